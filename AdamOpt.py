@@ -15,7 +15,7 @@ class AdamOpt:
     self.v = gvs[0][1]
     """
 
-    def __init__(self, variables, learning_rate = 0.001):
+    def __init__(self, variables, learning_rate = 0.001, model_axis = False):
 
         self.beta1 = 0.9
         self.beta2 = 0.999
@@ -24,6 +24,10 @@ class AdamOpt:
         self.variables = variables
         self.learning_rate = learning_rate
 
+        # With several models stacked along the first axis of every variable,
+        # each model has its own learning rate and its own update clipping
+        self.model_axis = model_axis
+
         self.m = {}
         self.v = {}
         self.delta_grads = {}
@@ -57,19 +61,36 @@ class AdamOpt:
 
     def compute_gradients(self, loss):
 
+        return self.update_variables(self.get_gradients(loss))
+
+
+    def get_gradients(self, loss):
+
         self.gradients = self.grad_descent.compute_gradients(loss, var_list = self.variables)
 
+        return [grads for grads, _ in self.gradients]
+
+
+    def update_variables(self, gradients):
+        """ Apply the Adam update given one gradient per variable, e.g. gradients
+            computed elsewhere and averaged across workers """
+
         self.t += 1
-        lr = self.learning_rate*np.sqrt(1-self.beta2**self.t)/(1-self.beta1**self.t)
+        lr = self.learning_rate*float(np.sqrt(1-self.beta2**self.t)/(1-self.beta1**self.t))
         self.update_var_op = []
 
         #grads_and_vars = []
-        for (grads, _), var in zip(self.gradients, self.variables):
+        for grads, var in zip(gradients, self.variables):
             new_m = self.beta1*self.m[var.op.name] + (1-self.beta1)*grads
             new_v = self.beta2*self.v[var.op.name] + (1-self.beta2)*grads*grads
 
-            delta_grad = - lr*new_m/(tf.sqrt(new_v) + self.epsilon)
-            delta_grad = tf.clip_by_norm(delta_grad, 1)
+            if self.model_axis:
+                rank = len(var.get_shape())
+                delta_grad = - tf.reshape(lr, [-1] + [1]*(rank-1))*new_m/(tf.sqrt(new_v) + self.epsilon)
+                delta_grad = tf.clip_by_norm(delta_grad, 1, axes=list(range(1, rank)))
+            else:
+                delta_grad = - lr*new_m/(tf.sqrt(new_v) + self.epsilon)
+                delta_grad = tf.clip_by_norm(delta_grad, 1)
 
             self.update_var_op.append(tf.assign(self.m[var.op.name], new_m))
             self.update_var_op.append(tf.assign(self.v[var.op.name], new_v))
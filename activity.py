@@ -0,0 +1,78 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import numpy as np
+import pickle
+import os
+
+# Model modules
+from parameters import par, rng
+
+
+def sample_indices(num_steps):
+    """ Choose the time steps, trials and units of each predictive cell
+        kept by the activity recorder """
+
+    steps = list(range(0, num_steps, par['record_time_stride']))
+
+    # With a dynamic batch, only trials present at the smallest batch size
+    batch_size = par['batch_size_min'] if par['dynamic_batch'] else par['batch_size']
+    n_trials = batch_size if par['record_trials'] is None else min(par['record_trials'], batch_size)
+    trials = list(range(n_trials))
+
+    # Units are drawn at random, so that analyses do not only see the first few
+    units = []
+    generator = rng('activity')
+    for n in par['n_hidden']:
+        if par['record_units'] is None or par['record_units'] >= n:
+            units.append(list(range(n)))
+        else:
+            units.append(sorted(generator.choice(n, par['record_units'], replace=False).tolist()))
+
+    return steps, trials, units
+
+
+class ActivityRecorder:
+
+    """ Streams sampled hidden activity, [record, time, trial, unit], to a
+        .npy file that can be opened with np.load(fn, mmap_mode='r').  The
+        units of all predictive cells are concatenated along the last axis,
+        and the sampled indices are saved alongside in a .pkl file """
+
+    def __init__(self, model, fn):
+
+        self.fn = fn
+        self.max_records = par['n_train_batches']//par['record_interval'] + 1
+        shape = (self.max_records, len(model.record_steps), len(model.record_trials), \
+            sum(len(u) for u in model.record_units))
+
+        os.makedirs(os.path.dirname(fn) or '.', exist_ok=True)
+        self.data = np.lib.format.open_memmap(fn + '.npy', mode='w+', dtype=np.float32, shape=shape)
+
+        self.info = {
+            'iters'     : [],
+            'steps'     : model.record_steps,
+            'trials'    : model.record_trials,
+            'units'     : model.record_units,
+            'cell'      : np.concatenate([[n]*len(u) for n, u in enumerate(model.record_units)]).astype(np.int32)}
+
+
+    def due(self, i):
+        return i%par['record_interval'] == 0 and len(self.info['iters']) < self.max_records
+
+
+    def record(self, i, h_sample):
+
+        self.data[len(self.info['iters'])] = h_sample
+        self.info['iters'].append(i)
+
+        # Keep the files on disk usable even if training is interrupted
+        self.data.flush()
+        self.info['num_records'] = len(self.info['iters'])
+        pickle.dump(self.info, open(self.fn + '.pkl', 'wb'))
+
+
+    def close(self):
+
+        self.data.flush()
+        del self.data
@@ -0,0 +1,329 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import tensorflow as tf
+import numpy as np
+import multiprocessing as mp
+import queue
+import os, time
+
+# Model modules
+from parameters import *
+import stimulus
+import model
+import graph_cache
+import results
+import evaluation
+
+
+class SharedWeights:
+
+    """ Flat shared-memory copy of the network weights, published by the
+        learner and polled by the actors between rollouts """
+
+    def __init__(self, layout, ctx):
+
+        # Layout is a list of (variable name, shape) pairs
+        self.layout = layout
+        self.sizes = [int(np.prod(shape)) for _, shape in layout]
+        self.buffer = ctx.RawArray('f', int(np.sum(self.sizes)))
+        self.version = ctx.Value('i', 0)
+
+
+    def publish(self, weights):
+
+        flat = np.frombuffer(self.buffer, dtype=np.float32)
+        with self.version.get_lock():
+            flat[:] = np.concatenate([weights[name].ravel() for name, _ in self.layout])
+            self.version.value += 1
+
+
+    def fetch(self, last_version):
+        """ Returns (version, weights), with weights None if nothing new has been published """
+
+        flat = np.frombuffer(self.buffer, dtype=np.float32)
+        with self.version.get_lock():
+            version = self.version.value
+            if version == last_version:
+                return version, None
+            values = np.copy(flat)
+
+        weights = {}
+        offset = 0
+        for (name, shape), size in zip(self.layout, self.sizes):
+            weights[name] = np.reshape(values[offset:offset+size], shape)
+            offset += size
+
+        return version, weights
+
+
+class ReplayBuffer:
+
+    """ The most recent trials recorded by the actors, in preallocated
+        arrays of [time, trial, ...] that are overwritten oldest first, so
+        that the learner can train on each rollout more than once """
+
+    def __init__(self, capacity):
+
+        if capacity < par['batch_size']:
+            raise Exception('replay_capacity must hold at least one batch.')
+
+        self.capacity = capacity
+        self.data = {
+            'inputs'         : np.zeros([par['num_time_steps'], capacity, par['n_input']], dtype=np.float32),
+            'action'         : np.zeros([par['num_time_steps'], capacity, par['n_pol']], dtype=np.float32),
+            'reward'         : np.zeros([par['num_time_steps'], capacity, par['n_val']], dtype=np.float32),
+            'behaviour_prob' : np.zeros([par['num_time_steps'], capacity, 1], dtype=np.float32)}
+        self.version = np.zeros(capacity, dtype=np.int64)
+        self.rng = rng('replay')
+        self.size = 0
+        self.next = 0
+
+
+    def add(self, trajectory):
+        """ Store the trials of a trajectory from an actor """
+
+        index = (self.next + np.arange(par['batch_size'])) % self.capacity
+        for k, v in self.data.items():
+            v[:,index] = trajectory[k]
+        self.version[index] = trajectory['version']
+
+        self.next = (self.next + par['batch_size']) % self.capacity
+        self.size = min(self.size + par['batch_size'], self.capacity)
+
+
+    def sample(self):
+        """ A batch of stored trials, drawn uniformly, as a trajectory """
+
+        index = self.rng.integers(self.size, size=par['batch_size'])
+        trajectory = {k : v[:,index] for k, v in self.data.items()}
+        trajectory['version'] = np.mean(self.version[index])
+
+        return trajectory
+
+
+def learner_step(sess, learner, trajectory, first, replayed=False):
+    """ Train the learner on a trajectory, returning the losses and rewards.
+        The path integral only follows the rewards of fresh trajectories, as
+        those of replayed ones were earned by older policies. """
+
+    feed_dict = {learner.traj_inputs: trajectory['inputs'], learner.traj_action: trajectory['action'], \
+        learner.traj_reward: trajectory['reward'], learner.behaviour_prob: trajectory['behaviour_prob']}
+
+    if par['stabilization'] == 'pathint' and not replayed:
+        _, _, _, pol_loss, val_loss, aux_loss, reward_list = sess.run([learner.train_op, \
+            learner.update_current_reward, learner.update_small_omega, learner.pol_loss, \
+            learner.val_loss, learner.aux_loss, learner.reward], feed_dict=feed_dict)
+        if not first:
+            sess.run([learner.update_small_omega], feed_dict=feed_dict)
+        sess.run([learner.update_previous_reward])
+    else:
+        _, pol_loss, val_loss, aux_loss, reward_list = sess.run([learner.train_op, learner.pol_loss, \
+            learner.val_loss, learner.aux_loss, learner.reward], feed_dict=feed_dict)
+
+    return pol_loss, val_loss, aux_loss, reward_list
+
+
+def publication(sess, learner):
+    """ Weights and hyperparameters handed to the actors, keyed by variable name """
+
+    weights = model.get_weights(sess)
+    values = sess.run(learner.hyperparameters)
+    weights.update({learner.hyperparameters[n].op.name : np.float32(v) for n, v in values.items()})
+
+    return weights
+
+
+def next_trajectory(trajectory_queue, actors):
+    """ Wait for a trajectory from the actors, raising if any of them has failed """
+
+    while True:
+        try:
+            return trajectory_queue.get(timeout=1.)
+        except queue.Empty:
+            if any(p.exitcode not in [None, 0] for p in actors) or not any(p.is_alive() for p in actors):
+                raise Exception('An actor failed.')
+
+
+def actor_process(actor_id, par_snapshot, shared_weights, trajectory_queue, stop_event):
+    """ Repeatedly roll out the most recently published policy, sending
+        the recorded trajectories to the learner """
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+    # Match the learner's parameters (reward vectors, etc.), but not its random streams
+    load_parameters(par_snapshot)
+    env = model.reset_environment(actor_id + 1)
+
+    tf.reset_default_graph()
+    with tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)) as sess:
+
+        actor = graph_cache.build(model.Model, env, mode='actor')
+        sess.run(tf.global_variables_initializer())
+        model.set_sampling_seed(sess, actor, worker=actor_id + 1)
+        prefetcher = stimulus.EpisodePrefetcher(env) if par['prefetch_episodes'] else None
+
+        version = 0
+        while not stop_event.is_set():
+
+            # Pick up new weights, waiting for the learner's first publication
+            new_version, weights = shared_weights.fetch(version)
+            if weights is not None:
+                model.set_weights(sess, weights)
+                model.set_hyperparameters(sess, actor, {n : weights[var.op.name] for n, var in actor.hyperparameters.items()})
+                version = new_version
+            elif version == 0:
+                time.sleep(0.01)
+                continue
+
+            if prefetcher is not None:
+                prefetcher.swap()
+            else:
+                env.place_agents()
+                env.place_rewards()
+
+            input_data, action, pol_out, reward = sess.run([actor.input_data, actor.action, actor.pol_out, actor.reward])
+
+            action = np.stack(action)
+            trajectory = {
+                'inputs'         : np.stack(input_data),
+                'action'         : action,
+                'reward'         : np.stack(reward),
+                'behaviour_prob' : np.sum(np.stack(pol_out)*action, axis=-1, keepdims=True),
+                'version'        : version,
+                'actor'          : actor_id}
+
+            # Block until the learner catches up, but keep an eye on the stop signal
+            while not stop_event.is_set():
+                try:
+                    trajectory_queue.put(trajectory, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+
+def actor_learner(save_fn='test.pkl', gpu_id=None):
+    """ Run reinforcement learning training, with rollouts generated
+        asynchronously by par['num_actors'] actor processes """
+
+    # Isolate requested GPU
+    if gpu_id is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+
+    # Reset Tensorflow graph before running anything
+    tf.reset_default_graph()
+
+    # Display relevant parameters
+    model.print_key_info()
+    print('Actor-learner training with {} actors.\n'.format(par['num_actors']))
+
+    # Build the learner before launching any actors, so the weight layout is known
+    device = '/cpu:0' if gpu_id is None else '/gpu:0'
+    learner = graph_cache.build(model.Model, model.stimulus_access, mode='learner', device=device)
+    layout = [(var.op.name, var.get_shape().as_list()) for var in tf.trainable_variables() + list(learner.hyperparameters.values())]
+
+    # TensorFlow does not survive forking, so actors are started fresh
+    ctx = mp.get_context('spawn')
+    shared_weights = SharedWeights(layout, ctx)
+    trajectory_queue = ctx.Queue(maxsize=par['actor_queue_size'])
+    stop_event = ctx.Event()
+    actors = [ctx.Process(target=actor_process, args=(n, dict(par), shared_weights, trajectory_queue, stop_event), daemon=True) \
+        for n in range(par['num_actors'])]
+    for p in actors:
+        p.start()
+
+    accuracy_iter = []
+    reward_iter = []
+    policy_lag = []
+    replay_lag = []
+    replay = ReplayBuffer(par['replay_capacity']) if par['replay_capacity'] else None
+
+    try:
+        with tf.Session(config=model.session_config()) as sess:
+
+            # Initialize variables and hand the initial weights to the actors
+            sess.run(tf.global_variables_initializer())
+            graph_cache.load_initial_weights(sess, learner)
+            sess.run(learner.reset_prev_vars)
+            hyperparameters = model.update_hyperparameters(sess, learner, 0)
+            shared_weights.publish(publication(sess, learner))
+            version = 1
+
+            # Evaluate snapshots of the weights on held-out episodes in the background
+            evaluator = evaluation.Evaluator(model.stimulus_access) if par['eval_interval'] else None
+
+            task_start_time = time.time()
+            n_steps = 0
+
+            for i in range(par['n_train_batches']):
+
+                trajectory = next_trajectory(trajectory_queue, actors)
+                policy_lag.append(version - trajectory['version'])
+                n_steps += par['batch_size']*par['num_time_steps']
+
+                hyperparameters = model.update_hyperparameters(sess, learner, i, hyperparameters)
+
+                # Calculate and apply gradients
+                pol_loss, val_loss, aux_loss, reward_list = learner_step(sess, learner, trajectory, i == 0)
+
+                # Train on replayed trials as well, with V-trace correcting for
+                # the older policies that recorded them
+                if replay is not None:
+                    replay.add(trajectory)
+                    for n in range(par['replay_ratio']):
+                        replay_batch = replay.sample()
+                        replay_lag.append(version - replay_batch['version'])
+                        learner_step(sess, learner, replay_batch, False, replayed=True)
+
+                # Hand the updated policy to the actors
+                if i%par['weight_publish_interval'] == 0:
+                    shared_weights.publish(publication(sess, learner))
+                    version += 1
+
+                if evaluator is not None and i%par['eval_interval'] == 0:
+                    evaluator.submit(i, model.get_weights(sess))
+
+                # Record accuracies
+                reward = np.stack(reward_list)
+                rew = np.mean(np.sum(reward, axis=0))
+                acc = np.mean(np.sum(reward>0, axis=0))
+                accuracy_iter.append(acc)
+                reward_iter.append(rew)
+
+                # Display network performance
+                if i%200 == 0:
+                    elapsed = time.time() - task_start_time
+                    print('Iter: {:>7} | Accuracy: {:5.3f} | Reward: {:5.3f} | Pol Loss: {:7.5f} | Val Loss: {:7.5f} | Aux Loss: {:7.5f}'.format(\
+                        i, acc, rew, pol_loss, val_loss, aux_loss))
+                    print('Time: {:>7} | Steps/sec: {:9.1f} | Policy lag: {:5.2f} | Queue: {}'.format(\
+                        int(np.around(elapsed)), n_steps/elapsed, np.mean(policy_lag[-200:]), trajectory_queue.qsize()))
+                    if replay is not None:
+                        print('Replay: {:>7} trials | Replay updates: {:>7} | Replay lag: {:5.2f}'.format(\
+                            replay.size, len(replay_lag), np.mean(replay_lag[-200*par['replay_ratio']:]) if replay_lag else 0.))
+                    print('')
+                    if evaluator is not None:
+                        for result in evaluator.poll():
+                            evaluation.print_result(result)
+
+            weights_fn = par['save_dir'] + par['save_fn'] + '_weights' + par['save_fn_suffix'] + '.pkl'
+            model.save_weights(sess, weights_fn)
+            metrics = results.summarize(accuracy_iter, reward_iter, time.time() - task_start_time, n_steps)
+            metrics['replay_updates'] = len(replay_lag)
+            eval_fn = None
+            if evaluator is not None:
+                eval_fn = model.finish_evaluation(evaluator, i, model.get_weights(sess))
+                metrics.update(evaluation.final_metrics(evaluator.results))
+            results.register_run(metrics, {'weights_file': weights_fn, 'evaluation_file': eval_fn})
+
+    finally:
+        # Stop the actors, draining the queue so none of them stays blocked
+        stop_event.set()
+        for p in actors:
+            while p.is_alive():
+                try:
+                    trajectory_queue.get(timeout=0.1)
+                except queue.Empty:
+                    p.join(timeout=0.1)
+
+    print('\nModel execution complete. (Actor-learner)')
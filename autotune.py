@@ -0,0 +1,286 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import numpy as np
+import multiprocessing as mp
+from itertools import product
+import platform
+import resource
+import pickle
+import queue
+import os, sys, time
+
+# Model modules
+from parameters import *
+
+# Settings searched by the autotuner, with the runtime environment variables they map to
+SETTINGS        = ['intra_op_threads', 'inter_op_threads', 'omp_num_threads', 'kmp_blocktime', 'prefetch_episodes', 'xla_jit']
+ENV_VARS        = {'omp_num_threads' : ['OMP_NUM_THREADS', 'MKL_NUM_THREADS'], 'kmp_blocktime' : ['KMP_BLOCKTIME']}
+
+# Smallest speed-up for which a setting replaces the current best, so that noise is not chased
+MIN_IMPROVEMENT = 1.05
+
+
+def machine_key():
+    """ Identify the machine, and the cores available to this process """
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return (platform.node(), platform.machine(), platform.processor(), os.cpu_count(), cores)
+
+
+def available_cores():
+    return machine_key()[-1]
+
+
+def apply(settings):
+    """ Use the given execution settings in this process.  The runtime
+        variables only take effect if no session has been started yet """
+
+    for k, v in settings.items():
+        par[k] = v
+    set_environment(settings)
+
+
+def set_environment(settings):
+
+    for k, names in ENV_VARS.items():
+        for name in names:
+            if settings[k] is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = str(settings[k])
+
+
+def benchmark_process(par_snapshot, settings, gpu_id, num_iters, result_queue):
+    """ Time a few training iterations with the given settings, in a fresh
+        process so that the threading runtime picks up its variables """
+
+    import tensorflow as tf
+    import stimulus
+    import model
+    import graph_cache
+
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    if gpu_id is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+
+    # With par['graph_cache'], every candidate builds the same graph, so
+    # only the first one pays for it
+    load_parameters(par_snapshot)
+    apply(settings)
+
+    # Settings that change the shapes of the weights redraw them, from the same streams
+    if 'num_models' in settings or 'batch_size' in settings:
+        par['seed'] = par['root_seed']
+        update_dependencies()
+    env = model.reset_environment()
+
+    tf.reset_default_graph()
+    with tf.Session(config=model.session_config()) as sess:
+
+        device = '/cpu:0' if gpu_id is None else '/gpu:0'
+        m = graph_cache.build(model.Model, env, device=device)
+        sess.run(tf.global_variables_initializer())
+        graph_cache.load_initial_weights(sess, m)
+        prefetcher = stimulus.EpisodePrefetcher(env) if par['prefetch_episodes'] else None
+
+        # One untimed iteration to warm up, and the median of the rest, as
+        # shared machines give the occasional slow iteration
+        times = []
+        reward = []
+        for i in range(num_iters + 1):
+            t_start = time.time()
+            if prefetcher is not None:
+                prefetcher.swap()
+            else:
+                env.place_agents()
+                env.place_rewards()
+            _, reward_list = sess.run([m.train_op, m.reward], feed_dict=m.state_feed(m.initial_state()))
+            times.append(time.time() - t_start)
+            reward.append(np.mean(np.sum(reward_list, axis=0)))
+
+    result_queue.put({'steps_per_sec' : par['batch_size']*m.num_steps/np.median(times[1:]), \
+                      'peak_memory'   : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, \
+                      'reward'        : reward})
+
+
+def benchmark(settings, gpu_id=None, num_iters=None):
+    """ Training steps per second, the peak memory of the process in MB,
+        and the reward of each iteration, with the given settings """
+
+    # The child inherits the environment at start-up
+    environ = dict(os.environ)
+    set_environment(settings)
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    num_iters = par['autotune_iters'] if num_iters is None else num_iters
+    p = ctx.Process(target=benchmark_process, args=(dict(par), settings, gpu_id, num_iters, result_queue))
+    p.start()
+    os.environ.clear()
+    os.environ.update(environ)
+
+    # The result is read before joining, as the child cannot exit until its
+    # queue has been flushed.  A setting that fails or times out scores zero.
+    result = None
+    deadline = time.time() + par['autotune_timeout']
+    while result is None:
+        exited = p.exitcode is not None
+        try:
+            result = result_queue.get(timeout=1.)
+        except queue.Empty:
+            if exited or time.time() > deadline:
+                break
+
+    p.join(timeout=10.)
+    if p.is_alive():
+        p.terminate()
+        p.join()
+    if result is None or p.exitcode != 0:
+        return {'steps_per_sec':0., 'peak_memory':0., 'reward':[]}
+
+    return result
+
+
+def candidates(name, cores):
+    """ Values tried for each setting """
+
+    if name in ['intra_op_threads', 'inter_op_threads']:
+        return [None] + sorted(set([1, min(2, cores), max(1, cores//2), cores]))
+    elif name == 'kmp_blocktime':
+        return [None, 0]
+    elif name == 'prefetch_episodes':
+        return [True, False]
+    elif name == 'xla_jit':
+        return [False, True]
+
+
+def autotune(gpu_id=None):
+    """ Choose the session threading, OpenMP/MKL and environment settings
+        giving the highest training throughput for the current parameters,
+        and apply them.  Results are cached per machine and graph. """
+
+    import graph_cache
+
+    key = (machine_key(), graph_cache.cache_key('train', '/cpu:0' if gpu_id is None else '/gpu:0'), gpu_id)
+    cache = pickle.load(open(par['autotune_cache'], 'rb')) if os.path.exists(par['autotune_cache']) else {}
+    if key in cache:
+        print('Using cached execution settings ({:.1f} steps/sec):'.format(cache[key]['steps_per_sec']))
+        print_settings(cache[key]['settings'])
+        apply(cache[key]['settings'])
+        return cache[key]['settings']
+
+    # Search one setting at a time, starting from the current ones
+    cores = available_cores()
+    best = {k : par[k] for k in SETTINGS}
+    results = {}
+
+    def measure(settings):
+        k = tuple(settings[s] for s in SETTINGS)
+        if k not in results:
+            results[k] = benchmark(settings, gpu_id)['steps_per_sec']
+            print('  {} -> {:9.1f} steps/sec'.format(k, results[k]))
+        return results[k]
+
+    print('\nAutotuning execution settings on {} cores...'.format(cores))
+    print('  ({})'.format(', '.join(SETTINGS)))
+    default_rate = measure(best)
+    for name in ['intra_op_threads', 'inter_op_threads', 'kmp_blocktime', 'prefetch_episodes', 'xla_jit']:
+        for value in candidates(name, cores):
+            settings = dict(best, **{name : value})
+            if name == 'intra_op_threads':
+                # Keep the OpenMP pool the same size as TensorFlow's own
+                settings['omp_num_threads'] = value
+            if measure(settings) > MIN_IMPROVEMENT*measure(best):
+                best = settings
+
+    rate = measure(best)
+    print('Best settings ({:.1f} steps/sec, {:+.0f}% over the starting settings):'.format(\
+        rate, 100*(rate/max(default_rate, 1e-9) - 1)))
+    print_settings(best)
+
+    # Other processes may have added to the cache in the meantime
+    cache = pickle.load(open(par['autotune_cache'], 'rb')) if os.path.exists(par['autotune_cache']) else {}
+    cache[key] = {'settings':best, 'steps_per_sec':rate, 'results':results}
+    pickle.dump(cache, open(par['autotune_cache'], 'wb'))
+
+    apply(best)
+    return best
+
+
+def print_settings(settings):
+
+    for k in SETTINGS:
+        print('  ' + k.ljust(28), settings[k])
+    print('')
+
+
+def compare_xla(gpu_id=None):
+    """ Training throughput and peak memory with and without XLA, with the
+        environment stepped in Python and in the graph """
+
+    print('Environment | XLA   | Steps/sec | Peak memory (MB)')
+    for in_graph_env, xla_jit in product([False, True], [False, True]):
+        settings = dict({k : par[k] for k in SETTINGS}, in_graph_env=in_graph_env, xla_jit=xla_jit)
+        result = benchmark(settings, gpu_id)
+        print('{:<11} | {:<5} | {:9.1f} | {:16.0f}'.format('graph' if in_graph_env else 'py_func', \
+            str(xla_jit), result['steps_per_sec'], result['peak_memory']))
+
+
+def compare_precision(num_iters=2000, window=100, tolerance=0.1, gpu_id=None):
+    """ Training throughput and peak memory in float32 and bfloat16, and
+        their learning curves from the same seed and initial weights, as the
+        mean reward over consecutive windows of iterations.  The curves match
+        if the mean rewards of every window differ by at most tolerance
+        (reward per trial).  Returns the results of both, and whether they match. """
+
+    results = {}
+    for precision in ['float32', 'bfloat16']:
+        settings = dict({k : par[k] for k in SETTINGS}, precision=precision)
+        results[precision] = benchmark(settings, gpu_id, num_iters)
+
+    print('Precision | Steps/sec | Peak memory (MB)')
+    for precision, result in results.items():
+        print('{:<9} | {:9.1f} | {:16.0f}'.format(precision, result['steps_per_sec'], result['peak_memory']))
+
+    # Sampled actions diverge between the two, so the curves can only match on average
+    curves = {k : [np.mean(r['reward'][n:n+window]) for n in range(1, len(r['reward']), window)] \
+        for k, r in results.items()}
+    print('\nIterations | float32 reward | bfloat16 reward | Difference')
+    for n, (a, b) in enumerate(zip(curves['float32'], curves['bfloat16'])):
+        print('{:>10} | {:14.3f} | {:15.3f} | {:10.3f}'.format((n+1)*window, a, b, b - a))
+
+    # A failed run has no curve to match
+    difference = np.abs(np.array(curves['bfloat16']) - np.array(curves['float32'])) \
+        if len(curves['float32']) == len(curves['bfloat16']) > 0 else np.array([np.inf])
+    match = bool(np.all(difference <= tolerance))
+    print('\nLearning curves {} (max. difference {:.3f}, tolerance {:.3f})'.format(\
+        'match: PASS' if match else 'differ: FAIL', np.amax(difference), tolerance))
+
+    return results, match
+
+
+def compare_models(model_counts=[1, 2, 4, 8], gpu_id=None):
+    """ Throughput per model when training several models, each with the
+        current batch size, in one graph, against training one alone """
+
+    print('Models | Steps/sec | Steps/sec per model | Speed-up | Peak memory (MB)')
+    single = None
+    for num_models in model_counts:
+        settings = dict({k : par[k] for k in SETTINGS}, num_models=num_models, batch_size=num_models*par['batch_size'])
+        result = benchmark(settings, gpu_id)
+        per_model = result['steps_per_sec']/num_models
+        single = per_model if single is None else single
+        print('{:>6} | {:9.1f} | {:19.1f} | {:8.2f} | {:16.0f}'.format(num_models, result['steps_per_sec'], \
+            per_model, per_model/max(single, 1e-9), result['peak_memory']))
+
+
+if __name__ == '__main__':
+    # python autotune.py [xla | precision | models]
+    if len(sys.argv) > 1 and sys.argv[1] == 'xla':
+        compare_xla()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'precision':
+        compare_precision()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'models':
+        compare_models()
+    else:
+        autotune()
@@ -0,0 +1,202 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import tensorflow as tf
+import numpy as np
+import multiprocessing as mp
+import os, time
+
+# Model modules
+from parameters import *
+import stimulus
+import model
+import graph_cache
+import results
+import evaluation
+import autotune
+
+
+class SharedGradients:
+
+    """ Shared-memory all-reduce of flat gradient vectors across workers.
+        Each worker averages one chunk of the vector (reduce-scatter) and
+        then reads back the full average (all-gather), so no single process
+        handles the whole reduction """
+
+    def __init__(self, num_workers, size, ctx):
+
+        self.num_workers = num_workers
+        self.size = size
+        self.slots = ctx.RawArray('f', num_workers*size)
+        self.result = ctx.RawArray('f', size)
+        self.barrier = ctx.Barrier(num_workers)
+        self.bounds = np.linspace(0, size, num_workers+1).astype(np.int64)
+
+
+    def average(self, worker_id, values):
+
+        slots = np.frombuffer(self.slots, dtype=np.float32).reshape(self.num_workers, self.size)
+        result = np.frombuffer(self.result, dtype=np.float32)
+
+        # Post this worker's contribution
+        slots[worker_id] = values
+        self.barrier.wait()
+
+        # Average this worker's chunk over all workers
+        start, end = self.bounds[worker_id], self.bounds[worker_id+1]
+        result[start:end] = np.mean(slots[:,start:end], axis=0)
+        self.barrier.wait()
+
+        return np.copy(result)
+
+
+def worker_process(worker_id, par_snapshot, shared_gradients):
+    """ Train on one shard of every batch, applying the gradients
+        averaged across all workers so that weights stay identical """
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+    # Identical parameters and initial weights, but a shard of the batch
+    # and independent environment draws
+    load_parameters(par_snapshot)
+    par['batch_size'] = par_snapshot['batch_size']//shared_gradients.num_workers
+    update_batch_dependencies()
+    env = model.reset_environment(worker_id + 1)
+
+    # Share the cores among the workers
+    par['intra_op_threads'] = max(1, autotune.available_cores()//shared_gradients.num_workers)
+    par['inter_op_threads'] = 1
+
+    tf.reset_default_graph()
+    with tf.Session(config=model.session_config()) as sess:
+
+        worker = graph_cache.build(model.Model, env, mode='worker')
+        sess.run(tf.global_variables_initializer())
+        graph_cache.load_initial_weights(sess, worker)
+        sess.run(worker.reset_prev_vars)
+        model.set_sampling_seed(sess, worker, worker=worker_id + 1)
+        prefetcher = stimulus.EpisodePrefetcher(env) if par['prefetch_episodes'] else None
+
+        sizes = [int(np.prod(ph.get_shape().as_list())) for ph in worker.gradient_ph]
+        offsets = np.cumsum([0] + sizes)
+        accuracy_iter = []
+        reward_iter = []
+        hyperparameters = None
+        task_start_time = time.time()
+
+        # The first worker evaluates snapshots of the weights on held-out episodes in the background
+        evaluator = evaluation.Evaluator(env) if par['eval_interval'] and worker_id == 0 else None
+
+        for i in range(par['n_train_batches']):
+
+            # Start new episodes, unless continuing the current ones in another window
+            if i%worker.windows_per_episode == 0:
+                if prefetcher is not None:
+                    prefetcher.swap()
+                else:
+                    env.place_agents()
+                    env.place_rewards()
+                carried_state = worker.initial_state()
+
+            # Every worker follows the same schedules
+            hyperparameters = model.update_hyperparameters(sess, worker, i, hyperparameters)
+
+            # Roll out this worker's shard and compute its gradients
+            if par['stabilization'] == 'pathint':
+                gradients, batch_reward, pol_loss, val_loss, reward_list, carried_state = sess.run([worker.local_gradients, \
+                    worker.batch_reward, worker.pol_loss, worker.val_loss, worker.reward, worker.state_out], \
+                    feed_dict=worker.state_feed(carried_state))
+            else:
+                gradients, pol_loss, val_loss, reward_list, carried_state = sess.run([worker.local_gradients, \
+                    worker.pol_loss, worker.val_loss, worker.reward, worker.state_out], feed_dict=worker.state_feed(carried_state))
+                batch_reward = 0.
+
+            # Average gradients and summary values across workers
+            reward = np.stack(reward_list)
+            rew = np.mean(np.sum(reward, axis=0))
+            acc = np.mean(np.sum(reward>0, axis=0))
+            summary = np.array([batch_reward, rew, acc, pol_loss, val_loss], dtype=np.float32)
+            averaged = shared_gradients.average(worker_id, np.concatenate([g.ravel() for g in gradients] + [summary]))
+            batch_reward, rew, acc, pol_loss, val_loss = averaged[offsets[-1]:]
+
+            # Apply the same update in every worker
+            feed_dict = {ph: np.reshape(averaged[offsets[n]:offsets[n+1]], ph.get_shape().as_list()) \
+                for n, ph in enumerate(worker.gradient_ph)}
+            if par['stabilization'] == 'pathint':
+                # The shared reward keeps the small omegas identical across workers
+                feed_dict[worker.batch_reward] = batch_reward
+                sess.run([worker.train_op, worker.update_current_reward, worker.update_small_omega], feed_dict=feed_dict)
+                if i>0:
+                    sess.run([worker.update_small_omega])
+                sess.run([worker.update_previous_reward])
+            else:
+                sess.run(worker.train_op, feed_dict=feed_dict)
+
+            accuracy_iter.append(acc)
+            reward_iter.append(rew)
+
+            if evaluator is not None and i%par['eval_interval'] == 0:
+                evaluator.submit(i, model.get_weights(sess))
+
+            # Display network performance
+            if worker_id == 0 and i%200 == 0:
+                elapsed = time.time() - task_start_time
+                n_steps = (i+1)*par_snapshot['batch_size']*worker.num_steps
+                print('Iter: {:>7} | Accuracy: {:5.3f} | Reward: {:5.3f} | Pol Loss: {:7.5f} | Val Loss: {:7.5f}'.format(\
+                    i, acc, rew, pol_loss, val_loss))
+                print('Time: {:>7} | Steps/sec: {:9.1f} | Workers: {} | Batch per worker: {}\n'.format(\
+                    int(np.around(elapsed)), n_steps/elapsed, shared_gradients.num_workers, par['batch_size']))
+                if evaluator is not None:
+                    for result in evaluator.poll():
+                        evaluation.print_result(result)
+
+        # Weights are identical in every worker, and the summary values are averaged
+        if worker_id == 0:
+            weights_fn = par['save_dir'] + par['save_fn'] + '_weights' + par['save_fn_suffix'] + '.pkl'
+            model.save_weights(sess, weights_fn)
+            n_steps = len(accuracy_iter)*par_snapshot['batch_size']*worker.num_steps
+            metrics = results.summarize(accuracy_iter, reward_iter, time.time() - task_start_time, n_steps)
+            eval_fn = None
+            if evaluator is not None:
+                eval_fn = model.finish_evaluation(evaluator, i, model.get_weights(sess))
+                metrics.update(evaluation.final_metrics(evaluator.results))
+            results.register_run(metrics, {'weights_file': weights_fn, 'evaluation_file': eval_fn}, params=par_snapshot)
+
+
+def data_parallel(save_fn='test.pkl', gpu_id=None):
+    """ Run reinforcement learning training with each batch split across
+        par['num_workers'] processes and gradients averaged synchronously """
+
+    if par['batch_size'] % par['num_workers'] != 0:
+        raise Exception('batch_size must be divisible by num_workers.')
+
+    # Display relevant parameters
+    model.print_key_info()
+    print('Data-parallel training with {} workers of {} trials each.\n'.format(\
+        par['num_workers'], par['batch_size']//par['num_workers']))
+
+    # Size of the flat gradient vector, plus the averaged summary values
+    size = model.num_weights() + 5
+
+    # TensorFlow does not survive forking, so workers are started fresh
+    ctx = mp.get_context('spawn')
+    shared_gradients = SharedGradients(par['num_workers'], size, ctx)
+    workers = [ctx.Process(target=worker_process, args=(n, dict(par), shared_gradients)) \
+        for n in range(par['num_workers'])]
+    for p in workers:
+        p.start()
+
+    try:
+        # If any worker fails, release the others from the barrier
+        while any(p.is_alive() for p in workers):
+            if any(p.exitcode not in [None, 0] for p in workers):
+                shared_gradients.barrier.abort()
+                raise Exception('A data-parallel worker failed.')
+            time.sleep(0.5)
+    finally:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+
+    print('\nModel execution complete. (Data-parallel)')
@@ -0,0 +1,216 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import numpy as np
+import multiprocessing as mp
+import queue
+
+# Model modules
+from parameters import *
+
+# Policies evaluated on every snapshot
+POLICIES = ['greedy', 'sampled']
+
+
+class Evaluator:
+
+    """ Evaluates snapshots of the weights in a separate process, on a
+        fixed held-out set of starting locations and reward layouts, so that
+        training does not wait for the evaluation """
+
+    def __init__(self, env):
+
+        # TensorFlow does not survive forking, so the evaluator is started fresh
+        ctx = mp.get_context('spawn')
+        self.snapshot_queue = ctx.Queue(maxsize=1)
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=evaluation_process, \
+            args=(dict(par), env.stim_loc, self.snapshot_queue, self.result_queue), daemon=True)
+        self.process.start()
+        self.results = []
+        self.submitted = None
+
+
+    def submit(self, i, weights):
+        """ Hand over the weights of iteration i, unless the evaluator is still
+            busy and another snapshot is already waiting, in which case this
+            one is skipped """
+
+        try:
+            self.snapshot_queue.put_nowait((i, weights))
+            self.submitted = i
+            return True
+        except queue.Full:
+            return False
+
+
+    def poll(self):
+        """ Evaluation results that have arrived since the last call """
+
+        new = []
+        while True:
+            try:
+                new.append(self.result_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.results += new
+
+        return new
+
+
+    def close(self, i=None, weights=None):
+        """ Evaluate the final weights, if given and not already handed over,
+            and wait for all evaluations to finish.  Returns the results not
+            yet polled. """
+
+        new = []
+        final = [(i, weights)] if weights is not None and i != self.submitted else []
+        for snapshot in final + [None]:
+            while self.process.is_alive():
+                try:
+                    self.snapshot_queue.put(snapshot, timeout=0.1)
+                    break
+                except queue.Full:
+                    new += self.poll()
+
+        # Keep draining the results, so that the process can exit
+        while self.process.is_alive():
+            new += self.poll()
+            self.process.join(timeout=0.1)
+
+        return new + self.poll()
+
+
+def evaluation_process(par_snapshot, stim_loc, snapshot_queue, result_queue):
+    """ Evaluate each snapshot handed over until None is received """
+
+    import tensorflow as tf
+    import model
+    import graph_cache
+
+    # The evaluation batch is independent of the training batch, and always
+    # covers whole episodes
+    load_parameters(par_snapshot)
+    par['batch_size'] = par['eval_batch_size']
+    par['tbptt_window'] = None
+    update_batch_dependencies()
+
+    # Reward locations must be those of the training environment
+    env = model.reset_environment()
+    env.stim_loc = stim_loc
+    episodes = held_out_episodes(env)
+
+    tf.reset_default_graph()
+    with tf.Session(config=model.session_config()) as sess:
+
+        m = graph_cache.build(model.Model, env, mode='actor')
+        sess.run(tf.global_variables_initializer())
+
+        # Failure penalty as at the start of training, so that all evaluations are comparable
+        model.update_hyperparameters(sess, m, 0)
+        model.set_sampling_seed(sess, m, 'evaluation')
+
+        while True:
+            snapshot = snapshot_queue.get()
+            if snapshot is None:
+                break
+
+            i, weights = snapshot
+            model.set_weights(sess, weights)
+            result_queue.put(evaluate(sess, m, env, episodes, i))
+
+
+def held_out_episodes(env):
+    """ Starting locations, rooms and reward maps of par['eval_episodes']
+        episodes, the same for every evaluation and every run with the same
+        par['eval_seed'].  All room sizes are used, regardless of buckets. """
+
+    generator = np.random.default_rng(par['eval_seed'])
+
+    episodes = []
+    for n in range(int(np.ceil(par['eval_episodes']/par['batch_size']))):
+        room_index = np.int32(generator.choice(len(env.room_sizes), size=par['batch_size']))
+        size = env.room_sizes[room_index]
+        agent_loc = np.int32(np.stack([generator.integers(size[:,0]), generator.integers(size[:,1])], axis=1))
+        reward_map = np.zeros_like(env.reward_map)
+        env.draw_rewards(reward_map, room_index, generator)
+        episodes.append({'agent_loc':agent_loc, 'room_index':room_index, 'reward_map':reward_map})
+
+    return episodes
+
+
+def layout_names(env):
+    """ Room size and the reward at each stimulus location, for each trial """
+
+    stim_loc = env.stim_loc[env.room_index]
+    rewards = env.reward_map[np.arange(par['batch_size'])[:,np.newaxis], stim_loc[...,0], stim_loc[...,1]]
+    return ['{}x{} {}'.format(h, w, [par['rewards'][r] for r in rew]) for (h, w), rew in zip(env.room_size(), rewards)]
+
+
+def evaluate(sess, m, env, episodes, i):
+    """ Success rate, reward and steps to reward of the greedy and the
+        sampled policy on the held-out episodes, overall and per layout """
+
+    result = {'iter': i}
+    for policy in POLICIES:
+
+        total, steps, layouts = [], [], []
+        for episode in episodes:
+
+            # Place the held-out episodes in the environment
+            env.agent_loc[:] = episode['agent_loc']
+            env.room_index[:] = episode['room_index']
+            env.reward_map[:] = episode['reward_map']
+            env.reset_history()
+
+            reward = np.stack(sess.run(m.reward, feed_dict={m.greedy: policy == 'greedy'}))[...,0]
+            total.append(np.sum(reward, axis=0))
+            steps.append(np.argmax(reward != 0, axis=0) + 1)
+            layouts += layout_names(env)
+
+        total = np.concatenate(total)[:par['eval_episodes']]
+        steps = np.concatenate(steps)[:par['eval_episodes']]
+        layouts = np.array(layouts[:par['eval_episodes']])
+        success = total > 0
+
+        result[policy] = summarize(total, steps, success)
+        result[policy]['layouts'] = {name : summarize(total[layouts==name], steps[layouts==name], success[layouts==name]) \
+            for name in sorted(set(layouts))}
+
+    return result
+
+
+def summarize(total, steps, success):
+
+    return {'episodes'     : len(total),
+            'success_rate' : float(np.mean(success)),
+            'mean_reward'  : float(np.mean(total)),
+            'mean_steps'   : float(np.mean(steps[success])) if np.any(success) else np.nan}
+
+
+def print_result(result):
+
+    for policy in POLICIES:
+        r = result[policy]
+        print('Eval:  {:>7} | Policy: {:<7} | Success: {:5.3f} | Reward: {:5.3f} | Steps to reward: {:6.2f}'.format(\
+            result['iter'], policy, r['success_rate'], r['mean_reward'], r['mean_steps']))
+        for name, l in r['layouts'].items():
+            print('       {:<24} | Success: {:5.3f} | Reward: {:5.3f} | Steps to reward: {:6.2f}'.format(\
+                name, l['success_rate'], l['mean_reward'], l['mean_steps']))
+    print('')
+
+
+def final_metrics(results):
+    """ Metrics of the last evaluation, for the results index """
+
+    if len(results) == 0:
+        return {}
+
+    last = max(results, key=lambda r: r['iter'])
+    metrics = {'eval_iter': last['iter']}
+    for policy in POLICIES:
+        metrics['eval_success_' + policy] = last[policy]['success_rate']
+        metrics['eval_reward_' + policy] = last[policy]['mean_reward']
+        metrics['eval_steps_' + policy] = last[policy]['mean_steps']
+
+    return metrics
@@ -0,0 +1,215 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import tensorflow as tf
+import numpy as np
+import multiprocessing as mp
+import queue
+import os
+
+# Model modules
+from parameters import *
+import model
+
+
+class FisherModel(model.Model):
+
+    """ Replays recorded trials through the network with a separate copy of
+        the weights for each trial in a chunk, so that one backward pass gives
+        the per-trial gradients of the log-likelihood of the chosen actions """
+
+    def __init__(self, chunk_size):
+
+        self.mode = 'fisher'
+        self.chunk_size = chunk_size
+        epsilon = 1e-7
+
+        # Shared weights, loaded from the training session
+        self.declare_variables()
+        self.shared_var_dict = self.var_dict
+        var_list = [var for var in tf.trainable_variables() if not 'val' in var.op.name]
+
+        # Recorded trials, [time, trial, ...]
+        self.inputs = tf.placeholder(tf.float32, shape=[par['num_time_steps'], chunk_size, par['n_input']])
+        self.action = tf.placeholder(tf.float32, shape=[par['num_time_steps'], chunk_size, par['n_pol']])
+        self.reward = tf.placeholder(tf.float32, shape=[par['num_time_steps'], chunk_size, par['n_val']])
+        self.mask   = tf.placeholder(tf.float32, shape=[par['num_time_steps'], chunk_size, 1])
+
+        # One copy of each weight per trial, so each trial is a batch of one
+        per_trial = {}
+        self.var_dict = {}
+        for name, var in self.shared_var_dict.items():
+            if isinstance(var, list):
+                self.var_dict[name] = [tf.tile(v[tf.newaxis], [chunk_size] + [1]*len(v.shape)) for v in var]
+                per_trial.update({v.op.name : w for v, w in zip(var, self.var_dict[name])})
+            else:
+                self.var_dict[name] = tf.tile(var[tf.newaxis], [chunk_size, 1, 1])
+                per_trial[var.op.name] = self.var_dict[name]
+
+        # Replay the trials
+        h = [tf.zeros([chunk_size, 1, n]) for n in par['n_hidden']]
+        c = [tf.zeros([chunk_size, 1, n]) for n in par['n_hidden']]
+        reward = tf.zeros([chunk_size, 1, par['n_val']])
+        action = tf.zeros([chunk_size, 1, par['n_pol']])
+
+        log_p_theta = 0.
+        for t in range(par['num_time_steps']):
+            h, c = self.predictive_hierarchy(self.inputs[t][:,tf.newaxis,:], h, c, reward, action, record=False)
+
+            pol_out = tf.nn.softmax(h[-1] @ self.var_dict['W_pol_out'] + self.var_dict['b_pol_out'], -1)
+            action = self.action[t][:,tf.newaxis,:]
+            reward = self.reward[t][:,tf.newaxis,:]
+            log_p_theta += tf.reduce_sum(self.mask[t][:,tf.newaxis,:]*action*tf.log(epsilon + pol_out))
+
+        # Accumulate squared per-trial gradients over chunks
+        names = [var.op.name for var in var_list]
+        grads = tf.gradients(log_p_theta, [per_trial[n] for n in names])
+
+        self.fisher_sum = {}
+        accumulate_ops = []
+        for n, var, grad in zip(names, var_list, grads):
+            self.fisher_sum[n] = tf.Variable(tf.zeros(var.get_shape()), trainable=False)
+            accumulate_ops.append(tf.assign_add(self.fisher_sum[n], tf.reduce_sum(tf.square(grad), axis=0)))
+
+        self.accumulate = tf.group(*accumulate_ops)
+        self.reset = tf.group(*[tf.assign(v, tf.zeros_like(v)) for v in self.fisher_sum.values()])
+
+
+class FisherEstimator:
+
+    """ Streaming per-trial Fisher estimate in its own graph and session, with
+        memory bounded by the chunk size rather than the number of trials """
+
+    def __init__(self, weights):
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            with tf.device('/cpu:0'):
+                self.model = FisherModel(par['EWC_fisher_chunk'])
+            self.sess = tf.Session(graph=self.graph)
+            self.sess.run(tf.global_variables_initializer())
+            model.set_weights(self.sess, weights)
+
+        self.num_trials = 0
+
+
+    def add_trials(self, trajectory):
+        """ Add a batch of recorded trials, [time, trial, ...], to the estimate """
+
+        m = self.model.chunk_size
+        num_trials = trajectory['inputs'].shape[1]
+        for start in range(0, num_trials, m):
+            chunk = {k : trajectory[k][:,start:start+m] for k in ['inputs', 'action', 'reward', 'mask']}
+
+            # The last chunk is padded with trials whose mask is zero, which
+            # add nothing to the estimate
+            n = chunk['inputs'].shape[1]
+            if n < m:
+                chunk = {k : np.pad(v, [(0,0), (0,m-n), (0,0)]) for k, v in chunk.items()}
+
+            self.sess.run(self.model.accumulate, feed_dict={
+                self.model.inputs : chunk['inputs'],
+                self.model.action : chunk['action'],
+                self.model.reward : chunk['reward'],
+                self.model.mask   : chunk['mask']})
+            self.num_trials += n
+
+
+    def result(self):
+
+        fisher_sum = self.sess.run(self.model.fisher_sum)
+
+        return {n : f/max(1, self.num_trials) for n, f in fisher_sum.items()}
+
+
+    def close(self):
+        self.sess.close()
+
+
+def fisher_process(par_snapshot, weights, trajectory_queue, result_queue):
+    """ Estimate the Fisher information from trials streamed in by the
+        training process, until a None is received """
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    load_parameters(par_snapshot)
+
+    estimator = FisherEstimator(weights)
+    while True:
+        trajectory = trajectory_queue.get()
+        if trajectory is None:
+            break
+        estimator.add_trials(trajectory)
+
+    result_queue.put(estimator.result())
+    estimator.close()
+
+
+def put_checked(q, item, p):
+    """ Put an item on a queue read by process p, raising if p has died """
+
+    while True:
+        try:
+            q.put(item, timeout=1.)
+            return
+        except queue.Full:
+            if not p.is_alive():
+                raise Exception('The Fisher estimation process failed.')
+
+
+def get_checked(q, p):
+    """ Get an item from a queue written by process p, raising if p has died without writing it """
+
+    while True:
+        exited = p.exitcode is not None
+        try:
+            return q.get(timeout=1.)
+        except queue.Empty:
+            if exited:
+                raise Exception('The Fisher estimation process failed.')
+
+
+def estimate_fisher(sess, train_model, env):
+    """ Roll out par['EWC_fisher_num_batches'] batches with the current policy
+        and return the per-trial Fisher information of each stabilized weight.
+        With par['EWC_fisher_process'], the estimate runs in another process
+        while the rollouts are being generated. """
+
+    if par['tbptt_window']:
+        raise Exception('EWC Fisher estimation requires whole-episode rollouts.')
+
+    weights = model.get_weights(sess)
+    if par['EWC_fisher_process']:
+        ctx = mp.get_context('spawn')
+        trajectory_queue = ctx.Queue(maxsize=2)
+        result_queue = ctx.Queue()
+        p = ctx.Process(target=fisher_process, args=(dict(par), weights, trajectory_queue, result_queue))
+        p.start()
+        add_trials = lambda trajectory: put_checked(trajectory_queue, trajectory, p)
+    else:
+        estimator = FisherEstimator(weights)
+        add_trials = estimator.add_trials
+
+    try:
+        for n in range(par['EWC_fisher_num_batches']):
+            env.place_agents()
+            env.place_rewards()
+            input_data, action, reward, mask = sess.run([train_model.input_data, train_model.action, \
+                train_model.reward, train_model.mask])
+            add_trials({'inputs': np.stack(input_data), 'action': np.stack(action), \
+                'reward': np.stack(reward), 'mask': np.stack(mask)})
+
+        if par['EWC_fisher_process']:
+            put_checked(trajectory_queue, None, p)
+            fisher = get_checked(result_queue, p)
+            p.join()
+        else:
+            fisher = estimator.result()
+            estimator.close()
+    finally:
+        # Do not leave a stuck estimation process behind on error
+        if par['EWC_fisher_process'] and p.is_alive():
+            p.terminate()
+            p.join()
+
+    return fisher
@@ -0,0 +1,178 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import tensorflow as tf
+from tensorflow.python.ops import script_ops
+import numpy as np
+import pickle
+import hashlib
+import os
+
+# Model modules
+from parameters import par
+
+# Parameters that change the structure of the graph
+GRAPH_PARAMS    = ['n_hidden', 'num_time_steps', 'batch_size', 'n_input', 'n_pol', 'n_val', 'n_cell_input', \
+                   'n_LSTM_input', 'stabilization', 'training_method', 'tbptt_window', 'wavefront_replay', 'recompute_gradients', \
+                   'record_trials', 'record_units', 'record_time_stride', 'sparse_weights', 'connection_prob', \
+                   'in_graph_env', 'xla_jit', 'precision', 'num_models', 'room_sizes', 'room_height', 'room_width', 'tasks', \
+                   'dynamic_batch', 'batch_size_min', 'num_nav_tuned', 'num_rew_tuned']
+
+# Parameters baked into the graph as constants.  Those of schedules.HYPERPARAMETERS
+# are variables instead, set after loading (see model.update_hyperparameters).
+CONSTANT_PARAMS = ['spike_cost', 'omega_xi', 'EWC_fisher_num_batches', 'vtrace_rho_clip', 'vtrace_c_clip', 'rewards']
+
+# Source files whose contents define the graph:  the model and optimizer, the
+# hyperparameters held in variables, and the activity sampled in the graph
+SOURCE_FILES    = ['model.py', 'AdamOpt.py', 'schedules.py', 'activity.py']
+
+
+def cache_key(mode, device='/cpu:0'):
+    """ Hash of everything that determines the constructed graph, including
+        the device its ops are placed on """
+
+    key = [tf.__version__, mode, device]
+    for k in GRAPH_PARAMS + CONSTANT_PARAMS:
+        # A dynamic batch is read from the environment at run time (except
+        # for fed-in trajectories)
+        if k == 'batch_size' and par['dynamic_batch'] and mode != 'learner':
+            continue
+        key.append((k, np.asarray(par[k]).tolist()))
+
+    # Sparse connectivity is baked into the graph
+    for k in sorted(k for k in par if k.endswith('_index')):
+        key.append((k, [hashlib.sha1(np.ascontiguousarray(index)).hexdigest() for index in par[k]]))
+    for fn in SOURCE_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), fn), 'rb') as f:
+            key.append(hashlib.sha1(f.read()).hexdigest())
+
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+
+def build(model_class, env, mode='train', device='/cpu:0'):
+    """ Build the model into the default graph on the given device, or load
+        it from the cache if an identical graph has been built before """
+
+    if not par['graph_cache']:
+        with tf.device(device):
+            return model_class(mode=mode)
+
+    path = os.path.join(par['graph_cache_dir'], mode + '_' + cache_key(mode, device))
+    if os.path.exists(path + '.meta') and os.path.exists(path + '.pkl'):
+        print('Loading cached graph from {}.meta'.format(path))
+        return load(model_class, env, path)
+
+    with tf.device(device):
+        model = model_class(mode=mode)
+    export(model, path)
+
+    return model
+
+
+def export(model, path):
+    """ Save the graph and the names of the model's tensors and ops """
+
+    graph = tf.get_default_graph()
+
+    # Record which environment method each py_func calls
+    py_funcs = {}
+    for op in graph.get_operations():
+        if op.type in ['PyFunc', 'PyFuncStateless']:
+            token = op.get_attr('token').decode()
+            py_funcs[token] = script_ops._py_funcs.get(token).__name__
+
+    handles = {k : to_handles(v) for k, v in model.__dict__.items()}
+
+    # Write to temporary files first, as several processes may be filling the cache at once
+    os.makedirs(par['graph_cache_dir'], exist_ok=True)
+    suffix = '.tmp{}'.format(os.getpid())
+    tf.train.export_meta_graph(filename=path + '.meta' + suffix, graph=graph)
+    pickle.dump({'handles':handles, 'py_funcs':py_funcs}, open(path + '.pkl' + suffix, 'wb'))
+    os.replace(path + '.meta' + suffix, path + '.meta')
+    os.replace(path + '.pkl' + suffix, path + '.pkl')
+
+
+def load(model_class, env, path):
+    """ Import a cached graph, rebinding its py_funcs to the given environment """
+
+    graph = tf.get_default_graph()
+    cached = pickle.load(open(path + '.pkl', 'rb'))
+
+    meta_graph_def = tf.MetaGraphDef()
+    with open(path + '.meta', 'rb') as f:
+        meta_graph_def.ParseFromString(f.read())
+
+    # Register the environment's methods and point the py_func ops at them
+    tokens = {}
+    if not hasattr(graph, '_py_funcs_used_in_graph'):
+        graph._py_funcs_used_in_graph = []
+    for node in meta_graph_def.graph_def.node:
+        if node.op in ['PyFunc', 'PyFuncStateless']:
+            old_token = node.attr['token'].s.decode()
+            if old_token not in tokens:
+                func = getattr(env, cached['py_funcs'][old_token])
+                tokens[old_token] = script_ops._py_funcs.insert(func)
+                graph._py_funcs_used_in_graph.append(func)
+            node.attr['token'].s = tokens[old_token].encode()
+
+    tf.train.import_meta_graph(meta_graph_def)
+
+    # Rebuild the model object around the imported graph
+    variables = {var.op.name : var for var in tf.global_variables()}
+    model = model_class.__new__(model_class)
+    for k, v in cached['handles'].items():
+        setattr(model, k, from_handles(v, graph, variables))
+
+    return model
+
+
+def load_initial_weights(sess, model):
+    """ Set the network weights to the current initial values in par, as a
+        cached graph carries the initial values of the run that built it """
+
+    ops = []
+    feed_dict = {}
+    for name, var in model.var_dict.items():
+        for v, val in zip(var if isinstance(var, list) else [var], \
+                par[name + '_init'] if isinstance(var, list) else [par[name + '_init']]):
+            ops.append(v.initializer)
+            feed_dict[v.initializer.inputs[1]] = val
+
+    sess.run(ops, feed_dict=feed_dict)
+
+
+def to_handles(value):
+    """ Replace tensors, ops and variables by their names, recursively """
+
+    if isinstance(value, tf.Variable):
+        return ('variable', value.op.name)
+    elif isinstance(value, tf.Tensor):
+        return ('tensor', value.name)
+    elif isinstance(value, tf.Operation):
+        return ('op', value.name)
+    elif isinstance(value, (list, tuple)):
+        return ('list', [to_handles(v) for v in value])
+    elif isinstance(value, dict):
+        return ('dict', {k : to_handles(v) for k, v in value.items()})
+    elif value is None or isinstance(value, (str, int, float, bool)):
+        return ('value', value)
+    else:
+        # Python-side helpers (optimizers, etc.) are not needed after loading
+        return ('value', None)
+
+
+def from_handles(handle, graph, variables):
+
+    kind, value = handle
+    if kind == 'variable':
+        return variables[value]
+    elif kind == 'tensor':
+        return graph.get_tensor_by_name(value)
+    elif kind == 'op':
+        return graph.get_operation_by_name(value)
+    elif kind == 'list':
+        return [from_handles(v, graph, variables) for v in value]
+    elif kind == 'dict':
+        return {k : from_handles(v, graph, variables) for k, v in value.items()}
+    else:
+        return value
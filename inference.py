@@ -0,0 +1,259 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import tensorflow as tf
+import numpy as np
+from multiprocessing.connection import Listener, Client
+import threading, queue
+import pickle
+import os, sys, time
+
+# Model modules
+from parameters import *
+import model
+
+
+class InferenceModel(model.Model):
+
+    """ One step of the predictive-cell hierarchy and policy head, for a
+        variable number of independent episodes, with the recurrent state
+        fed in and fetched out by the caller """
+
+    def __init__(self):
+
+        self.mode = 'inference'
+        self.precision = par['precision']
+        self.num_models = par['num_models']
+        if self.num_models > 1:
+            raise Exception('Weights of several models trained in one graph cannot be served; ' + \
+                'train the model to serve on its own.')
+        self.declare_variables()
+
+        self.inputs = tf.placeholder(tf.float32, shape=[None, par['n_input']])
+        self.prev_reward = tf.placeholder(tf.float32, shape=[None, par['n_val']])
+        self.prev_action = tf.placeholder(tf.float32, shape=[None, par['n_pol']])
+        self.h_in = [tf.placeholder(tf.float32, shape=[None, n]) for n in par['n_hidden']]
+        self.c_in = [tf.placeholder(tf.float32, shape=[None, n]) for n in par['n_hidden']]
+
+        self.h_out, self.c_out = self.predictive_hierarchy(self.inputs, self.h_in, self.c_in, \
+            self.prev_reward, self.prev_action, record=False)
+
+        self.pol_out = tf.nn.softmax(self.output_layer(self.h_out[-1], 'pol'), -1)
+        self.val_out = self.output_layer(self.h_out[-1], 'val')
+
+
+class PolicyServer:
+
+    """ Serves a trained policy over a local socket.  Each client episode
+        (session) keeps its own recurrent state on the server, and step
+        requests arriving from many clients at once are answered with one
+        forward pass over all of them. """
+
+    def __init__(self, weights_fn, address=None):
+
+        # Rebuild the network that was trained
+        saved = pickle.load(open(weights_fn, 'rb'))
+        load_parameters(saved['par'])
+        self.address = par['inference_address'] if address is None else address
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            with tf.device('/cpu:0'):
+                self.model = InferenceModel()
+            self.sess = tf.Session(graph=self.graph, config=model.session_config())
+            self.sess.run(tf.global_variables_initializer())
+            model.set_weights(self.sess, saved['weights'])
+
+        self.sessions = {}
+        self.rng = rng('inference')
+        self.requests = queue.Queue()
+        self.running = False
+        self.batch_sizes = []
+
+
+    def start(self):
+        """ Start accepting clients and serving requests in background threads """
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        self.listener = Listener(self.address)
+        self.running = True
+
+        self.threads = [threading.Thread(target=self.accept_loop, daemon=True), \
+                        threading.Thread(target=self.batch_loop, daemon=True)]
+        for t in self.threads:
+            t.start()
+
+
+    def stop(self):
+
+        self.running = False
+        self.requests.put(None)
+        self.listener.close()
+
+
+    def accept_loop(self):
+
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.client_loop, args=(conn,), daemon=True).start()
+
+
+    def client_loop(self, conn):
+        """ Hand each request from one client to the batcher, and send back its reply """
+
+        done = threading.Event()
+        while self.running:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if request['type'] == 'reset':
+                self.sessions.pop(request['session'], None)
+                conn.send({'ok': True})
+            elif request['type'] == 'step':
+                request['done'] = done
+                self.requests.put(request)
+                done.wait()
+                done.clear()
+                conn.send(request['reply'])
+
+        conn.close()
+
+
+    def batch_loop(self):
+        """ Collect concurrent step requests into micro-batches """
+
+        while self.running:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+
+            # Wait briefly for other clients, up to the batch limit
+            deadline = time.time() + par['inference_max_wait']
+            while len(batch) < par['inference_max_batch']:
+                try:
+                    request = self.requests.get(timeout=max(0., deadline - time.time()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.running = False
+                    break
+                batch.append(request)
+
+            self.step(batch)
+            for request in batch:
+                request['done'].set()
+
+
+    def initial_state(self):
+
+        return {'h'      : [0.*par['h_init'][i][0] for i in range(par['num_pred_cells'])],
+                'c'      : [0.*par['h_init'][i][0] for i in range(par['num_pred_cells'])],
+                'action' : np.zeros(par['n_pol'], dtype=np.float32)}
+
+
+    def step(self, batch):
+        """ Advance every session in the batch by one time step """
+
+        states = [self.sessions.get(r['session']) or self.initial_state() for r in batch]
+        m = self.model
+
+        feed_dict = {m.inputs: np.stack([r['inputs'] for r in batch]), \
+            m.prev_reward: np.reshape(np.float32([r['reward'] for r in batch]), [-1, par['n_val']]), \
+            m.prev_action: np.stack([s['action'] for s in states])}
+        for i in range(par['num_pred_cells']):
+            feed_dict[m.h_in[i]] = np.stack([s['h'][i] for s in states])
+            feed_dict[m.c_in[i]] = np.stack([s['c'][i] for s in states])
+
+        h, c, pol, val = self.sess.run([m.h_out, m.c_out, m.pol_out, m.val_out], feed_dict=feed_dict)
+        self.batch_sizes.append(len(batch))
+
+        for n, r in enumerate(batch):
+            p = pol[n]/np.sum(pol[n])
+            action = int(np.argmax(p)) if r.get('greedy') else int(self.rng.choice(par['n_pol'], p=p))
+            self.sessions[r['session']] = {'h': [x[n] for x in h], 'c': [x[n] for x in c], \
+                'action': np.float32(np.arange(par['n_pol']) == action)}
+            r['reply'] = {'action': action, 'policy': pol[n], 'value': val[n]}
+
+
+class PolicyClient:
+
+    """ Connection to a PolicyServer.  Each session is one episode; step
+        takes the current observation and the reward for the previous
+        action, and returns the next action """
+
+    def __init__(self, address=None):
+        self.conn = Client(par['inference_address'] if address is None else address)
+
+    def reset(self, session):
+        self.conn.send({'type': 'reset', 'session': session})
+        return self.conn.recv()
+
+    def step(self, session, inputs, reward=0., greedy=False):
+        self.conn.send({'type': 'step', 'session': session, 'inputs': np.float32(inputs), \
+            'reward': reward, 'greedy': greedy})
+        return self.conn.recv()
+
+    def close(self):
+        self.conn.close()
+
+
+def benchmark(weights_fn, num_clients=[1, 4, 16, 64], num_steps=200):
+    """ Latency and throughput of the server under concurrent load, with
+        each client stepping its own episodes as fast as it is answered.
+        Returns the measurements for each number of clients. """
+
+    server = PolicyServer(weights_fn)
+    server.start()
+    inputs = np.zeros(par['n_input'], dtype=np.float32)
+
+    measurements = []
+    print('Clients | Steps/sec | Mean batch | Latency p50 (ms) | p99 (ms)')
+    for n in num_clients:
+        latencies = [[] for _ in range(n)]
+
+        def run(k):
+            client = PolicyClient(server.address)
+            for t in range(num_steps):
+                t_start = time.time()
+                client.step((k, n), inputs + t, reward=0.)
+                latencies[k].append(time.time() - t_start)
+            client.close()
+
+        server.batch_sizes = []
+        threads = [threading.Thread(target=run, args=(k,)) for k in range(n)]
+        t_start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - t_start
+
+        latency = 1000*np.concatenate(latencies)
+        measurements.append({'clients': n, 'steps_per_sec': n*num_steps/elapsed, 'mean_batch': np.mean(server.batch_sizes), \
+            'latency_p50': np.percentile(latency, 50), 'latency_p99': np.percentile(latency, 99)})
+        print('{clients:>7} | {steps_per_sec:9.1f} | {mean_batch:10.2f} | {latency_p50:16.2f} | {latency_p99:8.2f}'.format(**measurements[-1]))
+
+    server.stop()
+    return measurements
+
+
+if __name__ == '__main__':
+    # python inference.py <weights file> [benchmark]
+    if len(sys.argv) > 2 and sys.argv[2] == 'benchmark':
+        benchmark(sys.argv[1])
+    else:
+        server = PolicyServer(sys.argv[1])
+        server.start()
+        print('Serving {} at {}'.format(sys.argv[1], server.address))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.stop()
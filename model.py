@@ -5,6 +5,7 @@ import tensorflow as tf
 import numpy as np
 import pickle
 import os, sys, time
+import contextlib
 from itertools import product
 import matplotlib
 matplotlib.use('Agg')
@@ -14,6 +15,12 @@ import matplotlib.pyplot as plt
 from parameters import *
 import stimulus
 import AdamOpt
+import graph_cache
+import activity
+import results
+import evaluation
+import tasks
+import schedules
 
 # Match GPU IDs to nvidia-smi command
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -23,30 +30,138 @@ os.environ['TF_CPP_MIN_LOG_LEVEL']='2'
 
 stimulus_access = stimulus.RoomStimulus()
 
-class Model:
+# Network variable prefixes
+LSTM_VAR_PREFIXES   = ['Wf', 'Wi', 'Wo', 'Wc', 'Uf', 'Ui', 'Uo', 'Uc', 'bf', 'bi', 'bo', 'bc', 'W_pred', 'b_pred']
+RL_VAR_PREFIXES     = ['W_pol_out', 'b_pol_out', 'W_val_out', 'b_val_out']
+
+# Weights stored as the values of existing synapses only, if par['sparse_weights']
+SPARSE_VAR_PREFIXES = ['Wf', 'Wi', 'Wo', 'Wc', 'Uf', 'Ui', 'Uo', 'Uc', 'W_pred']
 
-    """ RNN model for supervised and reinforcement learning training """
+# Components of each predictive cell's input, as recorded in Model.pred_error
+PRED_ERROR_COMPONENTS = ['stim', 'rew', 'act']
 
-    def __init__(self):
+class Model:
 
-        self.time_mask = tf.unstack(tf.ones([par['num_time_steps'],par['batch_size']]), axis=0)
+    """ RNN model for supervised and reinforcement learning training
+
+        mode = 'train'   : collect rollouts from the environment and train on them
+        mode = 'actor'   : collect rollouts from the environment only
+        mode = 'learner' : train on rollouts fed in from (possibly stale) actors
+        mode = 'worker'  : collect rollouts and compute gradients, with the update
+                           applied from gradients fed back in (e.g. averaged across workers) """
+
+    # Precision of the predictive cells' computations and activity
+    precision = 'float32'
+
+    # Models trained side by side in the graph, with stacked weights
+    num_models = 1
+
+    def __init__(self, mode='train'):
+
+        self.mode = mode
+
+        # In bfloat16, the master weights and optimizer state stay in float32,
+        # and only the predictive cells are computed in reduced precision
+        self.precision = par['precision']
+
+        # The evaluator keeps the held-out episodes of the first task
+        if self.mode == 'train' and par['tasks'] and par['eval_interval']:
+            raise Exception('Evaluation (eval_interval) is not supported with a schedule of tasks.')
+
+        # Several independent models can share the graph, each with its own
+        # slice of the batch, weights, hyperparameters, optimizer and
+        # stabilization state.  Their weights are stacked along a leading axis,
+        # so that the predictive cells of all models run as batched matmuls.
+        self.num_models = par['num_models']
+        if self.num_models > 1:
+            if self.mode != 'train' or par['stabilization'] == 'EWC' or par['tasks'] or par['eval_interval']:
+                raise Exception('Several models in one graph are only supported by the standard training loop, ' + \
+                    'without EWC, tasks or evaluation.')
+            if par['batch_size'] % self.num_models != 0:
+                raise Exception('batch_size must be divisible by num_models.')
+            if par['model_hyperparameters'] is not None and len(par['model_hyperparameters']) != self.num_models:
+                raise Exception('model_hyperparameters must hold one dictionary per model.')
+
+        # Replayed trajectories do not depend on the network's actions, so cells
+        # of equal size can be evaluated a whole anti-diagonal at a time
+        self.wavefront = self.mode == 'learner' and par['wavefront_replay'] and len(set(par['n_hidden'])) == 1 \
+            and not par['sparse_weights'] and not par['recompute_gradients']
+
+        # With truncated BPTT, each run covers one window of the episode,
+        # with the network and trial state carried over between runs
+        self.num_steps = par['tbptt_window'] if par['tbptt_window'] else par['num_time_steps']
+        self.windows_per_episode = int(np.ceil(par['num_time_steps']/self.num_steps))
+        if par['tbptt_window'] and self.mode == 'learner':
+            raise Exception('Truncated BPTT is not supported for fed-in trajectories.')
+        if par['tbptt_window'] and par['stabilization'] == 'EWC':
+            raise Exception('Truncated BPTT is not supported with EWC, whose Fisher estimate needs whole-episode rollouts.')
+
+        # The environment can be stepped with graph ops instead of Python callbacks,
+        # starting from the episodes placed by stimulus_access
+        self.in_graph_env = par['in_graph_env'] and self.mode != 'learner'
+        if self.in_graph_env and par['tbptt_window']:
+            raise Exception('Truncated BPTT is not supported for the in-graph environment.')
+
+        # The rollout and losses can only be compiled as a whole if the
+        # environment is not called back in Python at every step
+        self.xla = par['xla_jit'] and (self.mode == 'learner' or self.in_graph_env) and not par['sparse_weights']
+        if par['xla_jit'] and not self.xla:
+            print('XLA compilation skipped: the environment is stepped through tf.py_func, or sparse weights are used.')
 
         # Declare all Tensorflow variables
         self.declare_variables()
+        self.declare_hyperparameters()
+
+        # With a dynamic batch, the number of trials is read from the environment
+        # at run time, so that it can change between iterations (see
+        # schedules.BatchScheduler).  Fed-in trajectories keep a fixed batch.
+        self.dynamic_batch = par['dynamic_batch'] and self.mode != 'learner'
+        if self.dynamic_batch and self.num_models > 1:
+            raise Exception('A dynamic batch is not supported with several models in one graph.')
+        if self.dynamic_batch:
+            self.static_batch_size = None
+            with tf.device('/cpu:0'):
+                self.batch_size, = tf.py_func(stimulus_access.get_batch_size, [], [tf.int32])
+                self.batch_size.set_shape([])
+        else:
+            self.static_batch_size = self.batch_size = par['batch_size']
+
+        # Make placeholders for trajectories generated elsewhere
+        if self.mode == 'learner':
+            self.declare_placeholders()
+
+        # Make placeholders for the state carried over from the previous window
+        self.declare_state_placeholders()
+        if par['tbptt_window']:
+            self.time_mask = [tf.cast(self.state_in['step'] + t < par['num_time_steps'], tf.float32)*tf.ones([self.batch_size]) \
+                for t in range(self.num_steps)]
+        else:
+            self.time_mask = tf.unstack(tf.ones([par['num_time_steps'],self.batch_size]), axis=0)
 
         # Build the Tensorflow graph
-        self.rnn_cell_loop()
+        with self.jit_scope():
+            self.rnn_cell_loop()
 
         # Train the model
-        self.optimize()
+        if self.mode != 'actor':
+            self.optimize()
+
+
+    def jit_scope(self, compile_ops=True):
+        """ Mark the ops built inside for XLA compilation, if enabled.
+            Their gradients are compiled along with them. """
+
+        if not self.xla:
+            return contextlib.suppress()
+        return tf.xla.experimental.jit_scope(compile_ops=compile_ops)
 
 
     def declare_variables(self):
         """ Initialize all required variables """
 
         # All the possible prefixes based on network setup
-        lstm_var_prefixes   = ['Wf', 'Wi', 'Wo', 'Wc', 'Uf', 'Ui', 'Uo', 'Uc', 'bf', 'bi', 'bo', 'bc', 'W_pred', 'b_pred']
-        rl_var_prefixes     = ['W_pol_out', 'b_pol_out', 'W_val_out', 'b_val_out']
+        lstm_var_prefixes   = LSTM_VAR_PREFIXES
+        rl_var_prefixes     = RL_VAR_PREFIXES
         #base_var_prefies    = ['W_out', 'b_out']
 
         # Add relevant prefixes to variable declaration
@@ -65,6 +180,104 @@ class Model:
                 self.var_dict[name] = tf.get_variable(name, initializer = par[name + '_init'])
 
 
+    def declare_hyperparameters(self):
+        """ Hyperparameters as variables, so that they can be changed between
+            iterations (see schedules.py and set_hyperparameters) """
+
+        # One value per model, if there are several
+        initial = lambda name: np.float32(par[name] if self.num_models == 1 else \
+            [schedules.start(name, n) for n in range(self.num_models)])
+
+        with tf.variable_scope('hyperparameters'):
+            self.hyperparameters = {name : tf.get_variable(name, initializer=initial(name), trainable=False) \
+                for name in schedules.HYPERPARAMETERS}
+
+
+    def per_model(self, x, rank):
+        """ A value per model, x, reshaped to broadcast against tensors of the
+            given rank with the models along their first axis (e.g. stacked
+            weights).  With a single model, x is a scalar and is returned as is. """
+
+        return x if self.num_models == 1 else tf.reshape(x, [-1] + [1]*(rank-1))
+
+
+    def per_trial(self, name):
+        """ A hyperparameter as a scalar, or with several models as a
+            [batch_size, 1] tensor holding the value of each trial's model """
+
+        x = self.hyperparameters[name]
+        if self.num_models == 1:
+            return x
+
+        return tf.reshape(tf.tile(x[:,tf.newaxis], [1, par['batch_size']//self.num_models]), [par['batch_size'], 1])
+
+
+    def split_models(self, x):
+        """ [batch, n] as [model, batch per model, n], with several models """
+
+        return x if self.num_models == 1 else tf.reshape(x, [self.num_models, -1, x.shape.as_list()[-1]])
+
+
+    def merge_models(self, x):
+        """ Inverse of split_models """
+
+        return x if self.num_models == 1 else tf.reshape(x, [-1, x.shape.as_list()[-1]])
+
+
+    def declare_placeholders(self):
+        """ Make placeholders for trajectories recorded by an actor """
+
+        self.traj_inputs    = tf.placeholder(tf.float32, shape=[par['num_time_steps'], par['batch_size'], par['n_input']])
+        self.traj_action    = tf.placeholder(tf.float32, shape=[par['num_time_steps'], par['batch_size'], par['n_pol']])
+        self.traj_reward    = tf.placeholder(tf.float32, shape=[par['num_time_steps'], par['batch_size'], par['n_val']])
+        self.behaviour_prob = tf.placeholder(tf.float32, shape=[par['num_time_steps'], par['batch_size'], 1])
+
+
+    def declare_state_placeholders(self):
+        """ Make placeholders for the network and trial state at the start
+            of a window, defaulting to the start of an episode """
+
+        self.state_in = {}
+        self.state_out = {}
+        if not par['tbptt_window']:
+            return
+
+        default = lambda n, value=0.: tf.placeholder_with_default(value*tf.ones([self.batch_size, n]), shape=[self.static_batch_size, n])
+        self.state_in['h']      = [default(n) for n in par['n_hidden']]
+        self.state_in['c']      = [default(n) for n in par['n_hidden']]
+        self.state_in['mask']   = default(1, 1.)
+        self.state_in['action'] = default(par['n_pol'])
+        self.state_in['reward'] = default(par['n_val'])
+        self.state_in['step']   = tf.placeholder_with_default(0, shape=[])
+
+
+    def initial_state(self):
+        """ Carried state at the start of an episode """
+
+        if not par['tbptt_window']:
+            return {}
+
+        return {'h'      : [np.zeros_like(par['h_init'][i]) for i in range(par['num_pred_cells'])],
+                'c'      : [np.zeros_like(par['h_init'][i]) for i in range(par['num_pred_cells'])],
+                'mask'   : np.ones([par['batch_size'], 1], dtype=np.float32),
+                'action' : np.zeros([par['batch_size'], par['n_pol']], dtype=np.float32),
+                'reward' : np.zeros([par['batch_size'], par['n_val']], dtype=np.float32),
+                'step'   : 0}
+
+
+    def state_feed(self, state):
+        """ Feed dictionary for a carried state (as fetched from state_out) """
+
+        feed_dict = {}
+        for k, v in state.items():
+            if isinstance(v, list):
+                feed_dict.update(zip(self.state_in[k], v))
+            else:
+                feed_dict[self.state_in[k]] = v
+
+        return feed_dict
+
+
     def rnn_cell_loop(self):
         """ Initialize parameters and execute loop through
             time to generate the network outputs """
@@ -78,78 +291,107 @@ class Model:
         self.action     = []
         self.reward     = []
         self.agent_locs = []
-        reward = tf.constant(np.zeros((par['batch_size'], par['n_val']), dtype = np.float32))
-        action = tf.constant(np.zeros((par['batch_size'], par['n_pol']), dtype = np.float32))
-        feedback_reward = tf.constant(np.zeros((par['batch_size'], par['n_val']), dtype = np.float32))
+        reward = tf.zeros([self.batch_size, par['n_val']])
+        action = tf.zeros([self.batch_size, par['n_pol']])
+        feedback_reward = tf.zeros([self.batch_size, par['n_val']])
+
+        # Actions are sampled from the policy, or the most probable one is taken (e.g. for evaluation)
+        self.greedy = tf.placeholder_with_default(False, shape=[])
 
         # Initialize state records
         self.h                  = []
-        self.total_pred_error   = [[] for _ in range(par['num_pred_cells'])]
-        self.stim_pred_error    = [[] for _ in range(par['num_pred_cells'])]
-        self.rew_pred_error     = [[] for _ in range(par['num_pred_cells'])]
-        self.act_pred_error     = [[] for _ in range(par['num_pred_cells'])]
+        self.pred_error_steps   = []
 
         # Initialize network state
-        h     = [tf.zeros_like(par['h_init'][i]) for i in range(par['num_pred_cells'])]
-        c     = [tf.zeros_like(par['h_init'][i]) for i in range(par['num_pred_cells'])]
-        mask  = tf.constant(np.ones((par['batch_size'], 1), dtype = np.float32))
+        h     = [tf.zeros([self.batch_size, n]) for n in par['n_hidden']]
+        c     = [tf.zeros([self.batch_size, n]) for n in par['n_hidden']]
+        mask  = tf.ones([self.batch_size, 1])
+
+        # Or pick up where the previous window left off
+        if par['tbptt_window']:
+            h, c = list(self.state_in['h']), list(self.state_in['c'])
+            mask, action, reward = self.state_in['mask'], self.state_in['action'], self.state_in['reward']
 
         self.expected_reward_vector = []
         self.actual_reward_vector = []
+
+        # In replay, every step's inputs are known in advance (the recorded
+        # rewards are already masked), so the whole hierarchy is run up front
+        if self.wavefront:
+            replay_h, replay_c = self.wavefront_hierarchy(tf.unstack(self.traj_inputs), \
+                [reward] + tf.unstack(self.traj_reward)[:-1], [action] + tf.unstack(self.traj_action)[:-1], h, c)
+
+        # The environment calls of a step must follow those of the previous step,
+        # as nothing else orders these stateful ops
+        env_step = []
+        env = self.episode_start() if self.in_graph_env else None
+
+        # Actions are sampled statelessly, from the seed of this process (see
+        # set_sampling_seed), the number of the rollout and the time step
+        if self.mode != 'learner':
+            with tf.variable_scope('sampling'):
+                self.sampling_seed = tf.get_variable('seed', initializer=np.int64(0), trainable=False)
+                self.rollouts = tf.get_variable('rollouts', initializer=np.int64(0), trainable=False)
+            with self.jit_scope(compile_ops=False):
+                rollout = tf.assign_add(self.rollouts, 1)
+
         # Loop through time, procuring new inputs at the end of each time step
-        for t in range(par['num_time_steps']):
+        for t in range(self.num_steps):
 
-            with tf.device('/cpu:0'):
-                inputs, = tf.py_func(stimulus_access.make_inputs, [], [tf.float32])
-                inputs  = tf.stop_gradient(tf.reshape(inputs, shape=[par['batch_size'], par['n_input']]))
-                self.agent_locs.append(tf.py_func(stimulus_access.get_agent_locs, [], [tf.float32]))
+            if self.mode == 'learner':
+                inputs = self.traj_inputs[t]
+            elif self.in_graph_env:
+                inputs = self.environment_inputs(env)
+                self.agent_locs.append([tf.cast(env['loc'], tf.float32)])
+            else:
+                with tf.device('/cpu:0'), tf.control_dependencies(env_step):
+                    inputs, = tf.py_func(stimulus_access.make_inputs, [], [tf.float32])
+                    inputs  = tf.stop_gradient(tf.reshape(inputs, shape=[self.batch_size, par['n_input']]))
+                    self.agent_locs.append(tf.py_func(stimulus_access.get_agent_locs, [], [tf.float32]))
             self.input_data.append(inputs)
 
             # Iterate over sequene of predictive cells
-            for i in range(par['num_pred_cells']):
-                # Compute the state of the hidden layer
-                # x is cell input, y is top-down activity input
-                y = None if i == par['num_pred_cells']-1 else h[i+1]
-                x = inputs if i == 0 else error_signal
-
-                x = tf.concat([x, reward*i, action*i], axis=-1)
-                h[i], c[i], error_signal = self.predictive_cell(x, y, h[i], c[i], i)
-
-                # Determine error signal for each
-                es = tf.stack([error_signal[:,:par['n_input']+1+par['n_pol']], \
-                               error_signal[:,par['n_input']+1+par['n_pol']:]], axis=-1)
-                for ind in range(2):
-                    self.stim_pred_error[i].append(tf.reduce_mean(es[:,:par['n_input'],ind]))
-                    self.rew_pred_error[i].append(tf.reduce_mean(es[:,par['n_input']:par['n_input']+1,ind]))
-                    self.act_pred_error[i].append(tf.reduce_mean(es[:,par['n_input']+1:par['n_input']+10,ind]))
-                    self.total_pred_error[i].append(self.stim_pred_error[i][-1] + self.rew_pred_error[i][-1] + self.act_pred_error[i][-1])
-
-                error_signal = tf.concat([es[:,:par['n_input'],0], es[:,:par['n_input'],1]], axis=1)
-                error_signal = tf.maximum(error_signal[:,0::2], error_signal[:,1::2])
+            if self.wavefront:
+                h, c = replay_h[t], replay_c[t]
+            else:
+                h, c = self.predictive_hierarchy(inputs, h, c, reward, action)
 
             self.actual_reward_vector.append(reward)
 
             # Compute outputs for action
-            pol_out        = h[-1] @ self.var_dict['W_pol_out'] + self.var_dict['b_pol_out']
-            action_index   = tf.multinomial(pol_out, 1)
-            action         = tf.one_hot(tf.squeeze(action_index), par['n_pol'])
+            pol_out        = self.output_layer(h[-1], 'pol')
+            if self.mode == 'learner':
+                action     = self.traj_action[t]
+            else:
+                seed           = tf.stack([self.sampling_seed, rollout*self.num_steps + t])
+                action_index   = tf.where(self.greedy, tf.argmax(pol_out, 1), \
+                    tf.squeeze(tf.random.stateless_multinomial(pol_out, 1, seed, output_dtype=tf.int64), 1))
+                action         = tf.one_hot(action_index, par['n_pol'])
 
             # Compute outputs for loss
             pol_out        = tf.nn.softmax(pol_out, 1)  # Note softmax for entropy loss
-            val_out        = h[-1] @ self.var_dict['W_val_out'] + self.var_dict['b_val_out']
+            val_out        = self.output_layer(h[-1], 'val')
 
             # Check for trial continuation (ends if previous reward was non-zero)
             continue_trial = tf.cast(tf.equal(reward, 0.), tf.float32)
             mask          *= continue_trial
 
-            if t < par['num_time_steps']-2:
-                with tf.device('/cpu:0'):
-                    feedback_reward, = tf.py_func(stimulus_access.agent_action, [action, mask], [tf.float32])
-                    feedback_reward  = tf.stop_gradient(tf.reshape(feedback_reward, shape=[par['batch_size'],1]))
+            if self.mode == 'learner':
+                # Recorded rewards already include the failure penalty
+                feedback_reward = self.traj_reward[t]
+            elif par['tbptt_window']:
+                # Position in the episode is only known at run time
+                feedback_reward = tf.cond(self.state_in['step'] + t < par['num_time_steps']-2, \
+                    lambda: self.environment_step(action, mask), \
+                    lambda: self.per_trial('failure_penalty')*tf.ones([self.batch_size, 1]))
+                env_step = [feedback_reward]
+            elif t < par['num_time_steps']-2:
+                feedback_reward = self.environment_step(action, mask, env)
+                env_step = [feedback_reward]
             else:
-                feedback_reward = tf.constant(par['failure_penalty'])
+                feedback_reward = self.per_trial('failure_penalty')
 
-            reward = feedback_reward*mask*tf.reshape(self.time_mask[t],[par['batch_size'], 1])
+            reward = feedback_reward*mask*tf.reshape(self.time_mask[t],[self.batch_size, 1])
 
             # Record RL outputs
             self.pol_out.append(pol_out)
@@ -164,27 +406,360 @@ class Model:
         self.expected_reward_vector = tf.stack(self.expected_reward_vector, axis=0)
         self.actual_reward_vector = tf.stack(self.actual_reward_vector, axis=0)
 
+        # Summarize hidden activity in the graph, so that only the mean and
+        # the subset kept by the activity recorder are fetched to the host
+        h_cells = [tf.stack([h[i] for h in self.h]) for i in range(par['num_pred_cells'])]
+        self.mean_h = tf.reduce_mean(tf.concat([tf.reshape(h, [-1]) for h in h_cells], axis=0))
+        self.record_steps, self.record_trials, self.record_units = activity.sample_indices(self.num_steps)
+        self.h_sample = tf.concat([tf.gather(tf.gather(tf.gather(h, self.record_steps), self.record_trials, axis=1), \
+            units, axis=2) for h, units in zip(h_cells, self.record_units)], axis=2)
+
+        # Average the errors over each input component in one contraction,
+        # giving prediction errors of shape [time, cell, sign, component].
+        # With several models, these are averaged over the models of
+        # model_pred_error, [time, cell, model, sign, component].
+        if self.num_models > 1:
+            self.model_pred_error = tf.tensordot(tf.transpose(tf.stack(self.pred_error_steps), [0,1,2,4,3]), \
+                pred_error_components(), axes=1)
+            self.pred_error = tf.reduce_mean(self.model_pred_error, axis=2)
+        else:
+            self.pred_error = tf.tensordot(tf.transpose(tf.stack(self.pred_error_steps), [0,1,3,2]), \
+                pred_error_components(), axes=1)
+
+        # Value of the state at the end of the episode
+        self.final_val = tf.zeros([1, self.batch_size, par['n_val']])
+
+        if par['tbptt_window']:
+            # Carry the state into the next window, without gradients
+            self.state_out = {'h': h, 'c': c, 'mask': mask, 'action': action, 'reward': reward, \
+                'step': self.state_in['step'] + self.num_steps}
+
+            # Bootstrap from the value the next window will start with, by looking
+            # ahead one step (the environment is not advanced, so this is repeated
+            # exactly at the start of the next window), after the last step of this one
+            with tf.device('/cpu:0'), tf.control_dependencies(env_step):
+                inputs, = tf.py_func(stimulus_access.make_inputs, [], [tf.float32])
+                inputs  = tf.stop_gradient(tf.reshape(inputs, shape=[self.batch_size, par['n_input']]))
+            h_next, _ = self.predictive_hierarchy(inputs, h, c, reward, action, record=False)
+            val_next = self.output_layer(h_next[-1], 'val')
+            episode_continues = tf.cast(self.state_in['step'] + self.num_steps < par['num_time_steps'], tf.float32)
+            self.final_val = tf.stop_gradient(episode_continues*val_next[tf.newaxis,:,:])
+
+
+    def environment_step(self, action, mask, env=None):
+        """ Apply the chosen actions in the environment, returning the reward """
+
+        if self.in_graph_env:
+            return self.graph_environment_step(env, action, mask)
+
+        with tf.device('/cpu:0'), tf.control_dependencies(self.agent_locs[-1]):
+            feedback_reward, = tf.py_func(stimulus_access.agent_action, [action, mask], [tf.float32])
+            feedback_reward  = tf.stop_gradient(tf.reshape(feedback_reward, shape=[self.batch_size,1]))
+
+        return feedback_reward
+
+
+    def episode_start(self):
+        """ Starting locations, reward maps and room sizes of the current
+            episodes, and the reward vectors, for stepping the environment in
+            the graph.  None are constants, so that tasks can change them. """
+
+        with tf.device('/cpu:0'), self.jit_scope(compile_ops=False):
+            loc, reward_map, room_size, reward_vectors = tf.py_func(stimulus_access.get_episode, [], [tf.int32]*3 + [tf.float32])
+
+        loc.set_shape([self.static_batch_size, 2])
+        reward_map.set_shape((self.static_batch_size,) + stimulus_access.reward_map.shape[1:])
+        room_size.set_shape([self.static_batch_size, 2])
+        reward_vectors.set_shape([len(par['rewards']), par['num_rew_tuned']])
+
+        return {'loc': loc, 'reward_map': reward_map, 'room_size': room_size, 'reward_vectors': reward_vectors}
+
+
+    def environment_inputs(self, env):
+        """ In-graph version of RoomStimulus.make_inputs """
+
+        y, x = tf.unstack(env['loc'], axis=1)
+        height, width = tf.unstack(env['room_size'], axis=1)
+        nav = tf.cast(tf.stack([y, x, height - y, width - x], axis=1), tf.float32)
+
+        # Reward vector of the reward under each agent, with a row of zeros for none
+        reward_vectors = tf.concat([env['reward_vectors'], tf.zeros([1, par['num_rew_tuned']])], axis=0)
+        r = self.environment_reward_index(env)
+        rew = tf.gather(reward_vectors, tf.where(r >= 0, r, len(par['rewards'])*tf.ones_like(r)))
+
+        inputs = tf.concat([nav, tf.zeros([self.batch_size, par['num_nav_tuned']-4]), rew, \
+            tf.zeros([self.batch_size, par['n_input']-par['num_nav_tuned']-par['num_rew_tuned']])], axis=1)
+
+        return tf.stop_gradient(inputs)
+
+
+    def environment_reward_index(self, env):
+        """ Index of the reward under each agent, or -1 """
+
+        return tf.gather_nd(env['reward_map'], tf.concat([tf.range(self.batch_size)[:,tf.newaxis], env['loc']], axis=1))
+
+
+    def graph_environment_step(self, env, action, mask):
+        """ In-graph version of RoomStimulus.agent_action, moving the agents
+            in env and returning the reward """
+
+        action = tf.argmax(action, axis=-1, output_type=tf.int32)
+        active = tf.not_equal(tf.reshape(mask, [-1]), 0.)
+        y, x = tf.unstack(env['loc'], axis=1)
+        height, width = tf.unstack(env['room_size'], axis=1)
+        move = lambda a, allowed: tf.cast(active & tf.equal(action, a) & allowed, tf.int32)
+
+        # Up, down, right and left (visually right, left, down and up), within the room
+        x += move(0, x < width-1) - move(1, x > 0)
+        y += move(2, y < height-1) - move(3, y > 0)
+        env['loc'] = tf.stack([y, x], axis=1)
+
+        # Pick reward
+        r = self.environment_reward_index(env)
+        pick = active & tf.equal(action, 4) & (r >= 0)
+        reward = tf.where(pick, tf.gather(np.float32(par['rewards']), tf.maximum(r, 0)), tf.zeros([self.batch_size]))
+
+        return tf.stop_gradient(tf.reshape(reward, [self.batch_size, 1]))
+
+
+    def predictive_hierarchy(self, inputs, h, c, reward, action, record=True):
+        """ Run one time step through the sequence of predictive cells,
+            recording the prediction errors if requested """
+
+        # The cells compute in their own precision, and hand back float32 states.
+        # Each model's slice of the batch goes through its own weights.
+        inputs, reward, action = [self.split_models(self.cast(x)) for x in [inputs, reward, action]]
+        h, c = [self.split_models(self.cast(x)) for x in h], [self.split_models(self.cast(x)) for x in c]
+
+        if record and par['recompute_gradients']:
+            h, c, errors, expected_reward = self.checkpointed_hierarchy_step(inputs, h, c, reward, action)
+        else:
+            h, c, errors, expected_reward = self.hierarchy_step(inputs, h, c, reward, action)
+
+        if record:
+            self.pred_error_steps.append(errors)
+            self.expected_reward_vector.append(self.merge_models(tf.cast(expected_reward, tf.float32)))
+
+        return [self.merge_models(tf.cast(x, tf.float32)) for x in h], [self.merge_models(tf.cast(x, tf.float32)) for x in c]
+
+
+    def output_layer(self, h, name):
+        """ Policy or value output ('pol' or 'val') from the activity of the
+            last predictive cell """
+
+        y = self.split_models(h) @ self.var_dict['W_' + name + '_out'] + self.var_dict['b_' + name + '_out']
+        return self.merge_models(y)
+
+
+    def cast(self, x):
+        """ x in the precision of the predictive cells """
+
+        return tf.cast(x, tf.bfloat16) if self.precision == 'bfloat16' else x
+
+
+    def weight(self, name, cell_num):
+        """ The named weight of a predictive cell, in the cells' precision """
+
+        return self.cast(self.var_dict[name][cell_num])
+
+
+    def hierarchy_step(self, inputs, h, c, reward, action):
+        """ One time step through the sequence of predictive cells, returning
+            the new states, the batch-averaged errors of all cells, [cell, unit, sign]
+            (or [cell, model, unit, sign] with several models), and the expected reward """
+
+        h = list(h)
+        c = list(c)
+        cell_errors = []
+        for i in range(par['num_pred_cells']):
+            # Compute the state of the hidden layer
+            # x is cell input, y is top-down activity input
+            y = None if i == par['num_pred_cells']-1 else h[i+1]
+            x = inputs if i == 0 else error_signal
+
+            x = tf.concat([x, reward*i, action*i], axis=-1)
+            if i == reward_cell():
+                expected_reward = (self.matmul(h[i], 'W_pred', i) + self.weight('b_pred', i))[...,par['n_input']:par['n_input']+1]
+            h[i], c[i], error_signal = self.predictive_cell(x, y, h[i], c[i], i)
+
+            # Determine error signal for each
+            es = tf.stack([error_signal[...,:par['n_input']+1+par['n_pol']], \
+                           error_signal[...,par['n_input']+1+par['n_pol']:]], axis=-1)
+            cell_errors.append(es)
+
+            error_signal = tf.concat([es[...,:par['n_input'],0], es[...,:par['n_input'],1]], axis=-1)
+            error_signal = tf.maximum(error_signal[...,0::2], error_signal[...,1::2])
+
+        # Errors are averaged over the batch (of each model) in float32
+        batch_axis = 1 if self.num_models == 1 else 2
+        return h, c, tf.reduce_mean(tf.cast(tf.stack(cell_errors), tf.float32), axis=batch_axis), expected_reward
+
+
+    def checkpointed_hierarchy_step(self, inputs, h, c, reward, action):
+        """ hierarchy_step, keeping only the states, inputs and weights for the
+            backward pass, and recomputing the cells' intermediate values
+            (gates, errors, concatenations) once the backward pass reaches it """
+
+        n = par['num_pred_cells']
+        names = [(name, i) for name in LSTM_VAR_PREFIXES for i in range(n)]
+        expected_reward = []
+
+        def step(args):
+            # Run the cells on the given tensors in place of the weights
+            var_dict = self.var_dict
+            self.var_dict = dict(var_dict)
+            for name in LSTM_VAR_PREFIXES:
+                self.var_dict[name] = [args[2*n + names.index((name, i))] for i in range(n)]
+            h, c, errors, er = self.hierarchy_step(inputs, args[:n], args[n:2*n], reward, action)
+            self.var_dict = var_dict
+            expected_reward.append(er)
+
+            return h + c + [errors]
+
+        @tf.custom_gradient
+        def checkpointed(*args):
+
+            def grad(*grad_ys):
+                # Wait for the backward pass before recomputing
+                with tf.control_dependencies(grad_ys):
+                    recompute_args = [tf.identity(a) for a in args]
+                grads = tf.gradients(step(recompute_args), recompute_args, grad_ys=grad_ys)
+                return [tf.zeros_like(a) if g is None else g for g, a in zip(grads, recompute_args)]
+
+            return step(args), grad
+
+        out = checkpointed(*(list(h) + list(c) + [self.var_dict[name][i] for name, i in names]))
+
+        return out[:n], out[n:2*n], out[-1], expected_reward[0]
+
+
+    def wavefront_hierarchy(self, inputs, rewards, actions, h, c):
+        """ Run the sequence of predictive cells over all time steps, given the
+            inputs, rewards and actions fed to each step.  Cell i at step t only
+            needs cell i-1 at step t and cell i+1 at step t-1, so all cells on an
+            anti-diagonal 2t+i are evaluated together as one batched LSTM step.
+            Requires all cells to be of equal size.  Returns the hidden and
+            cell states of every step. """
+
+        n_cells = par['num_pred_cells']
+        n_steps = len(inputs)
+        n_in = par['n_cell_input'][0]
+        n_hid = par['n_hidden'][0]
+
+        # Stack the weights of all cells, with the gates fused, and zero rows
+        # standing in for the top cell's missing top-down input
+        W, U, b = [], [], []
+        for i in range(n_cells):
+            W_gates = tf.concat([self.var_dict[k][i] for k in ['Wf', 'Wi', 'Wo', 'Wc']], axis=1)
+            if i == n_cells-1:
+                W_gates = tf.concat([W_gates, tf.zeros([n_hid, 4*n_hid])], axis=0)
+            W.append(W_gates)
+            U.append(tf.concat([self.var_dict[k][i] for k in ['Uf', 'Ui', 'Uo', 'Uc']], axis=1))
+            b.append(tf.concat([self.var_dict[k][i] for k in ['bf', 'bi', 'bo', 'bc']], axis=1))
+        W, U, b = self.cast(tf.stack(W)), self.cast(tf.stack(U)), self.cast(tf.stack(b))
+        W_pred, b_pred = self.cast(tf.stack(self.var_dict['W_pred'])), self.cast(tf.stack(self.var_dict['b_pred']))
+
+        inputs = [self.cast(x) for x in inputs]
+        rewards = [self.cast(x) for x in rewards]
+        actions = [self.cast(x) for x in actions]
+        h = [self.cast(x) for x in h]
+        c = [self.cast(x) for x in c]
+        x_up = [None]*n_cells
+        h_steps = [[None]*n_cells for _ in range(n_steps)]
+        c_steps = [[None]*n_cells for _ in range(n_steps)]
+        cell_errors = [[None]*n_cells for _ in range(n_steps)]
+        expected_reward = [None]*n_steps
+
+        for level in range(2*(n_steps-1) + n_cells):
+
+            # Cells on this anti-diagonal, at every other index
+            cells = [i for i in range(level%2, n_cells, 2) if 0 <= (level-i)//2 < n_steps]
+            if len(cells) == 0:
+                continue
+            steps = [(level-i)//2 for i in cells]
+            active = slice(cells[0], cells[-1]+1, 2)
+
+            x = tf.stack([tf.concat([inputs[t] if i == 0 else x_up[i], rewards[t]*i, actions[t]*i], axis=-1) \
+                for i, t in zip(cells, steps)])
+            y = tf.stack([tf.zeros_like(h[i]) if i == n_cells-1 else h[i+1] for i in cells])
+            h_prev = tf.stack([h[i] for i in cells])
+            c_prev = tf.stack([c[i] for i in cells])
+
+            # Same computation as predictive_cell
+            pred = h_prev @ W_pred[active] + b_pred[active]
+            error_signal = tf.concat([tf.nn.relu(x - pred), tf.nn.relu(pred - x)], axis=-1)
+            rnn_input = tf.concat([error_signal, y], axis=-1)
+
+            f, i_gate, o, cn = tf.split(rnn_input @ W[active] + h_prev @ U[active] + b[active], 4, axis=-1)
+            c_new = tf.sigmoid(f)*c_prev + tf.sigmoid(i_gate)*tf.tanh(cn)
+            h_new = tf.sigmoid(o)*tf.tanh(c_new)
+
+            for j, (i, t) in enumerate(zip(cells, steps)):
+                h[i], c[i] = h_new[j], c_new[j]
+                h_steps[t][i], c_steps[t][i] = tf.cast(h[i], tf.float32), tf.cast(c[i], tf.float32)
+                if i == reward_cell():
+                    expected_reward[t] = tf.cast(pred[j][:,par['n_input']:par['n_input']+1], tf.float32)
+
+                # Same error processing as predictive_hierarchy
+                es = tf.stack([error_signal[j][...,:n_in], error_signal[j][...,n_in:]], axis=-1)
+                cell_errors[t][i] = es
+                x_up_i = tf.concat([es[...,:par['n_input'],0], es[...,:par['n_input'],1]], axis=-1)
+                if i < n_cells-1:
+                    x_up[i+1] = tf.maximum(x_up_i[...,0::2], x_up_i[...,1::2])
+
+        # Records, in time order
+        for t in range(n_steps):
+            self.pred_error_steps.append(tf.reduce_mean(tf.cast(tf.stack(cell_errors[t]), tf.float32), axis=1))
+            self.expected_reward_vector.append(expected_reward[t])
+
+        return h_steps, c_steps
+
+
+    def matmul(self, x, name, cell_num):
+        """ x @ the named weight of a predictive cell, as a sparse-dense
+            matmul if the weight is stored sparsely """
+
+        if not (par['sparse_weights'] and name in SPARSE_VAR_PREFIXES):
+            return x @ self.weight(name, cell_num)
+
+        # Sparse-dense matmuls are only available in float32
+        w = self.var_dict[name][cell_num]
+        index = par[name + '_index'][cell_num]
+        n_out, n_in = par[name + '_shape'][cell_num]
+        dtype, x = x.dtype, tf.cast(x, tf.float32)
+
+        if len(w.shape) == 1:
+            y = tf.sparse.sparse_dense_matmul(tf.SparseTensor(index, w, [n_out, n_in]), \
+                tf.reshape(x, [-1, n_in]), adjoint_b=True)
+            shape = x.shape[:-1].as_list() if x.shape.is_fully_defined() else tf.unstack(tf.shape(x)[:-1])
+            return tf.cast(tf.reshape(tf.transpose(y), shape + [n_out]), dtype)
+
+        # One copy of the weights per trial (see fisher.py), applied as a block-diagonal matrix
+        m = int(w.shape[0])
+        index = np.concatenate([index + k*np.array([n_out, n_in]) for k in range(m)])
+        y = tf.sparse.sparse_dense_matmul(tf.SparseTensor(index, tf.reshape(w, [-1]), [m*n_out, m*n_in]), \
+            tf.reshape(tf.transpose(x, [0,2,1]), [m*n_in, -1]))
+        return tf.cast(tf.transpose(tf.reshape(y, [m, n_out, -1]), [0,2,1]), dtype)
+
 
     def predictive_cell(self, x, y, h, c, cell_num):
         """ Using the appropriate recurrent cell
             architecture, compute the hidden state """
 
-        if cell_num == 1:
-            self.expected_reward_vector.append((h @ self.var_dict['W_pred'][cell_num] + self.var_dict['b_pred'][cell_num])[:,par['n_input']:par['n_input']+1])
-
-        pos_err = tf.nn.relu(x - h @ self.var_dict['W_pred'][cell_num] - self.var_dict['b_pred'][cell_num])
-        neg_err = tf.nn.relu(h @ self.var_dict['W_pred'][cell_num] + self.var_dict['b_pred'][cell_num] - x)
+        pred = self.matmul(h, 'W_pred', cell_num) + self.weight('b_pred', cell_num)
+        pos_err = tf.nn.relu(x - pred)
+        neg_err = tf.nn.relu(pred - x)
         error_signal = tf.concat([pos_err, neg_err], axis = -1)
         rnn_input = error_signal if y is None else tf.concat([error_signal, y], axis = -1)
 
         # Compute LSTM state
         # f : forgetting gate, i : input gate,
         # c : cell state, o : output gate
-        f   = tf.sigmoid(rnn_input @ self.var_dict['Wf'][cell_num] + h @ self.var_dict['Uf'][cell_num] + self.var_dict['bf'][cell_num])
-        i   = tf.sigmoid(rnn_input @ self.var_dict['Wi'][cell_num] + h @ self.var_dict['Ui'][cell_num] + self.var_dict['bi'][cell_num])
-        cn  = tf.tanh(rnn_input @ self.var_dict['Wc'][cell_num] + h @ self.var_dict['Uc'][cell_num] + self.var_dict['bc'][cell_num])
+        f   = tf.sigmoid(self.matmul(rnn_input, 'Wf', cell_num) + self.matmul(h, 'Uf', cell_num) + self.weight('bf', cell_num))
+        i   = tf.sigmoid(self.matmul(rnn_input, 'Wi', cell_num) + self.matmul(h, 'Ui', cell_num) + self.weight('bi', cell_num))
+        cn  = tf.tanh(self.matmul(rnn_input, 'Wc', cell_num) + self.matmul(h, 'Uc', cell_num) + self.weight('bc', cell_num))
         c   = f * c + i * cn
-        o   = tf.sigmoid(rnn_input @ self.var_dict['Wo'][cell_num] + h @ self.var_dict['Uo'][cell_num] + self.var_dict['bo'][cell_num])
+        o   = tf.sigmoid(self.matmul(rnn_input, 'Wo', cell_num) + self.matmul(h, 'Uo', cell_num) + self.weight('bo', cell_num))
 
         # Compute hidden state
         h = o * tf.tanh(c)
@@ -198,11 +773,13 @@ class Model:
 
         # Set up optimizer and required constants
         epsilon = 1e-7
-        adam_optimizer = AdamOpt.AdamOpt(tf.trainable_variables(), learning_rate=par['learning_rate'])
+        adam_optimizer = AdamOpt.AdamOpt(tf.trainable_variables(), learning_rate=self.hyperparameters['learning_rate'], \
+            model_axis=self.num_models > 1)
 
         # Make stabilization records
         self.prev_weights = {}
         self.big_omega_var = {}
+        self.small_omega_vars = []
         reset_prev_vars_ops = []
         aux_losses = []
 
@@ -216,8 +793,8 @@ class Model:
 
             # Don't stabilize value weights/biases
             if not 'val' in n:
-                aux_losses.append(par['omega_c'] * \
-                    tf.reduce_sum(self.big_omega_var[n] * tf.square(self.prev_weights[n] - var)))
+                aux_losses.append(tf.reduce_sum(self.per_model(self.hyperparameters['omega_c'], len(var.get_shape())) * \
+                    self.big_omega_var[n] * tf.square(self.prev_weights[n] - var)))
 
             # Make a reset function for each prev_weight element
             reset_prev_vars_ops.append(tf.assign(self.prev_weights[n], var))
@@ -225,62 +802,81 @@ class Model:
         # Auxiliary stabilization loss
         self.aux_loss = tf.add_n(aux_losses)
 
-        # Spiking activity loss (penalty on high activation values in the hidden layer)
-        self.spike_loss = par['spike_cost']*tf.reduce_mean(tf.stack([mask*time_mask*tf.reduce_mean(h) \
-            for (h, mask, time_mask) in zip(self.h, self.mask, self.time_mask)]))
-
-        # Training-specific losses
-        if par['training_method'] == 'SL':
-            RL_loss = tf.constant(0.)
-
-            # Task loss (cross entropy)
-            self.pol_loss = tf.reduce_mean([mask*tf.nn.softmax_cross_entropy_with_logits(logits=y, \
-                labels=target, dim=1) for y, target, mask in zip(self.output, self.target_data, self.time_mask)])
-            sup_loss = self.pol_loss
-
-        elif par['training_method'] == 'RL':
-            sup_loss = tf.constant(0.)
-
-            # Collect information from across time
-            self.time_mask  = tf.reshape(tf.stack(self.time_mask),(par['num_time_steps'], par['batch_size'], 1))
-            self.mask       = tf.stack(self.mask)
-            self.reward     = tf.stack(self.reward)
-            self.action     = tf.stack(self.action)
-            self.pol_out    = tf.stack(self.pol_out)
-
-            # Get the value outputs of the network, and pad the last time step
-            val_out = tf.concat([tf.stack(self.val_out), tf.zeros([1,par['batch_size'],par['n_val']])], axis=0)
-
-            # Determine terminal state of the network
-            terminal_state = tf.cast(tf.logical_not(tf.equal(self.reward, tf.constant(0.))), tf.float32)
-
-            # Compute predicted value and the advantage for plugging into the policy loss
-            pred_val = self.reward + par['discount_rate']*val_out[1:,:,:]*(1-terminal_state)
-            advantage = pred_val - val_out[:-1,:,:]
-
-            # Stop gradients back through action, advantage, and mask
-            action_static    = tf.stop_gradient(self.action)
-            advantage_static = tf.stop_gradient(advantage)
-            mask_static      = tf.stop_gradient(self.mask)
-
-            # Policy loss
-            self.pol_loss = -tf.reduce_mean(advantage_static*mask_static*self.time_mask*action_static*tf.log(epsilon+self.pol_out))
-
-            # Value loss
-            self.val_loss = 0.5*par['val_cost']*tf.reduce_mean(mask_static*self.time_mask*tf.square(val_out[:-1,:,:]-tf.stop_gradient(pred_val)))
-
-            # Entropy loss
-            self.entropy_loss = -par['entropy_cost']*tf.reduce_mean(tf.reduce_sum(mask_static*self.time_mask*self.pol_out*tf.log(epsilon+self.pol_out), axis=1))
-
-            # Prediction loss
-            self.pred_loss = par['error_cost'] * tf.reduce_mean(tf.stack(self.total_pred_error))
-
-            # Collect RL losses
-            RL_loss = self.pol_loss + self.val_loss - self.entropy_loss + self.pred_loss
-
-        # Collect loss terms and compute gradients
-        total_loss = sup_loss + RL_loss + self.aux_loss + self.spike_loss
-        self.train_op = adam_optimizer.compute_gradients(total_loss)
+        # The losses are compiled with the rollout, and their gradients with them
+        with self.jit_scope():
+
+            # Spiking activity loss (penalty on high activation values in the hidden layer)
+            self.spike_loss = par['spike_cost']*tf.reduce_mean(tf.stack([mask*time_mask*tf.reduce_mean(tf.concat(h, axis=-1)) \
+                for (h, mask, time_mask) in zip(self.h, self.mask, self.time_mask)]))
+
+            # Training-specific losses
+            if par['training_method'] == 'SL':
+                RL_loss = tf.constant(0.)
+
+                # Task loss (cross entropy)
+                self.pol_loss = tf.reduce_mean([mask*tf.nn.softmax_cross_entropy_with_logits(logits=y, \
+                    labels=target, dim=1) for y, target, mask in zip(self.output, self.target_data, self.time_mask)])
+                sup_loss = self.pol_loss
+
+            elif par['training_method'] == 'RL':
+                sup_loss = tf.constant(0.)
+
+                # Collect information from across time
+                self.time_mask  = tf.reshape(tf.stack(self.time_mask),(self.num_steps, -1, 1))
+                self.mask       = tf.stack(self.mask)
+                self.reward     = tf.stack(self.reward)
+                self.action     = tf.stack(self.action)
+                self.pol_out    = tf.stack(self.pol_out)
+
+                # Get the value outputs of the network, and pad the last time step
+                val_out = tf.concat([tf.stack(self.val_out), self.final_val], axis=0)
+
+                # Determine terminal state of the network
+                terminal_state = tf.cast(tf.logical_not(tf.equal(self.reward, tf.constant(0.))), tf.float32)
+
+                # Compute predicted value and the advantage for plugging into the policy loss
+                if self.mode == 'learner':
+                    pred_val, advantage = self.vtrace(val_out, terminal_state)
+                else:
+                    pred_val = self.reward + self.per_trial('discount_rate')*val_out[1:,:,:]*(1-terminal_state)
+                    advantage = pred_val - val_out[:-1,:,:]
+
+                # Stop gradients back through action, advantage, and mask
+                action_static    = tf.stop_gradient(self.action)
+                advantage_static = tf.stop_gradient(advantage)
+                mask_static      = tf.stop_gradient(self.mask)
+
+                # Policy loss
+                self.pol_loss = -tf.reduce_mean(advantage_static*mask_static*self.time_mask*action_static*tf.log(epsilon+self.pol_out))
+
+                # Value loss
+                self.val_loss = 0.5*tf.reduce_mean(self.per_trial('val_cost')*mask_static*self.time_mask*tf.square(val_out[:-1,:,:]-tf.stop_gradient(pred_val)))
+
+                # Entropy loss
+                self.entropy_loss = -tf.reduce_mean(tf.reduce_sum(self.per_trial('entropy_cost')*mask_static*self.time_mask*self.pol_out*tf.log(epsilon+self.pol_out), axis=1))
+
+                # Prediction loss
+                if self.num_models > 1:
+                    model_error = tf.reduce_mean(tf.reduce_sum(self.model_pred_error, axis=-1), axis=[0,1,3])
+                    self.pred_loss = tf.reduce_mean(self.hyperparameters['error_cost']*model_error)
+                else:
+                    self.pred_loss = self.hyperparameters['error_cost'] * tf.reduce_mean(tf.reduce_sum(self.pred_error, axis=-1))
+
+                # Collect RL losses
+                RL_loss = self.pol_loss + self.val_loss - self.entropy_loss + self.pred_loss
+
+            # Collect loss terms.  The batch-averaged losses are also averaged
+            # over models, and are scaled back up so that each model gets the
+            # gradients it would get if trained alone.
+            total_loss = self.num_models*(sup_loss + RL_loss + self.spike_loss) + self.aux_loss
+
+        # Compute gradients
+        if self.mode == 'worker':
+            self.local_gradients = adam_optimizer.get_gradients(total_loss)
+            self.gradient_ph = [tf.placeholder(tf.float32, shape=var.get_shape()) for var in adam_optimizer.variables]
+            self.train_op = adam_optimizer.update_variables(self.gradient_ph)
+        else:
+            self.train_op = adam_optimizer.compute_gradients(total_loss)
 
         # Stabilize weights
         if par['stabilization'] == 'pathint':
@@ -296,23 +892,62 @@ class Model:
         # Make reset operations
         self.reset_prev_vars = tf.group(*reset_prev_vars_ops)
         self.reset_adam_op = adam_optimizer.reset_params()
+
+        # Consolidate a finished task in one run:  add the importance of each
+        # weight to the big omegas, then make the current weights the reference
+        # of the stabilization loss and start Adam and the small omegas afresh
+        with tf.control_dependencies([self.update_big_omega] if par['stabilization'] in ['pathint', 'EWC'] else []):
+            self.consolidate = tf.group(*[tf.assign(self.prev_weights[var.op.name], var) for var in tf.trainable_variables()], \
+                adam_optimizer.reset_params(), *[tf.assign(v, tf.zeros_like(v)) for v in self.small_omega_vars])
         self.reset_weights()
 
         # Make saturation correction operation
         self.make_recurrent_weights_positive()
 
 
+    def vtrace(self, val_out, terminal_state):
+        """ Off-policy value targets and advantages via V-trace (Espeholt et al., 2018),
+            correcting for the lag between the actors' policy and the learner's """
+
+        epsilon = 1e-7
+
+        # Truncated importance weights of the recorded actions
+        target_prob = tf.reduce_sum(self.pol_out*self.action, axis=2, keepdims=True)
+        rho = tf.stop_gradient(target_prob/(epsilon + self.behaviour_prob))
+        rho_bar = tf.minimum(par['vtrace_rho_clip'], rho)
+        c = tf.minimum(par['vtrace_c_clip'], rho)
+
+        val_static = tf.stop_gradient(val_out)
+        discount = self.hyperparameters['discount_rate']*(1-terminal_state)
+        delta = rho_bar*(self.reward + discount*val_static[1:,:,:] - val_static[:-1,:,:])
+
+        # Accumulate the corrections backwards through time
+        correction = tf.zeros_like(delta[0])
+        corrections = []
+        for t in reversed(range(self.num_steps)):
+            correction = delta[t] + discount[t]*c[t]*correction
+            corrections.append(correction)
+        vs = val_static[:-1,:,:] + tf.stack(corrections[::-1], axis=0)
+
+        # Bootstrap the advantage from the next corrected value
+        vs_next = tf.concat([vs[1:,:,:], val_static[-1:,:,:]], axis=0)
+        advantage = rho_bar*(self.reward + discount*vs_next - val_static[:-1,:,:])
+
+        return vs, advantage
+
+
     def reset_weights(self):
         """ Make new weights, if requested """
 
         reset_weights = []
+        generator = rng('reset_weights')
         for var in tf.trainable_variables():
             if 'b' in var.op.name:
                 # reset biases to 0
                 reset_weights.append(tf.assign(var, var*0.))
             elif 'W' in var.op.name:
                 # reset weights to initial-like conditions
-                new_weight = initialize_weight(var.shape, par['connection_prob'])
+                new_weight = initialize_weight(var.shape.as_list(), par['connection_prob'], generator)
                 reset_weights.append(tf.assign(var,new_weight))
 
         self.reset_weights = tf.group(*reset_weights)
@@ -342,14 +977,15 @@ class Model:
         update_small_omega_ops = []
         update_big_omega_ops = []
 
-        # If using reinforcement learning, update rewards
+        # If using reinforcement learning, update rewards (one per model, if there are several)
         if par['training_method'] == 'RL':
-            self.previous_reward = tf.Variable(-tf.ones([]), trainable=False)
-            self.current_reward = tf.Variable(-tf.ones([]), trainable=False)
+            models = [] if self.num_models == 1 else [self.num_models]
+            self.previous_reward = tf.Variable(-tf.ones(models), trainable=False)
+            self.current_reward = tf.Variable(-tf.ones(models), trainable=False)
 
             reward_stacked = tf.stack(self.reward, axis = 0)
-            current_reward = tf.reduce_mean(tf.reduce_sum(reward_stacked, axis = 0))
-            self.update_current_reward = tf.assign(self.current_reward, current_reward)
+            self.batch_reward = tf.reduce_mean(tf.reshape(tf.reduce_sum(reward_stacked, axis = 0), models + [-1]), axis = -1)
+            self.update_current_reward = tf.assign(self.current_reward, self.batch_reward)
             self.update_previous_reward = tf.assign(self.previous_reward, self.current_reward)
 
         # Iterate over variables in the model
@@ -360,6 +996,7 @@ class Model:
             small_omega_var_div[var.op.name] = tf.Variable(tf.zeros(var.get_shape()), trainable=False)
             reset_small_omega_ops.append(tf.assign(small_omega_var[var.op.name], small_omega_var[var.op.name]*0.0 ) )
             reset_small_omega_ops.append(tf.assign(small_omega_var_div[var.op.name], small_omega_var_div[var.op.name]*0.0 ) )
+            self.small_omega_vars += [small_omega_var[var.op.name], small_omega_var_div[var.op.name]]
 
             # Update the big omega vars based on the training method
             if par['training_method'] == 'RL':
@@ -382,7 +1019,7 @@ class Model:
         # Update the samll omegas using the gradients
         for (grad, var) in self.gradients:
             if par['training_method'] == 'RL':
-                delta_reward = self.current_reward - self.previous_reward
+                delta_reward = self.per_model(self.current_reward - self.previous_reward, len(var.get_shape()))
                 update_small_omega_ops.append(tf.assign_add(small_omega_var[var.op.name], self.delta_grads[var.op.name]*delta_reward))
                 update_small_omega_ops.append(tf.assign_add(small_omega_var_div[var.op.name], tf.abs(self.delta_grads[var.op.name]*delta_reward)))
             elif par['training_method'] == 'SL':
@@ -394,28 +1031,18 @@ class Model:
 
 
     def EWC(self):
-        """ Synaptic stabilization via the Kirkpatrick method """
+        """ Synaptic stabilization via the Kirkpatrick method.  The Fisher
+            information is estimated per trial in its own graph (see fisher.py)
+            and fed in to be added to the big omegas """
 
         # Set up method
         var_list = [var for var in tf.trainable_variables() if not 'val' in var.op.name]
-        epsilon = 1e-6
         fisher_ops = []
-        opt = tf.train.GradientDescentOptimizer(learning_rate = 1.0)
 
-        # Sample from logits
-        if par['training_method'] == 'RL':
-            log_p_theta = tf.stack([mask*time_mask*action*tf.log(epsilon + pol_out) for (pol_out, action, mask, time_mask) in \
-                zip(self.pol_out, self.action, self.mask, self.time_mask)], axis = 0)
-        elif par['training_method'] == 'SL':
-            log_p_theta = tf.stack([mask*time_mask*tf.log(epsilon + output) for (output, mask, time_mask) in \
-                zip(self.output, self.mask, self.time_mask)], axis = 0)
-
-        # Compute gradients and add to aggregate
-        grads_and_vars = opt.compute_gradients(log_p_theta, var_list = var_list)
-        for grad, var in grads_and_vars:
-            print(var.op.name)
-            fisher_ops.append(tf.assign_add(self.big_omega_var[var.op.name], \
-                grad*grad/par['EWC_fisher_num_batches']))
+        self.fisher_ph = {}
+        for var in var_list:
+            self.fisher_ph[var.op.name] = tf.placeholder(tf.float32, shape=var.get_shape())
+            fisher_ops.append(tf.assign_add(self.big_omega_var[var.op.name], self.fisher_ph[var.op.name]))
 
         # Make update group
         self.update_big_omega = tf.group(*fisher_ops)
@@ -433,6 +1060,9 @@ def reinforcement_learning(save_fn='test.pkl', gpu_id=None):
 
     # Set up stimulus and accuracy recording
     accuracy_iter = []
+    reward_iter = []
+    model_accuracy_iter = []
+    model_reward_iter = []
     full_activity_list = []
     agent_records = []
     model_performance = {'reward': [], 'entropy_loss': [], 'val_loss': [], 'pol_loss': [], 'spike_loss': [], 'trial': [], 'task': []}
@@ -441,53 +1071,110 @@ def reinforcement_learning(save_fn='test.pkl', gpu_id=None):
     print_key_info()
 
     # Start Tensorflow session
-    with tf.Session() as sess:
+    with tf.Session(config=session_config()) as sess:
 
         # Select CPU or GPU
         device = '/cpu:0' if gpu_id is None else '/gpu:0'
-        with tf.device(device):
-            model = Model()
+        model = graph_cache.build(Model, stimulus_access, device=device)
 
         # Initialize variables and start the timer
         sess.run(tf.global_variables_initializer())
+        graph_cache.load_initial_weights(sess, model)
         t_start = time.time()
         sess.run(model.reset_prev_vars)
+        set_sampling_seed(sess, model)
+        hyperparameters = None
+
+        # Switch between environment variants, in the same graph
+        scheduler = tasks.TaskScheduler(stimulus_access, model.windows_per_episode) if par['tasks'] else None
+        num_iters = par['n_train_batches'] if scheduler is None else scheduler.num_iters
+
+        # Draw upcoming episodes in the background while the current one runs
+        prefetcher = stimulus.EpisodePrefetcher(stimulus_access) if par['prefetch_episodes'] else None
+
+        # Grow the batch once learning plateaus, or shrink it under memory pressure
+        batcher = schedules.BatchScheduler(stimulus_access, prefetcher) if model.dynamic_batch else None
+
+        # Evaluate snapshots of the weights on held-out episodes in the background
+        evaluator = evaluation.Evaluator(stimulus_access) if par['eval_interval'] else None
+
+        # Stream sampled hidden activity to disk
+        recorder = None
+        if par['record_activity']:
+            recorder = activity.ActivityRecorder(model, par['save_dir'] + par['save_fn'] + '_activity' + par['save_fn_suffix'])
 
         # Begin training loop, iterating over tasks
         task_start_time = time.time()
+        num_steps = 0
 
-        for i in range(par['n_train_batches']):
+        for i in range(num_iters):
 
-            stimulus_access.place_agents()
-            stimulus_access.place_rewards()
+            # Move on to the next task once the current episodes are over
+            if scheduler is not None and i >= scheduler.end_iter and i%model.windows_per_episode == 0:
+                if scheduler.last_task():
+                    break
+                scheduler.next_task(sess, model, prefetcher, i)
+
+            # Start new episodes, unless continuing the current ones in another window
+            if i%model.windows_per_episode == 0:
+                if batcher is not None:
+                    batcher.update(i)
+                if prefetcher is not None:
+                    prefetcher.swap()
+                else:
+                    stimulus_access.place_agents()
+                    stimulus_access.place_rewards()
+                carried_state = model.initial_state()
+            feed_dict = model.state_feed(carried_state)
+            hyperparameters = update_hyperparameters(sess, model, i, hyperparameters)
+
+            # Only fetch the sampled activity when it is due to be recorded
+            recording = recorder is not None and recorder.due(i)
+            record_fetch = model.h_sample if recording else []
 
             # Calculate and apply gradients
             if par['stabilization'] == 'pathint':
-                _, _, _, pol_loss, val_loss, aux_loss, spike_loss, ent_loss, pred_err, stim_pred_err, \
-                    rew_pred_err, act_pred_err, h_list, reward_list, pred_loss, expected_reward, actual_reward, agent_locations, action = \
+                _, _, _, pol_loss, val_loss, aux_loss, spike_loss, ent_loss, pred_err, \
+                    mean_h, reward_list, pred_loss, expected_reward, actual_reward, agent_locations, action, carried_state, h_sample = \
                     sess.run([model.train_op, model.update_current_reward, model.update_small_omega, model.pol_loss, model.val_loss, \
-                    model.aux_loss, model.spike_loss, model.entropy_loss, model.total_pred_error, model.stim_pred_error, model.rew_pred_error, model.act_pred_error, \
-                    model.h, model.reward, model.pred_loss, model.expected_reward_vector, model.actual_reward_vector, \
-                    model.agent_locs, model.action])
+                    model.aux_loss, model.spike_loss, model.entropy_loss, model.pred_error, \
+                    model.mean_h, model.reward, model.pred_loss, model.expected_reward_vector, model.actual_reward_vector, \
+                    model.agent_locs, model.action, model.state_out, record_fetch], feed_dict=feed_dict)
                 if i>0:
                     sess.run([model.update_small_omega])
                 sess.run([model.update_previous_reward])
             elif par['stabilization'] == 'EWC':
-                _, _, pol_loss,val_loss, aux_loss, spike_loss, ent_loss, pred_err, stim_pred_err, rew_pred_err, act_pred_err, \
-                    h_list, reward_list, agent_locations, action = \
-                    sess.run([model.train_op, model.update_current_reward, model.pol_loss, model.val_loss, \
-                    model.aux_loss, model.spike_loss, model.entropy_loss, model.total_pred_error, model.stim_pred_error, model.rew_pred_error, model.act_pred_error, \
-                    model.h, model.reward, model.agent_locs, model.action])
+                _, pol_loss,val_loss, aux_loss, spike_loss, ent_loss, pred_err, \
+                    mean_h, reward_list, pred_loss, expected_reward, actual_reward, agent_locations, action, carried_state, h_sample = \
+                    sess.run([model.train_op, model.pol_loss, model.val_loss, \
+                    model.aux_loss, model.spike_loss, model.entropy_loss, model.pred_error, \
+                    model.mean_h, model.reward, model.pred_loss, model.expected_reward_vector, model.actual_reward_vector, \
+                    model.agent_locs, model.action, model.state_out, record_fetch], feed_dict=feed_dict)
+
+            if recording:
+                recorder.record(i, h_sample)
+
+            if evaluator is not None and i%par['eval_interval'] == 0:
+                evaluator.submit(i, get_weights(sess))
 
             # Record accuracies
             reward = np.stack(reward_list)
             rew = np.mean(np.sum(reward, axis=0))
             acc = np.mean(np.sum(reward>0, axis=0))
             accuracy_iter.append(acc)
-            if i > 5000:
-                if np.mean(accuracy_iter[-5000:]) > 0.98 or (i>25000 and np.mean(accuracy_iter[-20:]) > 0.95):
+            reward_iter.append(rew)
+            num_steps += par['batch_size']*model.num_steps
+            if batcher is not None:
+                batcher.record(rew)
+            model_accuracy_iter.append(np.mean(np.reshape(np.sum(reward>0, axis=0), [par['num_models'], -1]), axis=1))
+            model_reward_iter.append(np.mean(np.reshape(np.sum(reward, axis=0), [par['num_models'], -1]), axis=1))
+            task_iter = i if scheduler is None else i - scheduler.start_iter
+            if task_iter > 5000:
+                if np.mean(accuracy_iter[-5000:]) > 0.98 or (task_iter>25000 and np.mean(accuracy_iter[-20:]) > 0.95):
                     print('Accuracy reached threshold')
-                    break
+                    if scheduler is None:
+                        break
+                    scheduler.end_iter = min(scheduler.end_iter, i+1)
 
             # Display network performance
             if i%200 == 0:
@@ -512,53 +1199,242 @@ def reinforcement_learning(save_fn='test.pkl', gpu_id=None):
                     plt.clf()
                     plt.close()
 
-                pe  = str([float('{:7.5f}'.format(np.mean(pred_err[i]))) for i in range(len(pred_err))]).ljust(19)
-                spe = str([float('{:7.5f}'.format(np.mean(stim_pred_err[i]))) for i in range(len(stim_pred_err))]).ljust(19)
-                rpe = str([float('{:7.5f}'.format(np.mean(rew_pred_err[i]))) for i in range(len(rew_pred_err))]).ljust(19)
-                ape = str([float('{:7.5f}'.format(np.mean(act_pred_err[i]))) for i in range(len(act_pred_err))]).ljust(19)
+                # Per-cell prediction errors, averaged over time and sign
+                cell_err = np.mean(pred_err, axis=(0,2))
+                pe  = str([float('{:7.5f}'.format(e)) for e in np.sum(cell_err, axis=-1)]).ljust(19)
+                spe = str([float('{:7.5f}'.format(e)) for e in cell_err[:,0]]).ljust(19)
+                rpe = str([float('{:7.5f}'.format(e)) for e in cell_err[:,1]]).ljust(19)
+                ape = str([float('{:7.5f}'.format(e)) for e in cell_err[:,2]]).ljust(19)
 
                 print('Iter: {:>7} | Task: {} | Accuracy: {:5.3f} | Reward: {:5.3f} | Aux Loss: {:7.5f} | Mean h: {:8.5f}'.format(\
-                    i, par['task'], acc, rew, aux_loss, np.mean(np.stack(h_list))))
-                print('Time: {:>7} | Total PE: {} | Stim PE: {} | Rew PE: {} | Act PE: {}\n'.format(int(np.around(time.time() - task_start_time)), pe, spe, rpe, ape))
+                    i, par['task'] if scheduler is None else scheduler.active, acc, rew, aux_loss, mean_h))
+                print('Time: {:>7} | Total PE: {} | Stim PE: {} | Rew PE: {} | Act PE: {}'.format(int(np.around(time.time() - task_start_time)), pe, spe, rpe, ape))
+                if par['room_sizes'] is not None:
+                    # Reward per trial, by room size
+                    size = stimulus_access.room_size()
+                    trial_rew = np.sum(reward, axis=0)[:,0]
+                    print('Reward by room: ' + ' | '.join('{}x{}: {:5.3f}'.format(h, w, np.mean(trial_rew[(size[:,0]==h)*(size[:,1]==w)])) \
+                        for h, w in np.unique(size, axis=0)))
+                if par['num_models'] > 1:
+                    print('Reward by model: ' + ' | '.join('{}: {:5.3f}'.format(n, r) for n, r in enumerate(model_reward_iter[-1])))
+                print('')
+
+                if evaluator is not None:
+                    for result in evaluator.poll():
+                        evaluation.print_result(result)
 
                 fn = par['save_dir'] + par['save_fn'] + '_trajectories' + par['save_fn_suffix'] + '.pkl'
-                agent_records.append({'iter':i, 'reward_locs':stimulus_access.reward_locations,'agent_locs':stimulus_access.loc_history, 'actions':action})
+                agent_records.append({'iter':i, 'reward_locs':stimulus_access.get_reward_locations(),'agent_locs':np.stack(agent_locations)[:,0] if model.in_graph_env else stimulus_access.get_loc_history(), \
+                    'room_sizes':stimulus_access.room_size(), 'actions':action, 'pred_error':pred_err})
                 pickle.dump(agent_records, open(fn.format(i), 'wb'))
 
 
-        """# Update big omegaes, and reset other values before starting new task
-        if par['stabilization'] == 'pathint':
-            big_omegas = sess.run([model.update_big_omega, model.big_omega_var])
+        if recorder is not None:
+            recorder.close()
 
+        # Save the trained network first, so that it is kept if consolidation fails
+        weights_fn = par['save_dir'] + par['save_fn'] + '_weights' + par['save_fn_suffix'] + '.pkl'
+        save_weights(sess, weights_fn)
+        elapsed = time.time() - task_start_time
 
-        elif par['stabilization'] == 'EWC':
-            for n in range(par['EWC_fisher_num_batches']):
-                name, input_data, _, mk, reward_data = stim.generate_trial(task)
-                mk = mk[..., np.newaxis]
-                big_omegas = sess.run([model.update_big_omega,model.big_omega_var], feed_dict = \
-                    {x:input_data, target: reward_data, gating:par['gating'][task], mask:mk})"""
-
-        #results = {'reward_matrix': reward_matrix, 'par': par, 'activity': full_activity_list}
-        #pickle.dump(results, open(par['save_dir'] + save_fn, 'wb') )
-        #print('Analysis results saved in', save_fn)
-        #print('')
-
-        # Reset the Adam Optimizer, and set the previous parameter values to their current values
-        sess.run(model.reset_adam_op)
-        sess.run(model.reset_prev_vars)
-        if par['stabilization'] == 'pathint':
-            sess.run(model.reset_small_omega)
+        # Update big omegas, and reset the other values before any new task
+        if prefetcher is not None:
+            prefetcher.hold()
+        if scheduler is not None:
+            scheduler.finish_task(sess, model, prefetcher)
+        else:
+            tasks.consolidate(sess, model, stimulus_access)
+
+        # Add the run to the results index
+        metrics = results.summarize(accuracy_iter, reward_iter, elapsed, num_steps)
+        eval_fn = None
+        if evaluator is not None:
+            eval_fn = finish_evaluation(evaluator, i, get_weights(sess))
+            metrics.update(evaluation.final_metrics(evaluator.results))
+        if scheduler is not None:
+            metrics.update(scheduler.metrics())
+        if batcher is not None:
+            metrics.update(batcher.metrics())
+        artifacts = {'weights_file': weights_fn, 'evaluation_file': eval_fn, \
+             'trajectory_file': par['save_dir'] + par['save_fn'] + '_trajectories' + par['save_fn_suffix'] + '.pkl', \
+             'activity_file': recorder.fn + '.npy' if recorder is not None else None}
+        if par['num_models'] == 1:
+            results.register_run(metrics, artifacts)
+        else:
+            register_models(model_accuracy_iter, model_reward_iter, elapsed, \
+                num_steps//par['num_models'], artifacts)
 
     print('\nModel execution complete. (Reinforcement)')
 
 
+def register_models(model_accuracy_iter, model_reward_iter, wall_time, steps, artifacts):
+    """ Add each of several models trained in one graph to the results index
+        as a run of its own, with its hyperparameters and its share of the
+        steps.  The weights of all models are saved together, stacked. """
+
+    model_accuracy_iter = np.stack(model_accuracy_iter)
+    model_reward_iter = np.stack(model_reward_iter)
+
+    for n in range(par['num_models']):
+        params = dict(par)
+        params.update({name : schedules.start(name, n) for name in schedules.HYPERPARAMETERS})
+        params.update({'save_fn_suffix': par['save_fn_suffix'] + '_model{}'.format(n), 'model_index': n})
+        metrics = results.summarize(model_accuracy_iter[:,n], model_reward_iter[:,n], wall_time, steps)
+        results.register_run(metrics, artifacts, params=params)
+
+
+def finish_evaluation(evaluator, i, weights):
+    """ Evaluate the final weights, display the remaining evaluations and
+        save them all, returning the file name """
+
+    for result in evaluator.close(i, weights):
+        evaluation.print_result(result)
+
+    fn = par['save_dir'] + par['save_fn'] + '_evaluation' + par['save_fn_suffix'] + '.pkl'
+    pickle.dump(evaluator.results, open(fn, 'wb'))
+
+    return fn
+
+
+def session_config():
+    """ Session options from par, e.g. as chosen by the autotuner """
+
+    return tf.ConfigProto(intra_op_parallelism_threads=par['intra_op_threads'] or 0, \
+        inter_op_parallelism_threads=par['inter_op_threads'] or 0)
+
+
+def reset_environment(worker=0):
+    """ Rebuild the environment, e.g. after loading parameters from another
+        process, drawing from the random stream of the given worker """
+
+    global stimulus_access
+    stimulus_access = stimulus.RoomStimulus(worker)
+
+    return stimulus_access
+
+
+def reward_cell():
+    """ Predictive cell whose reward prediction is recorded as the expected reward """
+
+    return min(1, par['num_pred_cells']-1)
+
+
+def pred_error_components():
+    """ Matrix averaging the units of a predictive cell's input
+        over each of the PRED_ERROR_COMPONENTS """
+
+    component = np.array([0]*par['n_input'] + [1] + [2]*par['n_pol'])
+    averaging = np.float32(component[:,np.newaxis] == np.arange(len(PRED_ERROR_COMPONENTS))[np.newaxis,:])
+
+    return averaging/np.sum(averaging, axis=0, keepdims=True)
+
+
+def num_weights():
+    """ Total number of trainable parameters, computed from their initial values """
+
+    n = 0
+    for name in LSTM_VAR_PREFIXES:
+        n += int(np.sum([np.prod(w.shape) for w in par[name + '_init']]))
+    for name in RL_VAR_PREFIXES:
+        n += int(np.prod(par[name + '_init'].shape))
+
+    return n
+
+
+def get_weights(sess):
+    """ Collect the current values of all trainable variables, keyed by name """
+
+    variables = tf.trainable_variables()
+    values = sess.run(variables)
+
+    return {var.op.name : val for var, val in zip(variables, values)}
+
+
+def get_state(sess):
+    """ Collect the current values of all variables changed by training
+        (weights, optimizer and stabilization state), keyed by name.  The
+        hyperparameters and the sampling seed are left out. """
+
+    variables = [var for var in tf.global_variables() if not var.op.name.startswith(('hyperparameters/', 'sampling/'))]
+    values = sess.run(variables)
+
+    return {var.op.name : val for var, val in zip(variables, values)}
+
+
+def set_state(sess, state):
+    """ Load variable values (as from get_state) in one call, as in set_weights """
+
+    ops = []
+    feed_dict = {}
+    for var in tf.global_variables():
+        if var.op.name in state:
+            ops.append(var.initializer)
+            feed_dict[var.initializer.inputs[1]] = state[var.op.name]
+
+    sess.run(ops, feed_dict=feed_dict)
+
+
+def save_weights(sess, fn):
+    """ Save the trained weights, with the parameters needed to rebuild the network """
+
+    pickle.dump({'weights':get_weights(sess), 'par':dict(par)}, open(fn, 'wb'))
+
+
+def set_weights(sess, weights):
+    """ Load trainable variable values (as from get_weights) in one call,
+        feeding the existing initializers instead of adding assign ops """
+
+    ops = []
+    feed_dict = {}
+    for var in tf.trainable_variables():
+        if var.op.name in weights:
+            ops.append(var.initializer)
+            feed_dict[var.initializer.inputs[1]] = weights[var.op.name]
+
+    sess.run(ops, feed_dict=feed_dict)
+
+
+def set_hyperparameters(sess, model, values):
+    """ Load hyperparameter values, keyed by name, in one call, feeding the
+        initializers as in set_weights """
+
+    ops = []
+    feed_dict = {}
+    for name, value in values.items():
+        var = model.hyperparameters[name]
+        ops.append(var.initializer)
+        feed_dict[var.initializer.inputs[1]] = value
+
+    sess.run(ops, feed_dict=feed_dict)
+
+
+def set_sampling_seed(sess, model, component='actions', worker=0):
+    """ Seed the action sampling of a model from the stream of the given
+        component and worker, and start counting rollouts afresh """
+
+    seed = rng(component, worker).integers(2**63)
+    sess.run([model.sampling_seed.initializer, model.rollouts.initializer], \
+        feed_dict={model.sampling_seed.initializer.inputs[1]: seed, model.rollouts.initializer.inputs[1]: 0})
+
+
+def update_hyperparameters(sess, model, i, current=None):
+    """ Set the hyperparameters scheduled for iteration i, unless they are
+        unchanged from current, and return them """
+
+    values = schedules.values(i)
+    if values != current:
+        set_hyperparameters(sess, model, values)
+
+    return values
+
+
 def print_key_info():
     """ Display requested information """
 
     key_info = ['synapse_config','spike_cost','weight_cost','entropy_cost','omega_c','omega_xi',\
         'n_hidden','noise_rnn_sd','learning_rate','discount_rate', 'stabilization',\
-        'gating_type', 'gate_pct','include_rule_signal','task','num_nav_tuned','room_width','room_height',\
-        'rewards','failure_penalty']
+        'gating_type', 'gate_pct','include_rule_signal','task','num_nav_tuned','room_width','room_height','room_sizes',\
+        'rewards','failure_penalty','root_seed','precision','num_models']
     print('\nKey info:')
     print('-'*60)
     for k in key_info:
@@ -619,14 +1495,29 @@ def generate_placeholders():
 
 def main(save_fn='testing', gpu_id=None):
 
-    # Update all dependencies in parameters
+    # Update all dependencies in parameters, and the environment with them
     update_dependencies()
+    reset_environment()
 
     # Identify learning method and run accordingly
     if par['training_method'] == 'SL':
         raise Exception('This code does not support supervised learning at this time.')
-    elif par['training_method'] == 'RL':
+    elif par['training_method'] == 'RL' and par['training_loop'] != 'standard' and par['tasks']:
+        raise Exception('Task schedules are only supported by the standard training loop.')
+    elif par['training_method'] == 'RL' and par['training_loop'] == 'standard':
+        if par['autotune']:
+            import autotune
+            autotune.autotune(gpu_id)
         reinforcement_learning(save_fn, gpu_id)
+    elif par['training_method'] == 'RL' and par['training_loop'] == 'actor_learner':
+        import actor_learner
+        actor_learner.actor_learner(save_fn, gpu_id)
+    elif par['training_method'] == 'RL' and par['training_loop'] == 'data_parallel':
+        import data_parallel
+        data_parallel.data_parallel(save_fn, gpu_id)
+    elif par['training_method'] == 'RL' and par['training_loop'] == 'pbt':
+        import pbt
+        pbt.population_based_training(save_fn, gpu_id)
     else:
         raise Exception('Select a valid learning method.')
 
@@ -2,6 +2,7 @@
 
 import numpy as np
 from itertools import product, chain
+import zlib
 
 print("\n--> Loading parameters...")
 
@@ -16,6 +17,13 @@ par = {
     'plot_dir'              : './plotdir/',
     'save_fn'               : 'navigation',
     'save_fn_suffix'        : '_v0',
+    'seed'                  : None,             # Root of all random streams (see rng), or None to draw a new one
+    'results_dir'           : './results/',     # Every run registers its parameters, metrics and files here
+    'results_window'        : 100,              # Iterations averaged for the final metrics of a run
+    'eval_interval'         : None,             # Iterations between evaluations on held-out episodes, or None
+    'eval_episodes'         : 1024,             # Held-out episodes per evaluation, for both the greedy and the sampled policy
+    'eval_batch_size'       : 256,
+    'eval_seed'             : 0,                # Seed of the held-out starting locations and reward layouts
     'save_plots'            : True,
 
     # Network configuration
@@ -35,6 +43,7 @@ par = {
     'learning_rate'         : 1e-3,
     'membrane_time_constant': 100,
     'connection_prob'       : 1.0,
+    'sparse_weights'        : False,    # Store LSTM and prediction weights sparsely, at connection_prob
     'discount_rate'         : 0.95,
 
     # Variance values
@@ -53,10 +62,20 @@ par = {
     'num_actions'           : 5,
     'room_width'            : 4,
     'room_height'           : 5,
+    'room_sizes'            : None,     # List of [height, width] to mix within each batch, or None for room_height x room_width only
+    'room_buckets'          : 1,        # Groups of similarly sized rooms; each batch draws its rooms from one group
+    'room_bucket_episodes'  : 1,        # Episodes drawn from each group before moving on to the next larger one
     'rewards'               : [1., 2.,],
     'use_default_rew_locs'  : True,
     'failure_penalty'       : -1.,
     'trial_length'          : 500,
+    'in_graph_env'          : False,    # Step the environment with graph ops rather than Python callbacks
+    'xla_jit'               : False,    # Compile the rollout and losses with XLA, where the environment is in the graph
+    'recompute_gradients'   : False,    # Keep only the states and inputs of each step for backprop, recomputing the rest
+    'precision'             : 'float32',    # 'bfloat16' to run the predictive cells, and keep their activity, in bfloat16
+    'num_models'            : 1,        # Independent models trained in one graph, each on its own slice of the batch
+    'model_hyperparameters' : None,     # List of num_models dicts of hyperparameters (see schedules.py) set per model, or None
+    'tbptt_window'          : None,     # Time steps per truncated BPTT window, or None to backpropagate through whole episodes
 
     # Cost values
     'spike_cost'            : 0.,
@@ -72,19 +91,84 @@ par = {
     'U_std'                 : 0.45,
 
     # Training specs
-    'batch_size'            : 256,
+    'batch_size'            : 256,      # Total over all models, if num_models > 1
     'n_train_batches'       : 500000, #50000,
+    'schedules'             : None,     # Schedules of hyperparameters, changed between iterations (see schedules.py), or None
+    'dynamic_batch'         : False,    # Read the batch size from the environment at run time, and schedule it (see schedules.BatchScheduler)
+    'batch_size_min'        : 64,       # Limits of a dynamic batch size
+    'batch_size_max'        : 2048,
+    'batch_growth'          : 2,        # Factor by which a dynamic batch grows or shrinks
+    'batch_plateau_window'  : 1000,     # Iterations over which the mean reward is compared, before the batch can change again
+    'batch_plateau_tol'     : 0.01,     # Min. increase in mean reward per trial between windows not counted as a plateau
+    'batch_memory_limit'    : None,     # Resident memory (MB) above which a dynamic batch shrinks, or None
 
     # Omega parameters
     'omega_c'               : 0.,
     'omega_xi'              : 0.001,
     'EWC_fisher_num_batches': 16,   # number of batches when calculating EWC
+    'EWC_fisher_chunk'      : 32,   # trials per backward pass when calculating EWC (bounds memory)
+    'EWC_fisher_process'    : True, # calculate EWC in a separate process while rollouts are generated
+
+    # Continual learning
+    'tasks'                 : None,     # List of environment variants trained in turn in one session (see tasks.py), or None
+    'task_iters'            : 10000,    # Iterations per task, unless the task sets its own 'iters'
+    'task_eval_batches'     : 4,        # Batches run on every task seen so far whenever a task ends
 
     # Gating parameters
     'gating_type'           : None, # 'XdG', 'partial', 'split', None
     'gate_pct'              : 0.8,  # Num. gated hidden units for 'XdG' only
     'n_subnetworks'         : 4,    # Num. subnetworks for 'split' only
 
+    # Training loop
+    'training_loop'         : 'standard',   # 'standard', 'actor_learner', 'data_parallel', 'pbt'
+    'prefetch_episodes'     : True,     # Draw the next agent/reward placements on a background thread
+    'wavefront_replay'      : True,     # Evaluate replayed hierarchies along anti-diagonals of cells and time steps
+    'graph_cache'           : False,    # Reuse graphs built earlier with the same structure
+    'graph_cache_dir'       : './graphcache/',
+
+    # Session execution settings (None for the TensorFlow/runtime defaults)
+    'intra_op_threads'      : None,
+    'inter_op_threads'      : None,
+    'omp_num_threads'       : None,
+    'kmp_blocktime'         : None,
+    'autotune'              : False,    # Benchmark the execution settings before training, cached per machine and graph
+    'autotune_iters'        : 10,       # Timed iterations per benchmarked setting
+    'autotune_cache'        : './autotune.pkl',
+    'autotune_timeout'      : 1800,     # Seconds before a benchmarked setting counts as failed
+
+    # Activity recording
+    'record_activity'       : False,    # Stream sampled hidden activity to disk for later analysis
+    'record_interval'       : 200,      # Iterations between activity records
+    'record_trials'         : 16,       # Num. trials per record, or None for all
+    'record_units'          : 32,       # Num. units per predictive cell, or None for all
+    'record_time_stride'    : 1,        # Record every n-th time step
+
+    # Inference server parameters
+    'inference_address'     : './policy_server.sock',   # Local socket path, or (host, port)
+    'inference_max_batch'   : 64,       # Max. step requests answered by one forward pass
+    'inference_max_wait'    : 0.002,    # Seconds to wait for other requests to join a batch
+
+    # Actor-learner parameters
+    'num_actors'            : 4,    # Num. processes generating rollouts
+    'actor_queue_size'      : 8,    # Max. trajectories waiting for the learner
+    'weight_publish_interval': 10,  # Learner iterations between weight publications
+    'vtrace_rho_clip'       : 1.0,  # Truncation of importance weights in the policy gradient
+    'vtrace_c_clip'         : 1.0,  # Truncation of importance weights in the value targets
+    'replay_capacity'       : 0,    # Trials kept for replay by the learner, or 0 for none
+    'replay_ratio'          : 0,    # Replayed batches trained on per trajectory from the actors
+
+    # Data-parallel parameters
+    'num_workers'           : 4,    # Num. processes sharing each batch; batch_size is the total over workers
+
+    # Population-based training parameters
+    'pbt_population'        : 8,        # Num. models trained concurrently, one process each
+    'pbt_interval'          : 1000,     # Iterations between rankings of the population
+    'pbt_window'            : 100,      # Iterations of reward each member is ranked by (at most pbt_interval)
+    'pbt_fraction'          : 0.25,     # Fraction of the population replaced by copies of the best members at each ranking
+    'pbt_perturb'           : [0.8, 1.25],  # Factors applied to the copied hyperparameters
+    'pbt_ranges'            : {'learning_rate':(1e-4, 1e-2), 'entropy_cost':(1e-5, 1e-2), \
+                               'discount_rate':(0.9, 0.99), 'error_cost':(0.1, 10.)},   # Log-uniform initial draws
+
 }
 
 
@@ -104,6 +188,15 @@ def update_parameters(updates):
     update_dependencies()
 
 
+def load_parameters(snapshot):
+    """
+    Replaces the parameter dictionary with a snapshot taken in another process,
+    without redrawing any of the random dependent parameters
+    """
+    par.clear()
+    par.update(snapshot)
+
+
 def update_dependencies():
     """ Updates all parameter dependencies """
 
@@ -118,6 +211,10 @@ def update_dependencies():
     par['synapse_config'] = None
     par['spike_cost'] = 0.
 
+    # Every random draw comes from a stream derived from the root seed
+    par['root_seed'] = int(np.random.SeedSequence().generate_state(1)[0]) if par['seed'] is None else par['seed']
+    weight_rng = rng('weights')
+
     # Number of input neurons
     par['n_input'] = par['num_nav_tuned'] + par['num_rew_tuned'] + par['num_fix_tuned'] + par['num_rule_tuned']
 
@@ -136,7 +233,7 @@ def update_dependencies():
             par['n_cell_input'].append((par['n_input'] + par['extra_n_in']))
 
     for i in range(par['num_pred_cells']-1):
-        par['n_LSTM_input'].append(2*par['n_cell_input'][i] + par['n_hidden'][i-1])
+        par['n_LSTM_input'].append(2*par['n_cell_input'][i] + par['n_hidden'][i+1])
     par['n_LSTM_input'].append(2*par['n_cell_input'][-1])
 
     # Specify time step in seconds and neuron time constant
@@ -151,10 +248,7 @@ def update_dependencies():
     par['num_time_steps'] = par['trial_length']//par['dt']
 
     # Specify one-hot vectors matching with each reward
-    condition = True
-    while condition:
-        par['reward_vectors'] = np.random.choice([0,1], size=[len(par['rewards']), par['num_rew_tuned']])
-        condition = (np.mean(np.std(par['reward_vectors'], axis=0)) == 0.)
+    par['reward_vectors'] = draw_reward_vectors(rng('reward_vectors'))
 
     # Set up gating vectors for hidden layer
     #gen_gating()
@@ -164,34 +258,77 @@ def update_dependencies():
     ###
 
     # Specify initial RNN state
-    par['h_init'] = []
-    for i in range(par['num_pred_cells']):
-        par['h_init'].append(0.1*np.ones((par['batch_size'], par['n_hidden'][i]), dtype=np.float32))
+    update_batch_dependencies()
+    if par['dynamic_batch'] and not par['batch_size_min'] <= par['batch_size'] <= par['batch_size_max']:
+        raise Exception('With a dynamic batch, batch_size must lie between batch_size_min and batch_size_max.')
 
+    # Several models in one graph have their weights stacked along a leading axis
+    if par['num_models'] > 1 and par['sparse_weights']:
+        raise Exception('Sparse weights are not supported with several models in one graph.')
+    models = [par['num_models']] if par['num_models'] > 1 else []
 
     # Initialize RL-specific weights
-    par['W_pol_out_init'] = np.float32(np.random.uniform(-c, c, size = [par['n_hidden'][-1], par['n_pol']]))
-    par['b_pol_out_init'] = np.zeros((1,par['n_pol']), dtype = np.float32)
+    par['W_pol_out_init'] = np.float32(weight_rng.uniform(-c, c, size = models + [par['n_hidden'][-1], par['n_pol']]))
+    par['b_pol_out_init'] = np.zeros(models + [1,par['n_pol']], dtype = np.float32)
 
-    par['W_val_out_init'] = np.float32(np.random.uniform(-c, c, size = [par['n_hidden'][-1], par['n_val']]))
-    par['b_val_out_init'] = np.zeros((1,par['n_val']), dtype = np.float32)
+    par['W_val_out_init'] = np.float32(weight_rng.uniform(-c, c, size = models + [par['n_hidden'][-1], par['n_val']]))
+    par['b_val_out_init'] = np.zeros(models + [1,par['n_val']], dtype = np.float32)
 
     ### Setting up LSTM weights and biases
 
     LSTM_var_names = ['Wf', 'Wi', 'Wo', 'Wc', 'W_pred', 'Uf', 'Ui', 'Uo', 'Uc', 'bf', 'bi', 'bo', 'bc', 'b_pred']
     for name in LSTM_var_names:
         par[name + '_init'] = []
+        sparse = par['sparse_weights'] and name[0] in ['W', 'U']
+        if sparse:
+            par[name + '_index'] = []
+            par[name + '_shape'] = []
         for i in range(par['num_pred_cells']):
             if name == 'W_pred':
-                par[name + '_init'].append(np.float32(np.random.uniform(-c, c, size = [par['n_hidden'][i], par['n_cell_input'][i]])))
+                dims = [par['n_hidden'][i], par['n_cell_input'][i]]
             elif name == 'b_pred':
-                par[name + '_init'].append(np.float32(np.random.uniform(-c, c, size = [1, par['n_cell_input'][i]])))
+                dims = [1, par['n_cell_input'][i]]
             elif name.startswith('W'):
-                par[name + '_init'].append(np.float32(np.random.uniform(-c, c, size = [par['n_LSTM_input'][i], par['n_hidden'][i]])))
+                dims = [par['n_LSTM_input'][i], par['n_hidden'][i]]
             elif name.startswith('U'):
-                par[name + '_init'].append(np.float32(np.random.uniform(-c, c, size = [par['n_hidden'][i], par['n_hidden'][i]])))
+                dims = [par['n_hidden'][i], par['n_hidden'][i]]
             elif name.startswith('b'):
-                par[name + '_init'].append(np.float32(np.random.uniform(-c, c, size = [1, par['n_hidden'][i]])))
+                dims = [1, par['n_hidden'][i]]
+            w = np.float32(weight_rng.uniform(-c, c, size = models + dims))
+            if sparse:
+                w, index = sparsify(w, par['connection_prob'], weight_rng)
+                par[name + '_index'].append(index)
+                par[name + '_shape'].append(dims[::-1])
+            par[name + '_init'].append(w)
+
+
+def rng(component, worker=0):
+    """ Random generator for one component (e.g. 'environment') of one
+        worker process, independent of all others and reproducible from
+        par['root_seed'] """
+
+    seed = np.random.SeedSequence(par['root_seed'], spawn_key=(zlib.crc32(component.encode()), worker))
+    return np.random.default_rng(seed)
+
+
+def draw_reward_vectors(generator):
+    """ Random binary vectors identifying each reward, not all the same """
+
+    condition = True
+    while condition:
+        reward_vectors = generator.choice([0,1], size=[len(par['rewards']), par['num_rew_tuned']])
+        condition = (np.mean(np.std(reward_vectors, axis=0)) == 0.)
+
+    return reward_vectors
+
+
+def update_batch_dependencies():
+    """ Updates the parameters that depend on the batch size, without
+        redrawing any of the random dependent parameters """
+
+    par['h_init'] = []
+    for i in range(par['num_pred_cells']):
+        par['h_init'].append(0.1*np.ones((par['batch_size'], par['n_hidden'][i]), dtype=np.float32))
 
 
 def gen_gating():
@@ -199,13 +336,14 @@ def gen_gating():
     Generate the gating signal to applied to all hidden units
     """
     par['gating'] = []
+    generator = rng('gating')
 
     for t in range(par['n_tasks']):
         gating_task = np.zeros(par['n_hidden'], dtype=np.float32)
         for i in range(par['n_hidden']):
 
             if par['gating_type'] == 'XdG':
-                if np.random.rand() < 1-par['gate_pct']:
+                if generator.random() < 1-par['gate_pct']:
                     gating_task[i] = 1
 
             elif par['gating_type'] == 'split':
@@ -218,9 +356,17 @@ def gen_gating():
         par['gating'].append(gating_task)
 
 
-def initialize_weight(dims, connection_prob):
-    w = np.random.gamma(shape=0.25, scale=1.0, size=dims)
-    w *= (np.random.rand(*dims) < connection_prob)
+def sparsify(w, connection_prob, generator):
+    """ Keep each synapse of w with probability connection_prob, returning the
+        kept values and their indices into the transposed, [out, in], matrix """
+
+    index = np.argwhere(generator.random(w.shape[::-1]) < connection_prob)
+    return np.float32(w.T[index[:,0], index[:,1]]), index.astype(np.int64)
+
+
+def initialize_weight(dims, connection_prob, generator):
+    w = generator.gamma(shape=0.25, scale=1.0, size=dims)
+    w *= (generator.random(dims) < connection_prob)
     return np.float32(w)
 
 
@@ -0,0 +1,224 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import tensorflow as tf
+import numpy as np
+import multiprocessing as mp
+import pickle
+import os, time
+
+# Model modules
+from parameters import *
+import stimulus
+import model
+import graph_cache
+import results
+import schedules
+
+# Limits kept by perturbed hyperparameters
+BOUNDS = {'discount_rate' : (0., 0.999)}
+
+
+class Population:
+
+    """ Shared-memory scoreboard of a population trained in step.  At every
+        ranking, each member posts its recent reward, and every member then
+        derives the same ranking from the posted rewards """
+
+    def __init__(self, size, directory, ctx):
+
+        self.size = size
+        self.directory = directory
+        self.scores = ctx.RawArray('d', size)
+        self.barrier = ctx.Barrier(size)
+        self.num_replaced = max(1, int(par['pbt_fraction']*size))
+
+
+    def rank(self, member_id, score):
+        """ Post the score of a member, returning the members from best to
+            worst once all have posted.  The scores are not overwritten before
+            every member has passed the next barrier (see exploit). """
+
+        scores = np.frombuffer(self.scores, dtype=np.float64)
+        scores[member_id] = score
+        self.barrier.wait()
+
+        return np.argsort(-scores, kind='stable'), np.copy(scores)
+
+
+    def state_file(self, member_id):
+        """ Where a member hands over its state to be copied """
+
+        return os.path.join(self.directory, 'member{}.pkl'.format(member_id))
+
+
+def initial_hyperparameters(generator):
+    """ Hyperparameters of a new member, drawn log-uniformly from par['pbt_ranges'] """
+
+    return {k : float(np.exp(generator.uniform(np.log(low), np.log(high)))) for k, (low, high) in par['pbt_ranges'].items()}
+
+
+def perturb(hyperparameters, generator):
+    """ Multiply each hyperparameter by one of the factors in par['pbt_perturb'] """
+
+    new = {}
+    for k, v in hyperparameters.items():
+        low, high = BOUNDS.get(k, (-np.inf, np.inf))
+        new[k] = float(np.clip(v*generator.choice(par['pbt_perturb']), low, high))
+
+    return new
+
+
+def exploit(sess, m, member_id, population, order, hyperparameters, generator):
+    """ Replace the weights, optimizer and stabilization state of a member
+        in the bottom of the ranking with those of a member in the top, and
+        perturb the copied hyperparameters.  Returns the new hyperparameters
+        and the member copied from, or None. """
+
+    top, bottom = order[:population.num_replaced], order[-population.num_replaced:]
+
+    # Members in the top hand over their state, before any is overwritten
+    if member_id in top:
+        fn = population.state_file(member_id)
+        pickle.dump({'state':model.get_state(sess), 'hyperparameters':hyperparameters}, open(fn + '.tmp', 'wb'))
+        os.replace(fn + '.tmp', fn)
+    population.barrier.wait()
+
+    if member_id not in bottom:
+        return hyperparameters, None
+
+    source = int(generator.choice(top))
+    saved = pickle.load(open(population.state_file(source), 'rb'))
+    model.set_state(sess, saved['state'])
+
+    return perturb(saved['hyperparameters'], generator), source
+
+
+def member_process(member_id, par_snapshot, population):
+    """ Train one member of the population, ranking it against the others
+        every par['pbt_interval'] iterations """
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+    # Identical initial weights, but independent environment draws and hyperparameters
+    load_parameters(par_snapshot)
+    par['save_fn_suffix'] = par_snapshot['save_fn_suffix'] + '_member{}'.format(member_id)
+    env = model.reset_environment(member_id + 1)
+    generator = rng('pbt', member_id)
+    hyperparameters = initial_hyperparameters(generator)
+    par.update(hyperparameters)
+
+    # Share the cores among the population
+    threads = max(1, (os.cpu_count() or 1)//population.size)
+
+    tf.reset_default_graph()
+    with tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)) as sess:
+
+        m = graph_cache.build(model.Model, env)
+        sess.run(tf.global_variables_initializer())
+        graph_cache.load_initial_weights(sess, m)
+        sess.run(m.reset_prev_vars)
+        model.set_sampling_seed(sess, m, worker=member_id + 1)
+        prefetcher = stimulus.EpisodePrefetcher(env) if par['prefetch_episodes'] else None
+
+        accuracy_iter = []
+        reward_iter = []
+        history = [{'iter':0, 'source':None, 'hyperparameters':hyperparameters}]
+        current = None
+        task_start_time = time.time()
+
+        for i in range(par['n_train_batches']):
+
+            # Start new episodes, unless continuing the current ones in another window
+            if i%m.windows_per_episode == 0:
+                if prefetcher is not None:
+                    prefetcher.swap()
+                else:
+                    env.place_agents()
+                    env.place_rewards()
+                carried_state = m.initial_state()
+            feed_dict = m.state_feed(carried_state)
+
+            # Schedules, if any, start from this member's values
+            current = model.update_hyperparameters(sess, m, i, current)
+
+            if par['stabilization'] == 'pathint':
+                _, _, _, reward_list, carried_state = sess.run([m.train_op, m.update_current_reward, m.update_small_omega, \
+                    m.reward, m.state_out], feed_dict=feed_dict)
+                if i>0:
+                    sess.run([m.update_small_omega])
+                sess.run([m.update_previous_reward])
+            else:
+                _, reward_list, carried_state = sess.run([m.train_op, m.reward, m.state_out], feed_dict=feed_dict)
+
+            reward = np.stack(reward_list)
+            accuracy_iter.append(np.mean(np.sum(reward>0, axis=0)))
+            reward_iter.append(np.mean(np.sum(reward, axis=0)))
+
+            # Rank the population, and replace the weakest members
+            if (i+1)%par['pbt_interval'] == 0 and i+1 < par['n_train_batches']:
+                order, scores = population.rank(member_id, np.mean(reward_iter[-par['pbt_window']:]))
+                hyperparameters, source = exploit(sess, m, member_id, population, order, hyperparameters, generator)
+                if source is not None:
+                    par.update(hyperparameters)
+                    history.append({'iter':i+1, 'source':source, 'hyperparameters':hyperparameters})
+
+                if member_id == 0:
+                    elapsed = time.time() - task_start_time
+                    print('Iter: {:>7} | Time: {:>7} | Reward by rank: {}'.format(i+1, int(np.around(elapsed)), \
+                        ' | '.join('{}: {:5.3f}'.format(n, scores[n]) for n in order)))
+
+        # Save this member's network and lineage, and add it to the results index
+        weights_fn = par['save_dir'] + par['save_fn'] + '_weights' + par['save_fn_suffix'] + '.pkl'
+        model.save_weights(sess, weights_fn)
+        history_fn = par['save_dir'] + par['save_fn'] + '_pbt_history' + par['save_fn_suffix'] + '.pkl'
+        pickle.dump(history, open(history_fn, 'wb'))
+        n_steps = len(accuracy_iter)*par['batch_size']*m.num_steps
+        metrics = results.summarize(accuracy_iter, reward_iter, time.time() - task_start_time, n_steps)
+        metrics.update({'pbt_member':member_id, 'pbt_exploits':len(history) - 1})
+        results.register_run(metrics, {'weights_file': weights_fn, 'pbt_history_file': history_fn})
+
+
+def population_based_training(save_fn='test.pkl', gpu_id=None):
+    """ Train par['pbt_population'] models concurrently, one process each,
+        periodically replacing the weakest with perturbed copies of the best """
+
+    population_size = par['pbt_population']
+    if population_size < 2 or 2*max(1, int(par['pbt_fraction']*population_size)) > population_size:
+        raise Exception('Population-based training needs at least two members, and pbt_fraction at most 0.5.')
+    if par['pbt_window'] > par['pbt_interval']:
+        raise Exception('pbt_window must not exceed pbt_interval.')
+    unknown = set(par['pbt_ranges']) - set(schedules.HYPERPARAMETERS)
+    if len(unknown) > 0:
+        raise Exception('Only {} can be tuned, not {}.'.format(schedules.HYPERPARAMETERS, sorted(unknown)))
+
+    # Display relevant parameters
+    model.print_key_info()
+    print('Population-based training of {} members, ranked every {} iterations.\n'.format(\
+        population_size, par['pbt_interval']))
+
+    directory = par['save_dir'] + par['save_fn'] + '_pbt' + par['save_fn_suffix']
+    os.makedirs(directory, exist_ok=True)
+
+    # TensorFlow does not survive forking, so members are started fresh
+    ctx = mp.get_context('spawn')
+    population = Population(population_size, directory, ctx)
+    members = [ctx.Process(target=member_process, args=(n, dict(par), population)) \
+        for n in range(population_size)]
+    for p in members:
+        p.start()
+
+    try:
+        # If any member fails, release the others from the barrier
+        while any(p.is_alive() for p in members):
+            if any(p.exitcode not in [None, 0] for p in members):
+                population.barrier.abort()
+                raise Exception('A population member failed.')
+            time.sleep(0.5)
+    finally:
+        for p in members:
+            if p.is_alive():
+                p.terminate()
+
+    print('\nModel execution complete. (Population-based training)')
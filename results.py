@@ -0,0 +1,189 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import numpy as np
+import pickle
+import glob
+import ast
+import os, sys, time
+
+# Model modules
+from parameters import par
+
+# Every run writes one file to par['results_dir'], and the runs are
+# gathered into a table with one column per parameter, metric and artifact
+RUN_SUFFIX  = '.run.pkl'
+INDEX_FILE  = 'index.pkl'
+
+
+def to_value(v):
+    """ Parameter value as stored in the table, or None if it is not kept
+        (e.g. initial weights, which are saved with the trained weights) """
+
+    if isinstance(v, (np.bool_, np.integer, np.floating)):
+        return v.item()
+    elif v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    elif isinstance(v, np.ndarray) and v.size <= 64:
+        return to_value(v.tolist())
+    elif isinstance(v, (list, tuple)) and len(v) <= 64:
+        # Lists become tuples, so that they can be compared and grouped by
+        values = tuple(to_value(x) for x in v)
+        return None if any(x is None and y is not None for x, y in zip(values, v)) else values
+    return None
+
+
+def summarize(accuracy, reward, wall_time, steps):
+    """ Summary metrics of a training run, from the accuracy and reward of
+        each iteration """
+
+    w = min(par['results_window'], len(accuracy))
+    smooth = np.convolve(accuracy, np.ones(w)/w, mode='valid') if w > 0 else [np.nan]
+
+    return {'iterations'     : len(accuracy),
+            'final_accuracy' : float(np.mean(accuracy[-w:])) if w > 0 else np.nan,
+            'final_reward'   : float(np.mean(reward[-w:])) if w > 0 else np.nan,
+            'best_accuracy'  : float(np.max(smooth)),
+            'wall_time'      : wall_time,
+            'steps_per_sec'  : steps/wall_time}
+
+
+def register_run(metrics, artifacts, params=None):
+    """ Save the parameters, summary metrics and artifact paths of a run,
+        and add it to the index """
+
+    params = par if params is None else params
+    run_id = '{}{}_{}_{}'.format(params['save_fn'], params['save_fn_suffix'], time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+    record = {k : to_value(v) for k, v in params.items()}
+    record = {k : v for k, v in record.items() if v is not None or params[k] is None}
+    record.update(metrics)
+    record.update({k : os.path.abspath(v) for k, v in artifacts.items() if v is not None})
+    record.update({'run_id' : run_id, 'finished' : time.time()})
+
+    # Write to a temporary file first, so that the index never reads a partial run
+    os.makedirs(params['results_dir'], exist_ok=True)
+    fn = os.path.join(params['results_dir'], run_id + RUN_SUFFIX)
+    pickle.dump(record, open(fn + '.tmp', 'wb'))
+    os.replace(fn + '.tmp', fn)
+
+    update_index(params['results_dir'])
+    print('Run registered as {}'.format(run_id))
+
+    return run_id
+
+
+def update_index(results_dir=None):
+    """ Add any runs not yet in the index, returning the index.  Runs that
+        finish at the same time may overwrite each other's update, but their
+        files stay behind and are added by the next update. """
+
+    results_dir = par['results_dir'] if results_dir is None else results_dir
+    fn = os.path.join(results_dir, INDEX_FILE)
+    index = pickle.load(open(fn, 'rb')) if os.path.exists(fn) else {'run_id' : np.array([], dtype=object)}
+
+    known = set(index['run_id'])
+    new = [f for f in sorted(glob.glob(os.path.join(results_dir, '*' + RUN_SUFFIX))) \
+        if os.path.basename(f)[:-len(RUN_SUFFIX)] not in known]
+    if len(new) == 0:
+        return index
+
+    index = append(index, [pickle.load(open(f, 'rb')) for f in new])
+    pickle.dump(index, open(fn + '.tmp{}'.format(os.getpid()), 'wb'))
+    os.replace(fn + '.tmp{}'.format(os.getpid()), fn)
+
+    return index
+
+
+def append(index, records):
+    """ Add rows to the index, one column per key.  Numeric columns are
+        float arrays with NaN where a run has no value, all others hold objects. """
+
+    n = len(index['run_id'])
+    new_index = {}
+    for k in set(index) | set(k for r in records for k in r):
+        values = [None]*n if k not in index else [None if is_missing(v) else v for v in index[k]]
+        values += [r.get(k) for r in records]
+
+        if all(v is None or is_number(v) for v in values):
+            new_index[k] = np.float64([np.nan if v is None else v for v in values])
+        else:
+            new_index[k] = np.empty(len(values), dtype=object)
+            for i, v in enumerate(values):
+                new_index[k][i] = v
+
+    return new_index
+
+
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def is_missing(v):
+    return v is None or (isinstance(v, float) and np.isnan(v))
+
+
+def load_index(results_dir=None):
+    """ The index of all registered runs, as a dictionary of columns """
+    return update_index(results_dir)
+
+
+def select(index, **conditions):
+    """ Rows of the index matching all conditions, each either a value or a
+        function of the column value, e.g. select(index, room_width=8,
+        entropy_cost=lambda x: x < 1e-3) """
+
+    mask = np.ones(len(index['run_id']), dtype=bool)
+    for k, cond in conditions.items():
+        col = index[k] if k in index else np.full(len(mask), None, dtype=object)
+        if callable(cond):
+            mask &= np.array([v is not None and bool(cond(v)) for v in col], dtype=bool)
+        elif col.dtype != object:
+            mask &= col == cond
+        else:
+            value = to_value(cond)
+            mask &= np.array([v == value for v in col], dtype=bool)
+
+    return {k : v[mask] for k, v in index.items()}
+
+
+def best(index, metric, by, **conditions):
+    """ For each value of the parameter by, the run with the highest metric
+        among the runs matching the conditions, as (value, metric, run_id) """
+
+    index = select(index, **conditions)
+    values = set(v for v in index[by].tolist() if not is_missing(v))
+
+    rows = []
+    for value in sorted(values, key=lambda v: (0, v, '') if is_number(v) else (1, 0, str(v))):
+        group = np.where(np.array([v == value for v in index[by]], dtype=bool))[0]
+        scores = np.asarray(index[metric][group], dtype=np.float64)
+        if np.all(np.isnan(scores)):
+            continue
+        n = np.nanargmax(scores)
+        rows.append((value, float(scores[n]), index['run_id'][group[n]]))
+
+    return rows
+
+
+def print_best(metric, by, **conditions):
+
+    rows = best(load_index(), metric, by, **conditions)
+    print('{:<20} | {:<14} | Run'.format(by, metric))
+    for value, score, run_id in rows:
+        print('{:<20} | {:14.5f} | {}'.format(str(value), score, run_id))
+
+
+if __name__ == '__main__':
+    # python results.py <metric> <parameter> [key=value ...]
+    #   e.g. python results.py final_reward entropy_cost room_height=8 room_width=8
+    conditions = {}
+    for arg in sys.argv[3:]:
+        k, v = arg.split('=', 1)
+        try:
+            conditions[k] = ast.literal_eval(v)
+        except (ValueError, SyntaxError):
+            conditions[k] = v
+    t_start = time.time()
+    print_best(sys.argv[1], sys.argv[2], **conditions)
+    print('({} runs, {:.1f} ms)'.format(len(load_index()['run_id']), 1000*(time.time() - t_start)))
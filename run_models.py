@@ -20,10 +20,13 @@ def try_model(save_fn):
 ###############################################################################
 ###############################################################################
 
-updates = {
-    'save_fn'           : 'navigation_fixed_vectors',
-    'save_fn_suffix'    : '_v0',
-}
+# Guarded so that worker processes (started with 'spawn') can import this module
+if __name__ == '__main__':
 
-update_parameters(updates)
-try_model(par['save_fn'])
+    updates = {
+        'save_fn'           : 'navigation_fixed_vectors',
+        'save_fn_suffix'    : '_v0',
+    }
+
+    update_parameters(updates)
+    try_model(par['save_fn'])
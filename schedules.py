@@ -0,0 +1,151 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import numpy as np
+import resource
+import os
+
+# Model modules
+from parameters import par, update_batch_dependencies
+
+# Hyperparameters held in graph variables rather than baked into the graph,
+# so that they can be changed between iterations without rebuilding it
+HYPERPARAMETERS = ['learning_rate', 'entropy_cost', 'val_cost', 'error_cost', 'discount_rate', 'omega_c', 'failure_penalty']
+
+
+def start(name, model=None):
+    """ Value of a hyperparameter before any schedule, in par unless it is
+        set for the given model in par['model_hyperparameters'] """
+
+    if model is None or par['model_hyperparameters'] is None:
+        return par[name]
+
+    return par['model_hyperparameters'][model].get(name, par[name])
+
+
+def value(name, i, model=None):
+    """ Value of a hyperparameter at iteration i, for the given model if
+        there are several.  par['schedules'] can give any of them a
+        schedule, starting from the value in start:
+            ('linear', end, n)       : linearly to end over n iterations
+            ('cosine', end, n)       : cosine annealing to end over n iterations
+            ('exponential', rate, n) : multiplied by rate every n iterations
+            ('step', [(j, v), ...])  : v from iteration j on """
+
+    start_value = start(name, model)
+    schedule = (par['schedules'] or {}).get(name)
+    if schedule is None:
+        return float(start_value)
+
+    kind = schedule[0]
+    if kind == 'linear':
+        end, n = schedule[1:]
+        return float(start_value + (end - start_value)*min(1., i/n))
+    elif kind == 'cosine':
+        end, n = schedule[1:]
+        return float(end + (start_value - end)*0.5*(1 + np.cos(np.pi*min(1., i/n))))
+    elif kind == 'exponential':
+        rate, n = schedule[1:]
+        return float(start_value*rate**(i/n))
+    elif kind == 'step':
+        v = start_value
+        for j, x in sorted(schedule[1]):
+            if i >= j:
+                v = x
+        return float(v)
+    else:
+        raise Exception('Unknown schedule \'{}\' for {}.'.format(kind, name))
+
+
+def values(i):
+    """ Values of all hyperparameters at iteration i, as lists over models
+        if there are several """
+
+    unknown = set(par['schedules'] or {}) - set(HYPERPARAMETERS)
+    if len(unknown) > 0:
+        raise Exception('Only {} can be scheduled, not {}.'.format(HYPERPARAMETERS, sorted(unknown)))
+
+    if par['num_models'] > 1:
+        return {name : [value(name, i, n) for n in range(par['num_models'])] for name in HYPERPARAMETERS}
+
+    return {name : value(name, i) for name in HYPERPARAMETERS}
+
+
+def resident_memory():
+    """ Current resident memory of this process, in MB, or the peak where
+        the current value is not available """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+
+
+class BatchScheduler:
+
+    """ Changes the batch size between episodes, for graphs built with
+        par['dynamic_batch'].  The batch grows by par['batch_growth'] once the
+        mean reward stops improving from one window of iterations to the next,
+        and shrinks by the same factor whenever the process holds more than
+        par['batch_memory_limit'] MB, after which it does not grow back.
+
+        Freed memory is rarely returned to the system, so after a resize the
+        batch only shrinks again if the process grows beyond what it held
+        just after the resize. """
+
+    def __init__(self, env, prefetcher=None):
+
+        self.env = env
+        self.prefetcher = prefetcher
+        self.max_size = par['batch_size_max']
+        self.memory_at_resize = 0.
+        self.rewards = []
+        self.history = [(0, par['batch_size'])]
+
+
+    def record(self, reward):
+        """ Mean reward per trial of one iteration """
+        self.rewards.append(reward)
+
+
+    def update(self, i):
+        """ Choose the batch size of the episodes starting at iteration i,
+            waiting a whole window after every change """
+
+        window = par['batch_plateau_window']
+        if len(self.rewards) < window:
+            return
+
+        size = par['batch_size']
+        if par['batch_memory_limit'] is not None and resident_memory() > max(par['batch_memory_limit'], self.memory_at_resize):
+            self.max_size = max(par['batch_size_min'], size//par['batch_growth'])
+            self.resize(i, self.max_size)
+        elif len(self.rewards) >= 2*window:
+            previous, current = np.mean(self.rewards[-2*window:-window]), np.mean(self.rewards[-window:])
+            if current - previous < par['batch_plateau_tol']:
+                self.resize(i, min(self.max_size, size*par['batch_growth']))
+
+
+    def resize(self, i, size):
+
+        if size == par['batch_size']:
+            return
+
+        print('Iter: {:>7} | Batch size: {} -> {}\n'.format(i, par['batch_size'], size))
+        par['batch_size'] = size
+        update_batch_dependencies()
+        if self.prefetcher is not None:
+            self.prefetcher.resize(size)
+        else:
+            self.env.resize(size)
+
+        self.memory_at_resize = resident_memory()
+        self.rewards = []
+        self.history.append((i, size))
+
+
+    def metrics(self):
+        """ Batch sizes used and the iterations they started at, for the results index """
+
+        return {'batch_sizes' : tuple(self.history)}
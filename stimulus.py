@@ -1,7 +1,7 @@
 ### Authors: Nicolas Y. Masse, Gregory D. Grant
 import numpy as np
-from parameters import par
-import copy
+from parameters import par, rng
+import threading
 
 # Actions that can be taken
 #   Move up, down, left, right
@@ -11,119 +11,336 @@ print('Using \'Room Stim\' stimulus file.')
 
 class RoomStimulus:
 
-    def __init__(self):
+    def __init__(self, worker=0):
 
-        self.initialize_rooms()
+        # Each worker process draws its episodes from its own stream
+        self.rng = rng('environment', worker)
+        self.rewards = par['rewards']
+
+        self.allocate(par['batch_size'])
+        self.reset_rooms()
         self.place_agents()
+        self.place_rewards()
+        self.num_episodes = 0
 
-        self.rewards = par['rewards']
+
+    def allocate(self, batch_size):
+        """ Preallocate the environment state for batch_size trials """
+
+        # Trials in the same batch can be in rooms of different sizes, with
+        # the reward maps padded to the largest room of any task
+        max_height, max_width = max_room_size()
+
+        self.batch_size = batch_size
+        self.agent_loc = np.zeros([batch_size, 2], dtype=np.int32)
+        self.room_index = np.zeros([batch_size], dtype=np.int32)
+        self.reward_map = -np.ones([batch_size, max_height, max_width], dtype=np.int32)
+        self.loc_history = np.zeros([par['num_time_steps'], batch_size, 2], dtype=np.int32)
+        self.step = 0
+
+
+    def resize(self, batch_size):
+        """ Change the number of trials, starting new episodes, e.g. for a
+            graph built with par['dynamic_batch'] """
+
+        self.allocate(batch_size)
+        self.place_agents()
+        self.place_rewards()
+
+
+    def reset_rooms(self, stim_loc=None):
+        """ Take up the room sizes in par, e.g. when switching tasks, with
+            newly drawn reward locations or those given in stim_loc """
+
+        # Room sizes, [height, width], in order of area
+        self.room_sizes = room_sizes()
+        if np.any(np.amax(self.room_sizes, axis=0) > self.reward_map.shape[1:]):
+            raise Exception('Rooms larger than those of par[\'room_sizes\'] or par[\'tasks\'] at start-up.')
+        self.buckets = np.array_split(np.arange(len(self.room_sizes)), min(par['room_buckets'], len(self.room_sizes)))
+        self.num_episodes = 0
+
+        if stim_loc is None:
+            self.initialize_rooms()
+        else:
+            self.stim_loc = stim_loc
 
 
     def initialize_rooms(self):
 
-        # Two sets of reward locations:  Random and default
-        rand_locs = np.random.choice(par['room_width']*par['room_height'], size=len(par['rewards']), replace=False)
-        default_locs = [[1,1], [par['room_height']-2,par['room_width']-2], [1,par['room_width']-2], [par['room_height']-2],1]
+        # Assign one stimulus location per reward, in each room size
+        self.stim_loc = np.zeros([len(self.room_sizes), len(par['rewards']), 2], dtype=np.int32)
+        for n, (height, width) in enumerate(self.room_sizes):
 
-        # Assign one stimulus location per reward
-        self.stim_loc = []
-        for i in range(len(par['rewards'])):
+            # Two sets of reward locations:  Random and default
+            rand_locs = self.rng.choice(width*height, size=len(par['rewards']), replace=False)
+            default_locs = [[1,1], [height-2,width-2], [1,width-2], [height-2,1]]
 
-            if par['use_default_rew_locs']:
-                if i >= len(default_locs):
+            # The default locations, one step in from the corners, fall outside
+            # rooms smaller than 3x3 and coincide in narrow ones, so those rooms
+            # use the random locations instead
+            use_default = par['use_default_rew_locs']
+            if use_default:
+                if len(par['rewards']) > len(default_locs):
                     raise Exception('Implement more default reward locations!')
-                rew_loc = default_locs[i]
-            else:
-                rew_loc = [int(rand_locs[i]//par['room_width']), int(rand_locs[i]%par['room_width'])]
+                locs = default_locs[:len(par['rewards'])]
+                use_default = min(height, width) >= 3 and len(set(map(tuple, locs))) == len(locs)
 
-            self.stim_loc.append(rew_loc)
+            for i in range(len(par['rewards'])):
 
-        # One locations are assigned, place rewards at those locations
-        self.place_rewards()
+                if use_default:
+                    rew_loc = default_locs[i]
+                else:
+                    rew_loc = [int(rand_locs[i]//width), int(rand_locs[i]%width)]
+
+                self.stim_loc[n,i] = rew_loc
+
+
+    def draw_rooms(self, room_index):
+        """ Fill room_index in place with the room size of each trial, drawn
+            from the current bucket of similarly sized rooms.  The bucket
+            advances every par['room_bucket_episodes'] episodes, from the
+            smallest rooms to the largest, and then starts over. """
+
+        bucket = self.buckets[(self.num_episodes//par['room_bucket_episodes'])%len(self.buckets)]
+        room_index[:] = self.rng.choice(bucket, size=len(room_index))
+        self.num_episodes += 1
+
+
+    def draw_rewards(self, reward_map, room_index, generator=None):
+        """ Fill reward_map in place with a random permutation of the
+            rewards over the stimulus locations, for each trial, drawn from
+            generator or else the environment's own stream """
+
+        # reward_map holds the index of the reward at each location, or -1
+        generator = self.rng if generator is None else generator
+        perms = np.argsort(generator.random((len(room_index), len(par['rewards']))), axis=1)
+        stim_loc = self.stim_loc[room_index[:,np.newaxis], perms]
+        reward_map[...] = -1
+        reward_map[np.arange(len(room_index))[:,np.newaxis], stim_loc[...,0], stim_loc[...,1]] = \
+            np.arange(len(par['rewards']))[np.newaxis,:]
+
+
+    def draw_agents(self, agent_loc, room_index):
+        """ Fill agent_loc and room_index in place with the rooms and random
+            starting locations of new episodes """
+
+        self.draw_rooms(room_index)
+        size = self.room_sizes[room_index]
+        agent_loc[:,1] = self.rng.integers(size[:,1])
+        agent_loc[:,0] = self.rng.integers(size[:,0])
 
 
     def place_rewards(self):
 
-        self.reward_locations = []
-        for i in range(par['batch_size']):
-            trial_set = {}
-            for r, loc in enumerate([self.stim_loc[ind] for ind in np.random.permutation(len(par['rewards']))]):
-                trial_set[tuple(loc)] = {'rew':par['rewards'][r], 'vec':par['reward_vectors'][r]}
-            self.reward_locations.append(trial_set)
+        self.draw_rewards(self.reward_map, self.room_index)
 
 
     def place_agents(self):
+        """ Start new episodes, in newly drawn rooms; the rewards must be
+            placed again afterwards """
 
-        xs = np.random.choice(par['room_width'],size=par['batch_size'])
-        ys = np.random.choice(par['room_height'],size=par['batch_size'])
-        self.agent_loc = [[int(ys[i]), int(xs[i])] for i in range(par['batch_size'])]
+        self.draw_agents(self.agent_loc, self.room_index)
+        self.reset_history()
 
-        self.loc_history = [self.agent_loc]
+
+    def reset_history(self):
+
+        self.step = 0
+        self.loc_history[0] = self.agent_loc
 
 
     def identify_reward(self, location, i):
 
-        if tuple(location) in self.reward_locations[i].keys():
-            data = self.reward_locations[i][tuple(location)]
-            return data['rew'], data['vec']
+        r = self.reward_map[i, location[0], location[1]]
+        if r >= 0:
+            return par['rewards'][r], par['reward_vectors'][r]
         else:
             return None, None
 
 
+    def room_size(self):
+        """ Height and width of the room of each trial """
+        return self.room_sizes[self.room_index]
+
+
+    def current_reward_index(self):
+        """ Index of the reward under each agent, or -1 """
+
+        return self.reward_map[np.arange(self.batch_size), self.agent_loc[:,0], self.agent_loc[:,1]]
+
+
     def make_inputs(self):
 
         # Inputs contain information for batch x (d1, d2, d3, d4, on_stim)
-        inputs = np.zeros([par['batch_size'], par['n_input']])
-        inputs[:,0] = [agent[0] for agent in self.agent_loc]
-        inputs[:,1] = [agent[1] for agent in self.agent_loc]
-        inputs[:,2] = [par['room_height'] - agent[0] for agent in self.agent_loc]
-        inputs[:,3] = [par['room_width'] - agent[1] for agent in self.agent_loc]
+        inputs = np.zeros([self.batch_size, par['n_input']], dtype=np.float32)
+        inputs[:,0] = self.agent_loc[:,0]
+        inputs[:,1] = self.agent_loc[:,1]
+        size = self.room_size()
+        inputs[:,2] = size[:,0] - self.agent_loc[:,0]
+        inputs[:,3] = size[:,1] - self.agent_loc[:,1]
 
-        for i in range(par['batch_size']):
-            _, vec = self.identify_reward(self.agent_loc[i], i)
-            if vec is not None:
-                inputs[i,par['num_nav_tuned']:par['num_nav_tuned']+par['num_rew_tuned']] = vec
+        r = self.current_reward_index()
+        on_stim = r >= 0
+        inputs[on_stim,par['num_nav_tuned']:par['num_nav_tuned']+par['num_rew_tuned']] = par['reward_vectors'][r[on_stim]]
 
-        return np.float32(inputs)
+        return inputs
 
 
     def agent_action(self, action, mask):
         """ Takes in a vector of actions of size [batch_size, n_output] """
 
         action = np.argmax(action, axis=-1) # to [batch_size]
-        reward = np.zeros(par['batch_size'])
+        reward = np.zeros(self.batch_size, dtype=np.float32)
 
-        for i, a in enumerate(action):
+        # If the network has found a reward for this trial, cease movement
+        active = np.reshape(mask, [-1]) != 0.
+        y = self.agent_loc[:,0]
+        x = self.agent_loc[:,1]
+        size = self.room_size()
 
-            # If the network has found a reward for this trial, cease movement
-            if mask[i] == 0.:
-                continue
+        # Input 0 = Move Up (visually right)
+        x += active*(action == 0)*(x != size[:,1]-1)
+        # Input 1 = Move Down (visually left)
+        x -= active*(action == 1)*(x != 0)
+        # Input 2 = Move Right (visually down)
+        y += active*(action == 2)*(y != size[:,0]-1)
+        # Input 3 = Move Left (visually up)
+        y -= active*(action == 3)*(y != 0)
 
-            if a == 0 and self.agent_loc[i][1] != par['room_width']-1:
-                # Input 0 = Move Up (visually right)
-                self.agent_loc[i][1] += 1
-            elif a == 1 and self.agent_loc[i][1] != 0:
-                # Input 1 = Move Down (visually left)
-                self.agent_loc[i][1] -= 1
-            elif a == 2 and self.agent_loc[i][0] != par['room_height']-1:
-                # Input 2 = Move Right (visually down)
-                self.agent_loc[i][0] += 1
-            elif a == 3 and self.agent_loc[i][0] != 0:
-                # Input 3 = Move Left (visually up)
-                self.agent_loc[i][0] -= 1
-            elif a == 4:
-                # Input 5 = Pick Reward
-                rew, _ = self.identify_reward(self.agent_loc[i], i)
-                if rew is not None:
-                    reward[i] = rew
+        # Input 5 = Pick Reward
+        r = self.current_reward_index()
+        pick = active*(action == 4)*(r >= 0)
+        reward[pick] = np.array(par['rewards'], dtype=np.float32)[r[pick]]
 
-        self.loc_history.append(copy.deepcopy(self.agent_loc))
+        self.step += 1
+        self.loc_history[self.step] = self.agent_loc
 
-        return np.float32(reward)
+        return reward
 
 
     def get_agent_locs(self):
-        return np.array(self.agent_loc).astype(np.float32)
+        return self.agent_loc.astype(np.float32)
+
+
+    def get_batch_size(self):
+        """ Number of trials, for graphs built with a variable batch dimension """
+        return np.int32(self.batch_size)
+
+
+    def get_episode(self):
+        """ Starting locations, reward maps and room sizes of the current
+            episodes, and the reward vectors, for stepping the environment
+            in the graph """
+        return self.agent_loc, self.reward_map, self.room_size(), np.float32(par['reward_vectors'])
+
+
+    def get_loc_history(self):
+        """ Copy of the agent locations recorded so far this episode """
+        return np.copy(self.loc_history[:self.step+1])
+
+
+    def get_reward_locations(self):
+        """ Per-trial dictionaries of reward locations, for trajectory records """
+
+        reward_locations = []
+        for i in range(self.batch_size):
+            trial_set = {}
+            for loc in zip(*np.where(self.reward_map[i] >= 0)):
+                r = self.reward_map[i][loc]
+                trial_set[(int(loc[0]), int(loc[1]))] = {'rew':par['rewards'][r], 'vec':par['reward_vectors'][r]}
+            reward_locations.append(trial_set)
+
+        return reward_locations
+
+
+def room_sizes():
+    """ The [height, width] of every room size used, in order of area """
+
+    sizes = [[par['room_height'], par['room_width']]] if par['room_sizes'] is None else par['room_sizes']
+    sizes = np.array(sizes, dtype=np.int32)
+    return sizes[np.argsort(np.prod(sizes, axis=1), kind='stable')]
+
+
+def max_room_size():
+    """ The largest height and width of any room, including those of later tasks """
+
+    sizes = [room_sizes()] + [np.reshape(task['room_sizes'], [-1,2]) for task in par['tasks'] or [] \
+        if task.get('room_sizes') is not None]
+    return np.amax(np.concatenate(sizes), axis=0)
+
+
+class EpisodePrefetcher:
+
+    """ Draws the next batch of agent and reward placements on a background
+        thread while the current batch is running, into a second set of
+        preallocated buffers that is swapped in at the iteration boundary """
+
+    def __init__(self, env):
+
+        self.env = env
+        self.back_agent_loc = np.zeros_like(env.agent_loc)
+        self.back_room_index = np.zeros_like(env.room_index)
+        self.back_reward_map = np.zeros_like(env.reward_map)
+
+        self.requested = threading.Event()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.requested.set()
+        self.thread.start()
+
+
+    def run(self):
+
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            self.env.draw_agents(self.back_agent_loc, self.back_room_index)
+            self.env.draw_rewards(self.back_reward_map, self.back_room_index)
+            self.ready.set()
+
+
+    def swap(self):
+        """ Install the prefetched episodes and start drawing the next ones.
+            Must not be called while the environment is being stepped. """
+
+        self.ready.wait()
+        self.ready.clear()
+
+        env = self.env
+        env.agent_loc, self.back_agent_loc = self.back_agent_loc, env.agent_loc
+        env.room_index, self.back_room_index = self.back_room_index, env.room_index
+        env.reward_map, self.back_reward_map = self.back_reward_map, env.reward_map
+        env.reset_history()
+
+        self.requested.set()
+
+
+    def hold(self):
+        """ Wait for the episodes being drawn, so that the environment can
+            be changed or placed directly; follow with redraw() """
+
+        self.ready.wait()
+
+
+    def resize(self, batch_size):
+        """ Change the number of trials of the environment (see
+            RoomStimulus.resize) and of the episodes drawn for it """
+
+        self.ready.wait()
+        self.env.resize(batch_size)
+        self.back_agent_loc = np.zeros_like(self.env.agent_loc)
+        self.back_room_index = np.zeros_like(self.env.room_index)
+        self.back_reward_map = np.zeros_like(self.env.reward_map)
+        self.redraw()
+
+
+    def redraw(self):
+        """ Discard the prefetched episodes and draw them again, e.g. after
+            switching tasks """
+
+        self.ready.wait()
+        self.ready.clear()
+        self.requested.set()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import numpy as np
+
+# Model modules
+from parameters import *
+
+# Parameters a task can set.  They only change the environment, so that all
+# tasks are trained on the same graph.
+TASK_PARAMS = ['room_sizes', 'room_buckets', 'room_bucket_episodes', 'use_default_rew_locs', 'reward_vectors']
+
+
+class TaskScheduler:
+
+    """ Trains the environment variants of par['tasks'] in turn, in one
+        session, consolidating the weights at the end of each task.  Each task
+        is a dictionary of TASK_PARAMS, with the others as at start-up, plus
+        optionally its number of iterations, 'iters', rounded up to whole
+        episodes.  A 'reward_vectors' of 'new' draws a new set of vectors.  The
+        reward locations of a task are drawn on its first visit and kept for
+        later ones. """
+
+    def __init__(self, env, windows_per_episode=1):
+
+        self.env = env
+        base = {k : par[k] for k in TASK_PARAMS}
+        generator = rng('tasks')
+
+        self.tasks = []
+        for task in par['tasks']:
+            unknown = set(task) - set(TASK_PARAMS) - {'iters'}
+            if len(unknown) > 0:
+                raise Exception('Tasks cannot set {}, as it would change the graph.'.format(sorted(unknown)))
+
+            t = dict(base)
+            t.update(task)
+            if isinstance(t['reward_vectors'], str) and t['reward_vectors'] == 'new':
+                t['reward_vectors'] = draw_reward_vectors(generator)
+            t['iters'] = int(np.ceil(task.get('iters', par['task_iters'])/windows_per_episode))*windows_per_episode
+            t['stim_loc'] = None
+            self.tasks.append(t)
+
+        # Upper bound on the iterations, as tasks can end early
+        self.num_iters = sum(t['iters'] for t in self.tasks)
+
+        # Mean reward on every task seen so far, at the end of each task
+        self.task_rewards = []
+
+        self.activate(0)
+        self.start_iter = 0
+        self.end_iter = self.tasks[0]['iters']
+
+
+    def activate(self, n):
+        """ Set up the environment for task n """
+
+        task = self.tasks[n]
+        for k in TASK_PARAMS:
+            par[k] = task[k]
+        self.env.reset_rooms(task['stim_loc'])
+        task['stim_loc'] = self.env.stim_loc
+        self.active = n
+
+
+    def last_task(self):
+        return self.active == len(self.tasks) - 1
+
+
+    def next_task(self, sess, model, prefetcher, i):
+        """ Consolidate the task just trained, and start the next one at
+            iteration i """
+
+        self.finish_task(sess, model, prefetcher)
+        self.activate(self.active + 1)
+        self.start_iter = i
+        self.end_iter = i + self.tasks[self.active]['iters']
+        print('Starting task {} of {} at iteration {}\n'.format(self.active, len(self.tasks), i))
+
+        if prefetcher is not None:
+            prefetcher.redraw()
+
+
+    def finish_task(self, sess, model, prefetcher):
+        """ Consolidate the current task, and measure the reward on it and
+            on every task before it """
+
+        # The environment is used directly from here on
+        if prefetcher is not None:
+            prefetcher.hold()
+
+        consolidate(sess, model, self.env)
+
+        if par['task_eval_batches'] > 0:
+            current = self.active
+            self.task_rewards.append([self.task_reward(sess, model, n) for n in range(current + 1)])
+            self.activate(current)
+            print('After task {}: '.format(current) + ' | '.join('Task {}: {:5.3f}'.format(n, r) \
+                for n, r in enumerate(self.task_rewards[-1])))
+
+
+    def task_reward(self, sess, model, n):
+        """ Mean reward per trial on task n, with the current weights """
+
+        self.activate(n)
+        reward = []
+        for b in range(par['task_eval_batches']):
+            self.env.place_agents()
+            self.env.place_rewards()
+            state = model.initial_state()
+            total = 0.
+            for w in range(model.windows_per_episode):
+                r, state = sess.run([model.reward, model.state_out], feed_dict=model.state_feed(state))
+                total += np.sum(np.stack(r), axis=0)
+            reward.append(np.mean(total))
+
+        return float(np.mean(reward))
+
+
+    def metrics(self):
+        """ Rewards on each task after each task, and the mean reward on all
+            tasks at the end, for the results index """
+
+        if len(self.task_rewards) == 0:
+            return {}
+
+        return {'task_rewards'     : tuple(tuple(r) for r in self.task_rewards),
+                'mean_task_reward' : float(np.mean(self.task_rewards[-1]))}
+
+
+def consolidate(sess, model, env):
+    """ Add the importance of each weight for the task just trained to the
+        big omegas, and reset the per-task records, in one run.  With EWC, the
+        Fisher information is estimated first, from rollouts of env. """
+
+    feed_dict = {}
+    if par['stabilization'] == 'EWC':
+        import fisher
+        fisher_info = fisher.estimate_fisher(sess, model, env)
+        feed_dict = {model.fisher_ph[n]: fisher_info[n] for n in model.fisher_ph}
+
+    sess.run(model.consolidate, feed_dict=feed_dict)
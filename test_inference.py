@@ -0,0 +1,97 @@
+### Authors: Nicolas Y. Masse, Gregory D. Grant
+
+# Required packages
+import pytest
+tf = pytest.importorskip('tensorflow')
+import numpy as np
+import threading
+import pickle
+
+# Model modules
+from parameters import *
+import model
+import inference
+
+NUM_CLIENTS = 8
+
+
+@pytest.fixture
+def weights_fn(tmp_path):
+    """ Untrained weights, served from a socket in tmp_path, with enough
+        time for concurrent requests to join a batch """
+
+    tf.reset_default_graph()
+    with tf.Session() as sess:
+        inference.InferenceModel()
+        sess.run(tf.global_variables_initializer())
+        weights = model.get_weights(sess)
+
+    snapshot = dict(par, inference_address=str(tmp_path / 'policy_server.sock'), \
+        inference_max_wait=0.05, inference_max_batch=64)
+    fn = str(tmp_path / 'weights.pkl')
+    pickle.dump({'weights':weights, 'par':snapshot}, open(fn, 'wb'))
+
+    return fn
+
+
+def expected_reply(server, observation):
+    """ Policy and value of a new session given one observation, run alone """
+
+    m = server.model
+    state = server.initial_state()
+    feed_dict = {m.inputs: observation[np.newaxis], m.prev_reward: np.zeros([1, par['n_val']], dtype=np.float32), \
+        m.prev_action: state['action'][np.newaxis]}
+    for i in range(par['num_pred_cells']):
+        feed_dict[m.h_in[i]] = state['h'][i][np.newaxis]
+        feed_dict[m.c_in[i]] = state['c'][i][np.newaxis]
+
+    pol, val = server.sess.run([m.pol_out, m.val_out], feed_dict=feed_dict)
+    return pol[0], val[0]
+
+
+def test_concurrent_clients_are_batched(weights_fn):
+
+    server = inference.PolicyServer(weights_fn)
+    server.start()
+
+    # Each client sends its own observation, all at once
+    observations = np.random.default_rng(0).uniform(0., 5., size=[NUM_CLIENTS, par['n_input']]).astype(np.float32)
+    replies = [None]*NUM_CLIENTS
+    ready = threading.Barrier(NUM_CLIENTS)
+
+    def run(k):
+        client = inference.PolicyClient(server.address)
+        ready.wait()
+        replies[k] = client.step(k, observations[k])
+        client.close()
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(NUM_CLIENTS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=60)
+
+    try:
+        assert all(r is not None for r in replies)
+        assert sum(server.batch_sizes) == NUM_CLIENTS
+        assert max(server.batch_sizes) > 1
+
+        # Every client is answered for its own observation, not another's
+        for k in range(NUM_CLIENTS):
+            pol, val = expected_reply(server, observations[k])
+            np.testing.assert_allclose(replies[k]['policy'], pol, rtol=1e-4, atol=1e-6)
+            np.testing.assert_allclose(replies[k]['value'], val, rtol=1e-4, atol=1e-6)
+        assert not np.allclose(replies[0]['policy'], replies[1]['policy'])
+    finally:
+        server.stop()
+
+
+def test_benchmark_under_load(weights_fn):
+
+    measurements = inference.benchmark(weights_fn, num_clients=[1, NUM_CLIENTS], num_steps=20)
+
+    assert [m['clients'] for m in measurements] == [1, NUM_CLIENTS]
+    for m in measurements:
+        assert m['steps_per_sec'] > 0.
+        assert 0. < m['latency_p50'] <= m['latency_p99'] < np.inf
+    assert measurements[-1]['mean_batch'] > 1.